@@ -0,0 +1,415 @@
+## Archive of all titration curves in one file
+# Cross-sample analyses (E0 drift, emf stability, ...) would otherwise have to
+# parse every titration file again. An archive is a folder with
+#   curves.bin  the points of all FWD and BWD curves, back to back, as
+#               records of solutions.titration_fields (weight, emf, t, T, pH)
+#   raw.bin     the same points as read from the files, records of raw_fields
+#               (extract_data.titration_dtype with the time as 12 ascii
+#               bytes instead of 32 unicode characters), so a curve can be
+#               derived again
+#   index.csv   one row per curve: file, header row, sample id, date, titrant
+#               lot, sample header values, offset and length in both .bin
+#               files, and the auxiliary rows the weights were computed with
+# All three are only appended to, under a lock shared with other processes.
+# A crash can leave a partial index row or curves without an index row; both
+# are dropped the next time the archive is opened for adding. The reader
+# memory maps the .bin files copy-on-write and returns Titration views of
+# single curves, so only the pages of the curves that are used are read, and
+# changes to them (e.g., recalculate_pH) never reach the archive.
+#
+# A curve is one contiguous slice of records rather than one slice per column,
+# because Titration keeps its points in one record buffer: a record slice is
+# a Titration as is (Titration.from_buffer), a column layout would have to be
+# copied together for every curve.
+#
+#   archive = TitrationArchive("archive")
+#   for entry in archive.find(lot="A21", direction="fwd"):
+#       titration = archive.titration(entry)
+import csv
+import json
+import os
+import re
+import tempfile
+import logging
+import numpy as np
+from auxiliary import registry
+from extract_data import read_titration_file, titration_data, titration_dtype
+import parse_cache
+from locks import exclusive_lock
+from solutions import Titrant, Titration, titration_fields
+
+logger = logging.getLogger(__name__)
+
+curves_file = "curves.bin"
+raw_file = "raw.bin"
+index_file = "index.csv"
+index_columns = [
+    "file",
+    # json of the header row of the file
+    "header",
+    "sample_id",
+    "date",
+    "sample_type",
+    "w0",
+    "salt",
+    "emf0",
+    "flag",
+    "direction",
+    "titrant",
+    "titrant_id",
+    "titrant_concentration",
+    "titrant_ionic_strength",
+    "E0",
+    "k",
+    "offset",
+    "length",
+    # json of the auxiliary rows used, table name -> id -> fingerprint
+    "dependencies",
+]
+# columns read back as numbers
+float_columns = [
+    "w0",
+    "salt",
+    "emf0",
+    "titrant_concentration",
+    "titrant_ionic_strength",
+    "E0",
+    "k",
+]
+int_columns = ["offset", "length"]
+# the columns of the file; time, e.g. 10:23:45, takes 12 bytes rather than
+# the 128 of the parsed U32, which would make raw.bin larger than the files
+raw_time_length = 12
+raw_fields = np.dtype(
+    [
+        (name, f"S{raw_time_length}" if name == "time" else titration_dtype[name])
+        for name in titration_dtype.names
+    ]
+)
+
+
+def _file_date(filename: str) -> str:
+    # titration files start with the date, e.g., 20210101 SW0-A.csv
+    match = re.match(r"(\d{8}) ", os.path.basename(filename))
+    return match.group(1) if match else ""
+
+
+def _parse_entry(row: dict) -> dict:
+    # None for a row cut short by a crash
+    if None in row or any(row.get(column) is None for column in index_columns):
+        return None
+    try:
+        for column in float_columns:
+            row[column] = float(row[column]) if row[column] != "" else None
+        for column in int_columns:
+            row[column] = int(row[column])
+    except ValueError:
+        return None
+    return row
+
+
+class TitrationArchive:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.curves_path = os.path.join(folder, curves_file)
+        self.raw_path = os.path.join(folder, raw_file)
+        self.index_path = os.path.join(folder, index_file)
+        self._curves = None
+        self._raw = None
+        self._titrants = dict()
+        self._load()
+
+    def _load(self):
+        self.entries = list()
+        # lookups, value -> positions in entries
+        self._by_file = dict()
+        self._by_sample = dict()
+        self._by_date = dict()
+        self._by_lot = dict()
+        if not os.path.exists(self.index_path):
+            return
+        # curves that are completely on disk in both files
+        records = min(
+            self._records(self.curves_path, titration_fields),
+            self._records(self.raw_path, raw_fields),
+        )
+        with open(self.index_path, newline="") as csvfile:
+            reader = csv.DictReader(csvfile)
+            if reader.fieldnames and reader.fieldnames != index_columns:
+                raise ValueError(
+                    f"{self.index_path} was written by another version, build the archive again"
+                )
+            for row in reader:
+                entry = _parse_entry(row)
+                if entry is None or entry["offset"] + entry["length"] > records:
+                    logger.warning(
+                        f"Ignoring incomplete entry for {row.get('file')} in {self.index_path}"
+                    )
+                    continue
+                self._add_entry(entry)
+
+    @staticmethod
+    def _records(path: str, dtype: np.dtype) -> int:
+        return os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+
+    def _add_entry(self, row: dict):
+        position = len(self.entries)
+        self.entries.append(row)
+        self._by_file.setdefault(row["file"], list()).append(position)
+        self._by_sample.setdefault(row["sample_id"], list()).append(position)
+        self._by_date.setdefault(row["date"], list()).append(position)
+        self._by_lot.setdefault(row["titrant_id"], list()).append(position)
+
+    def _repair(self) -> int:
+        """
+        Method to cut the files back to the entries that are complete, after
+        a crash while adding. Called with the lock held
+
+        Returns:
+            int: number of records in the .bin files
+        """
+        records = max(
+            (entry["offset"] + entry["length"] for entry in self.entries), default=0
+        )
+        for path, dtype in (
+            (self.curves_path, titration_fields),
+            (self.raw_path, raw_fields),
+        ):
+            with open(path, "ab") as binfile:
+                if binfile.tell() != records * dtype.itemsize:
+                    binfile.truncate(records * dtype.itemsize)
+        # the complete entries again, without partial or dangling rows
+        with open(self.index_path, newline="") as csvfile:
+            lines = csvfile.read().splitlines(keepends=True)
+        complete = {(entry["file"], entry["direction"]) for entry in self.entries}
+        kept = lines[:1] + [
+            line
+            for line, row in zip(lines[1:], csv.DictReader(lines))
+            if (row.get("file"), row.get("direction")) in complete
+            and line.endswith("\n")
+        ]
+        if len(kept) != len(lines):
+            handle, temporary = tempfile.mkstemp(
+                dir=self.folder, prefix=".", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(handle, "w", newline="") as csvfile:
+                    csvfile.writelines(kept)
+                    csvfile.flush()
+                    os.fsync(csvfile.fileno())
+                os.replace(temporary, self.index_path)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.unlink(temporary)
+                raise
+        return records
+
+    def add(self, files: list, burette_id: str = "dosimat 12") -> int:
+        """
+        Method to append the curves of titration files that are not in the
+        archive yet. Files that cannot be read are logged and skipped. Other
+        processes adding to the same archive wait for this one to finish
+
+        Args:
+            files (list): titration files
+            burette_id (str): burette the titrations were done with
+
+        Returns:
+            int: number of files added
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        added = 0
+        with exclusive_lock(self.index_path):
+            if not os.path.exists(self.index_path):
+                with open(self.index_path, "w", newline="") as indexfile:
+                    csv.DictWriter(indexfile, fieldnames=index_columns).writeheader()
+            # other processes may have added files since this one was opened
+            self._load()
+            offset = self._repair()
+            with open(self.curves_path, "ab") as curvesfile, open(
+                self.raw_path, "ab"
+            ) as rawfile, open(self.index_path, "a", newline="") as indexfile:
+                writer = csv.DictWriter(indexfile, fieldnames=index_columns)
+                for file in files:
+                    file = os.path.abspath(file)
+                    if file in self._by_file:
+                        continue
+                    try:
+                        # parsed once, for both the raw and the derived curves
+                        parsed = parse_cache.load(file, read_titration_file)
+                        with registry.track() as dependencies:
+                            sample, fwd, bwd = titration_data(file, burette_id, parsed)
+                    except Exception as e:
+                        logger.error(f"Failed to read {file}: {e!r}")
+                        continue
+                    rows = list()
+                    for direction, titration, raw in (
+                        ("fwd", fwd, parsed.fwd_data),
+                        ("bwd", bwd, parsed.bwd_data),
+                    ):
+                        if titration is None or not len(titration):
+                            continue
+                        curvesfile.write(
+                            np.ascontiguousarray(
+                                titration.data, dtype=titration_fields
+                            ).tobytes()
+                        )
+                        if np.char.str_len(raw["time"]).max() > raw_time_length:
+                            logger.warning(
+                                f"Times in {file} are cut to {raw_time_length} characters"
+                            )
+                        rawfile.write(raw.astype(raw_fields).tobytes())
+                        rows.append(
+                            {
+                                "file": file,
+                                "header": json.dumps(parsed.sample_info),
+                                "sample_id": sample.id,
+                                "date": _file_date(file),
+                                "sample_type": sample.type,
+                                "w0": sample.w0,
+                                "salt": (
+                                    sample.S
+                                    if sample.type.lower() == "sw"
+                                    else sample.I
+                                ),
+                                "emf0": sample.emf0,
+                                "flag": sample.flag,
+                                "direction": direction,
+                                "titrant": titration.titrant.type,
+                                "titrant_id": titration.titrant.id,
+                                "titrant_concentration": titration.titrant.concentration,
+                                "titrant_ionic_strength": titration.titrant.ionic_strength,
+                                "E0": titration.E0,
+                                "k": titration.k,
+                                "offset": offset,
+                                "length": len(titration),
+                                "dependencies": json.dumps(
+                                    dependencies, sort_keys=True
+                                ),
+                            }
+                        )
+                        offset += len(titration)
+                    # the curves are on disk before the index points to them
+                    curvesfile.flush()
+                    rawfile.flush()
+                    writer.writerows(rows)
+                    indexfile.flush()
+                    for row in rows:
+                        self._add_entry(
+                            _parse_entry(
+                                {
+                                    key: "" if value is None else str(value)
+                                    for key, value in row.items()
+                                }
+                            )
+                        )
+                    added += 1
+        logger.info(f"Added {added} files to {self.folder}")
+        return added
+
+    def find(
+        self,
+        sample_id: str = None,
+        date: str = None,
+        lot: str = None,
+        direction: str = None,
+    ) -> list:
+        """
+        Method to get the index entries of the curves that match all given
+        criteria
+
+        Args:
+            sample_id (str): sample id, e.g., SW1
+            date (str): date of the titration, YYYYMMDD
+            lot (str): titrant lot, e.g., A21
+            direction (str): fwd (HCl) or bwd (NaOH)
+
+        Returns:
+            list: index rows in archive order
+        """
+        positions = None
+        for lookup, value in (
+            (self._by_sample, sample_id),
+            (self._by_date, date),
+            (self._by_lot, lot),
+        ):
+            if value is not None:
+                matches = set(lookup.get(value, ()))
+                positions = matches if positions is None else positions & matches
+        if positions is None:
+            positions = range(len(self.entries))
+        return [
+            self.entries[position]
+            for position in sorted(positions)
+            if direction is None or self.entries[position]["direction"] == direction
+        ]
+
+    def titration(self, entry: dict) -> Titration:
+        """
+        Method to get one curve as a Titration viewing the memory map
+
+        Args:
+            entry (dict): index row, e.g., from find
+
+        Returns:
+            Titration: curve with its titrant, E0 and k
+        """
+        end = entry["offset"] + entry["length"]
+        if self._curves is None or len(self._curves) < end:
+            # mapped again when the archive has grown since
+            self._curves = np.memmap(self.curves_path, dtype=titration_fields, mode="c")
+        key = (
+            entry["titrant"],
+            entry["titrant_id"],
+            entry["titrant_concentration"],
+            entry["titrant_ionic_strength"],
+        )
+        if key not in self._titrants:
+            self._titrants[key] = Titrant(*key)
+        return Titration.from_buffer(
+            self._curves[entry["offset"] : end],
+            self._titrants[key],
+            entry["E0"],
+            entry["k"],
+        )
+
+    def raw(self, entry: dict) -> np.ndarray:
+        """
+        Method to get the points of one curve as they were read from the
+        file, e.g., to convert the volumes again with other coefficients
+
+        Args:
+            entry (dict): index row, e.g., from find
+
+        Returns:
+            np.ndarray: records of raw_fields viewing the memory map
+        """
+        end = entry["offset"] + entry["length"]
+        if self._raw is None or len(self._raw) < end:
+            self._raw = np.memmap(self.raw_path, dtype=raw_fields, mode="c")
+        return self._raw[entry["offset"] : end]
+
+    def titrations(self, **criteria):
+        """
+        Method to iterate over the curves that match, see find
+
+        Yields:
+            tuple: index row, Titration
+        """
+        for entry in self.find(**criteria):
+            yield entry, self.titration(entry)
+
+    def stale(self) -> list:
+        """
+        Method to find curves whose weights were computed with auxiliary rows
+        that have changed since, e.g., to rebuild the archive
+
+        Returns:
+            list: index rows
+        """
+        fingerprints = dict()
+        return [
+            entry
+            for entry in self.entries
+            if registry.changed(json.loads(entry["dependencies"]), fingerprints)
+        ]
@@ -0,0 +1,343 @@
+## Process-wide registry of the auxiliary data tables
+# All titrant, burette, nutrient and system constant lookups go through here,
+# so the csv files in auxiliary_data/ are read once per process and only read
+# again when a file is modified on disk. Lookups inside registry.track() are
+# recorded with a fingerprint of the row, so a result can tell later whether
+# the auxiliary data it was computed from has changed.
+import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union
+from exceptions import CalibrationDataMissing, FileMissing
+from locks import exclusive_lock
+import profiling
+
+auxiliary_folder = "auxiliary_data/"
+# previous values of changed tables, kept out of auxiliary_folder itself so
+# the history files never match the keyword of a table
+history_folder = "history"
+history_columns = ["time", "id", "column", "old", "new", "source"]
+
+# keywords of the tables, resolved the same way as get_matching_files
+auxiliary_tables = [
+    "HCl_summary",
+    "NaOH_summary",
+    "burette_density",
+    "nutrients",
+    "system_constants",
+]
+
+
+def _parse_value(value: str) -> Union[float, str]:
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _read_table(path: str) -> dict[str, dict]:
+    """
+    Reads an auxiliary csv into an index keyed by its first column. Numeric
+    cells are converted to float, and if an id occurs more than once the
+    first row is kept
+
+    Args:
+        path (str): csv file
+
+    Returns:
+        dict: rows keyed by id, in file order
+    """
+    index = dict()
+    with open(path, newline="") as csvfile:
+        reader = csv.DictReader(csvfile)
+        key = reader.fieldnames[0]
+        for row in reader:
+            if not row or row[key] is None:
+                continue
+            index.setdefault(
+                row[key], {name: _parse_value(value) for name, value in row.items()}
+            )
+    return index
+
+
+class _Number(float):
+    # a number written back as it was read, e.g., -1.069e-4, and left
+    # unquoted by csv.QUOTE_NONNUMERIC
+    def __new__(cls, text: str):
+        number = super().__new__(cls, text)
+        number.text = text
+        return number
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def _quoted_row(row: list) -> list:
+    # values for a QUOTE_NONNUMERIC writer: text is quoted, numbers and
+    # empty values are not
+    values = list()
+    for value in row:
+        if value == "":
+            values.append(None)
+            continue
+        try:
+            values.append(_Number(value))
+        except ValueError:
+            values.append(value)
+    return values
+
+
+def row_fingerprint(row: dict) -> str:
+    """
+    Method to get a short hash of the values of a table row
+
+    Args:
+        row (dict): column name -> value, None for a missing row
+
+    Returns:
+        str: hex digest, empty for a missing row
+    """
+    if row is None:
+        return ""
+    encoded = json.dumps(row, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:12]
+
+
+class AuxiliaryTables:
+    def __init__(self, folder: str = auxiliary_folder):
+        self.folder = folder
+        # keyword -> path, and path -> (mtime, index)
+        self._paths = dict()
+        self._tables = dict()
+        # rows looked up by each thread inside track(), e.g., server requests
+        self._tracking = threading.local()
+
+    def path(self, keyword: str) -> str:
+        """
+        Method to find the csv file for a table, i.e., the first file in
+        the auxiliary folder matching *keyword*csv
+
+        Args:
+            keyword (str): e.g., HCl, NaOH, burette_density
+
+        Raises:
+            FileMissing
+
+        Returns:
+            str: path to the table
+        """
+        if keyword not in self._paths:
+            matches = sorted(
+                str(file)
+                for file in Path(self.folder).glob(f"*{keyword}*csv")
+                if file.is_file()
+            )
+            if not matches:
+                raise FileMissing(
+                    f"No auxiliary table matching {keyword} in {self.folder}"
+                )
+            self._paths[keyword] = matches[0]
+        return self._paths[keyword]
+
+    def table(self, keyword: str) -> dict[str, dict]:
+        """
+        Method to get the indexed table, read from disk only the first time
+        or when the file has been modified since it was last read
+
+        Args:
+            keyword (str): table keyword
+
+        Returns:
+            dict: rows keyed by id
+        """
+        with profiling.stage("auxiliary"):
+            path = self.path(keyword)
+            mtime = os.stat(path).st_mtime_ns
+            cached = self._tables.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, _read_table(path))
+                self._tables[path] = cached
+            return cached[1]
+
+    def row(self, keyword: str, id: str) -> dict:
+        """
+        Method to get one row of a table
+
+        Args:
+            keyword (str): table keyword
+            id (str): identifier in the first column
+
+        Raises:
+            CalibrationDataMissing: if id is not in the table
+
+        Returns:
+            dict: column name -> value
+        """
+        row = self.get(keyword, id)
+        if row is None:
+            raise CalibrationDataMissing(f"No entry for {id} in {self.path(keyword)}")
+        return row
+
+    def get(self, keyword: str, id: str) -> dict:
+        """
+        Method to get one row of a table, or None if id is not in the table
+
+        Args:
+            keyword (str): table keyword
+            id (str): identifier in the first column
+
+        Returns:
+            dict: column name -> value
+        """
+        row = self.table(keyword).get(id)
+        for used in getattr(self._tracking, "stack", ()):
+            used.setdefault(self.name(keyword), dict())[id] = row_fingerprint(row)
+        return row
+
+    def name(self, keyword: str) -> str:
+        # file name of the table without extension, e.g., HCl -> HCl_summary
+        return Path(self.path(keyword)).stem
+
+    @contextmanager
+    def track(self):
+        """
+        Records every row looked up in this thread inside the with block,
+        missing rows included, e.g., for the nutrients of a sample
+
+        Yields:
+            dict: table name -> id -> fingerprint of the row
+        """
+        used = dict()
+        stack = self._tracking.__dict__.setdefault("stack", list())
+        stack.append(used)
+        try:
+            yield used
+        finally:
+            stack.remove(used)
+
+    def changed(self, dependencies: dict, fingerprints: dict = None) -> list:
+        """
+        Method to compare recorded lookups with the tables as they are now
+
+        Args:
+            dependencies (dict): table name -> id -> fingerprint, as from track()
+            fingerprints (dict): current fingerprints to reuse between calls,
+                filled in as rows are compared
+
+        Returns:
+            list: (table name, id) of rows that changed, were added or removed
+        """
+        if fingerprints is None:
+            fingerprints = dict()
+        changes = list()
+        for name, rows in dependencies.items():
+            current = fingerprints.setdefault(name, dict())
+            for id, fingerprint in rows.items():
+                if id not in current:
+                    try:
+                        current[id] = row_fingerprint(self.table(name).get(id))
+                    except FileMissing:
+                        current[id] = ""
+                if current[id] != fingerprint:
+                    changes.append((name, id))
+        return changes
+
+    def update(self, keyword: str, updates: dict[str, dict], source: str = ""):
+        """
+        Method to change values of a table on disk. The new table is written
+        to a temporary file in the same folder and moved over the old one, so
+        readers, also in other processes, only ever see the old or the new
+        table. Updates of the same table from several processes are done one
+        after the other. Every change is appended to the table's history file
+
+        Args:
+            keyword (str): table keyword
+            updates (dict): id -> {column: new value}
+            source (str): what the new values come from, for the history
+
+        Raises:
+            CalibrationDataMissing: if an id is not in the table
+        """
+        path = self.path(keyword)
+        # other processes updating the same table wait, so that no update is
+        # lost between reading the table and replacing it
+        lock = os.path.join(self.folder, history_folder, keyword)
+        os.makedirs(os.path.dirname(lock), exist_ok=True)
+        with exclusive_lock(lock):
+            with open(path, newline="") as csvfile:
+                text = csvfile.read()
+            rows = list(csv.reader(text.splitlines()))
+            header = rows[0]
+            # keep the layout of the file: quoted text, line endings, last newline
+            quote_text = len(rows) > 1 and text.splitlines()[1].startswith('"')
+            newline = "\r\n" if "\r\n" in text else "\n"
+            by_id = dict()
+            for row in rows[1:]:
+                if row:
+                    by_id.setdefault(row[0], row)
+            changes = list()
+            for id, values in updates.items():
+                if id not in by_id:
+                    raise CalibrationDataMissing(f"No entry for {id} in {path}")
+                for column, value in values.items():
+                    i = header.index(column)
+                    changes.append((id, column, by_id[id][i], str(value)))
+                    by_id[id][i] = str(value)
+            output = io.StringIO()
+            csv.writer(output, lineterminator=newline).writerow(header)
+            writer = csv.writer(
+                output,
+                lineterminator=newline,
+                quoting=csv.QUOTE_NONNUMERIC if quote_text else csv.QUOTE_MINIMAL,
+            )
+            writer.writerows(
+                _quoted_row(row) if quote_text else row for row in rows[1:] if row
+            )
+            output = output.getvalue()
+            if not text.endswith("\n"):
+                # the file had no newline after the last row
+                output = output[: -len(newline)]
+            # not named *csv, so the temporary file never matches a table keyword
+            handle, temporary = tempfile.mkstemp(
+                dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(handle, "w", newline="") as tmpfile:
+                    tmpfile.write(output)
+                    tmpfile.flush()
+                    os.fsync(tmpfile.fileno())
+                os.replace(temporary, path)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.unlink(temporary)
+                raise
+            self._tables.pop(path, None)
+            self._record_history(keyword, changes, source)
+
+    def _record_history(self, keyword: str, changes: list, source: str):
+        folder = os.path.join(self.folder, history_folder)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{keyword}_history.csv")
+        new_file = not os.path.exists(path)
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(path, "a", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            if new_file:
+                writer.writerow(history_columns)
+            for id, column, old, new in changes:
+                writer.writerow([now, id, column, old, new, source])
+
+    def warm(self):
+        """Loads all known tables, e.g., once per worker process"""
+        for keyword in auxiliary_tables:
+            self.table(keyword)
+
+
+registry = AuxiliaryTables()
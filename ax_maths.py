@@ -1,28 +1,194 @@
 import math
 import numpy as np
-from scipy.stats import linregress
 from collections import namedtuple
 
 
-def Gran_F1(mass: list, emf: list, T: float, m0: float):
-    # assumes data was not collected below a certain pH/emf
-    # TODO maybe put in some good tools to find the optimal data range?
+def Gran_F1(mass: list, emf: list, T: float, m0: float, auto_window: bool = False):
+    # assumes data was not collected below a certain pH/emf, unless the
+    # window is chosen automatically (best_linear_window)
     Gran_data = namedtuple(
         "Gran_data",
         ["F1", "F1_mass", "slope", "intercept", "goodness_of_fit", "indices"],
     )
     k = k_boltz(T)
     F1_all_data = m0 * np.exp(emf / k)
-    # TODO have automatic findig_good_data method instead of hardcoded 100 cutoff
-    indices = (0, np.count_nonzero(F1_all_data > 100))
+    if auto_window:
+        # F1 is only linear past the equivalence point, where it is positive
+        indices = best_linear_window(mass, F1_all_data, above=0)
+    else:
+        indices = (0, np.count_nonzero(F1_all_data > 100))
     F1 = F1_all_data[indices[0] : indices[1]]
     F1_mass = mass[indices[0] : indices[1]]
-    slope, intercept, r_value, _, _ = linregress(F1_mass, F1)
-    goodness_of_fit = r_value**2
+    slope, intercept, goodness_of_fit = _linear_fit(F1_mass, F1)
 
     return Gran_data(F1, F1_mass, slope, intercept, goodness_of_fit, indices)
 
 
+def _linear_fit(x: np.ndarray, y: np.ndarray) -> tuple[float, float, float]:
+    # slope, intercept and r2 as from scipy.stats.linregress, which alone
+    # takes most of the start up time of the command line tools
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(x) < 2:
+        raise ValueError("A linear fit needs at least two points")
+    dx = x - np.mean(x)
+    dy = y - np.mean(y)
+    Sxx = dx @ dx
+    Syy = dy @ dy
+    Sxy = dx @ dy
+    if Sxx == 0:
+        raise ValueError("A linear fit needs at least two distinct x values")
+    slope = Sxy / Sxx
+    intercept = np.mean(y) - slope * np.mean(x)
+    goodness_of_fit = Sxy**2 / (Sxx * Syy) if Syy else 1.0
+    return slope, intercept, goodness_of_fit
+
+
+Gran_estimate = namedtuple(
+    "Gran_estimate",
+    ["n", "slope", "intercept", "goodness_of_fit", "equivalence_mass"],
+)
+
+
+class GranEstimator:
+    """
+    Streaming version of Gran_F1 for use during a titration. Points are added
+    one at a time and the fit of F1 against mass is kept as running means and
+    co-moments (Welford), so every update is O(1) and numerically stable.
+    Like Gran_F1, only points with F1 above the cutoff are part of the fit.
+    """
+
+    def __init__(self, m0: float, cutoff: float = 100):
+        self.m0 = m0
+        self.cutoff = cutoff
+        self.n = 0
+        self._mean_mass = 0.0
+        self._mean_F1 = 0.0
+        self._Sxx = 0.0
+        self._Syy = 0.0
+        self._Sxy = 0.0
+
+    def update(self, mass: float, emf: float, T: float) -> Gran_estimate:
+        """
+        Adds one titration point and returns the current fit
+
+        Args:
+            mass (float): titrant mass added so far
+            emf (float): measured emf
+            T (float): temperature in K
+
+        Returns:
+            Gran_estimate: number of points, slope, intercept, r2 and equivalence mass
+        """
+        F1 = self.m0 * math.exp(emf / k_boltz(T))
+        if F1 > self.cutoff:
+            self.n += 1
+            dx = mass - self._mean_mass
+            dy = F1 - self._mean_F1
+            self._mean_mass += dx / self.n
+            self._mean_F1 += dy / self.n
+            self._Sxx += dx * (mass - self._mean_mass)
+            self._Syy += dy * (F1 - self._mean_F1)
+            self._Sxy += dx * (F1 - self._mean_F1)
+        return self.estimate()
+
+    def estimate(self) -> Gran_estimate:
+        # a line needs two distinct masses, before that everything is nan
+        if self.n < 2 or self._Sxx == 0:
+            return Gran_estimate(self.n, math.nan, math.nan, math.nan, math.nan)
+        slope = self._Sxy / self._Sxx
+        intercept = self._mean_F1 - slope * self._mean_mass
+        if self._Syy > 0:
+            goodness_of_fit = self._Sxy**2 / (self._Sxx * self._Syy)
+        else:
+            goodness_of_fit = 1.0
+        if slope:
+            equivalence_mass = -intercept / slope
+        else:
+            equivalence_mass = math.nan
+        return Gran_estimate(
+            self.n, slope, intercept, goodness_of_fit, equivalence_mass
+        )
+
+
+def best_linear_window(
+    x: np.ndarray,
+    y: np.ndarray,
+    min_points: int = 5,
+    min_r2: float = 0.9995,
+    above: float = None,
+) -> tuple[int, int]:
+    """
+    Finds the contiguous range of points that is best described by a straight
+    line: the longest window with r2 >= min_r2, or the window with the highest
+    r2 if none reaches it. The sums of a linear fit are differences of
+    cumulative sums, so every window is scored with a few array operations
+    instead of one regression per window, O(n) per window start
+
+    Args:
+        x (np.ndarray): independent variable, e.g., titrant mass
+        y (np.ndarray): dependent variable, e.g., Gran function F1
+        min_points (int): smallest window that is considered
+        min_r2 (float): r2 a window needs to count as linear
+        above (float): if given, only windows whose fitted line stays above
+            this value at both ends are considered
+
+    Returns:
+        tuple[int, int]: start and stop index of the window
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n < min_points:
+        return (0, n)
+    # centered and scaled to keep the differences of the sums accurate
+    x = (x - np.mean(x)) / (np.std(x) or 1)
+    if above is not None:
+        above = (above - np.mean(y)) / (np.std(y) or 1)
+    y = (y - np.mean(y)) / (np.std(y) or 1)
+    zero = np.zeros(1)
+    Sx, Sy, Sxx, Syy, Sxy = (
+        np.concatenate((zero, np.cumsum(values)))
+        for values in (x, y, x * x, y * y, x * y)
+    )
+    best = (0, n)
+    best_length = 0
+    best_r2 = -np.inf
+    for start in range(n - min_points + 1):
+        stop = np.arange(start + min_points, n + 1)
+        count = stop - start
+        sx = Sx[stop] - Sx[start]
+        sy = Sy[stop] - Sy[start]
+        var_x = Sxx[stop] - Sxx[start] - sx * sx / count
+        var_y = Syy[stop] - Syy[start] - sy * sy / count
+        cov = Sxy[stop] - Sxy[start] - sx * sy / count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r2 = np.nan_to_num(cov * cov / (var_x * var_y), nan=-np.inf)
+            if above is not None:
+                slope = cov / var_x
+                intercept = (sy - slope * sx) / count
+                r2[
+                    ~(
+                        (intercept + slope * x[start] > above)
+                        & (intercept + slope * x[stop - 1] > above)
+                    )
+                ] = -np.inf
+        linear = np.flatnonzero(r2 >= min_r2)
+        if len(linear):
+            # the longest linear window of this start ends furthest out
+            i = linear[-1]
+            if count[i] > best_length or (count[i] == best_length and r2[i] > best_r2):
+                best = (start, int(stop[i]))
+                best_length = count[i]
+                best_r2 = r2[i]
+        elif not best_length:
+            i = np.argmax(r2)
+            if r2[i] > best_r2:
+                best = (start, int(stop[i]))
+                best_r2 = r2[i]
+    return best
+
+
 def k_boltz(T: float):
     return 8.31451 * T / 96484.56
 
@@ -39,33 +205,75 @@ def find_data_in_range(low: float, high: float, data: iter):
     Returns:
         iter: _description_
     """
-    return [i for i, x in enumerate(data) if low <= x <= high]
+    data = np.asarray(data)
+    return np.flatnonzero((low <= data) & (data <= high))
 
 
 def estimate_AT_E0(
-    titrant_mass: np.ndarray, emf: np.ndarray, T: float, m0: float, titrant_conc: float
+    titrant_mass: np.ndarray,
+    emf: np.ndarray,
+    T: float,
+    m0: float,
+    titrant_conc: float,
+    auto_window: bool = False,
 ) -> tuple[float, float]:
-    gran_data = Gran_F1(titrant_mass, emf, T, m0)
+    gran_data = Gran_F1(titrant_mass, emf, T, m0, auto_window)
+    if auto_window:
+        # E0 only from the points the line was fitted to
+        titrant_mass = gran_data.F1_mass
+        emf = emf[gran_data.indices[0] : gran_data.indices[1]]
     mass_eq = -gran_data.intercept / gran_data.slope
     k = k_boltz(T)
     titrant_moles = titrant_conc * (titrant_mass - mass_eq)
     E0_est = np.mean(emf - k * np.log(titrant_moles / (m0 + titrant_mass)))
-    H_est = np.exp((emf - np.mean(E0_est)) / k)
     AT_est = mass_eq * titrant_conc / m0
     return AT_est, E0_est
 
 
 def AT_residuals(x, sample, titration):
-    ST = sample.ST
-    KS = sample.KS
-    FT = sample.FT
-    KF = sample.KF
-    m0 = sample.m0
-    KW = sample.KW
-    CHCl = titration.titrant.concentration
-    m = titration.weight
-    H = 10 ** -(titration.pH_est)
     f, AT = x
+    return _AT_residual(
+        f,
+        AT,
+        10 ** -(titration.pH_est),
+        titration.weight,
+        sample.m0,
+        sample.ST,
+        sample.KS,
+        sample.FT,
+        sample.KF,
+        sample.KW,
+        titration.titrant.concentration,
+    )
+
+
+def AT_jacobian(x, sample, titration):
+    f, AT = x
+    H = 10 ** -(titration.pH_est)
+    m0 = sample.m0
+    dres_df = _AT_residual_df(
+        f,
+        H,
+        titration.weight,
+        m0,
+        sample.ST,
+        sample.KS,
+        sample.FT,
+        sample.KF,
+        sample.KW,
+    )
+
+    # dresidual/dAT is just m0 (scalar)
+    dres_dAT = np.full_like(H, m0)
+
+    # Stack into Jacobian matrix: shape (len(H), 2)
+    J = np.column_stack((dres_df, dres_dAT))
+    return J
+
+
+# the mass balance and its derivative in f, written so that every argument
+# broadcasts, i.e., they work for one titration or a stack of titrations
+def _AT_residual(f, AT, H, m, m0, ST, KS, FT, KF, KW, CHCl):
     Z = 1 + ST / KS
     HSO4 = m0 * ST / (1 + (Z * KS) / (f * H))
     HF = m0 * FT / (1 + KF / (f * H))
@@ -74,16 +282,7 @@ def AT_residuals(x, sample, titration):
     return residual
 
 
-def AT_jacobian(x, sample, titration):
-    ST = sample.ST
-    KS = sample.KS
-    FT = sample.FT
-    KF = sample.KF
-    m0 = sample.m0
-    KW = sample.KW
-    m = titration.weight
-    H = 10 ** -(titration.pH_est)
-    f, AT = x
+def _AT_residual_df(f, H, m, m0, ST, KS, FT, KF, KW):
     Z = 1 + ST / KS
 
     # dHSO4/df
@@ -96,11 +295,358 @@ def AT_jacobian(x, sample, titration):
     dterm_df = (H / Z) + (Z * KW) / (f**2 * H)
 
     # dresidual/df
-    dres_df = dHSO4_df + dHF_df + (m0 + m) * dterm_df
+    return dHSO4_df + dHF_df + (m0 + m) * dterm_df
 
-    # dresidual/dAT is just m0 (scalar)
-    dres_dAT = np.full_like(H, m0)
 
-    # Stack into Jacobian matrix: shape (len(H), 2)
-    J = np.column_stack((dres_df, dres_dAT))
-    return J
+AT_fit = namedtuple("AT_fit", ["f", "AT", "cost", "nfev", "converged"])
+
+
+def fit_AT_batch(
+    problems: list,
+    x0,
+    max_nfev: int = 200,
+    xtol: float = 1e-14,
+    ftol: float = 1e-15,
+) -> AT_fit:
+    """
+    Fits f and AT for many titrations at once. The titrations are padded to
+    the same length and stacked, and every Levenberg-Marquardt step is taken
+    for all samples together: each sample only has two parameters, so its
+    damped normal equations are a 2x2 system that is solved in closed form
+    across the whole batch. Gives the same minimum per sample as
+    least_squares(AT_residuals, jac=AT_jacobian, method="lm")
+
+    Args:
+        problems (list): (sample, titration) pairs, as passed to AT_residuals
+        x0: starting (f, AT) per problem, shape (n, 2)
+        max_nfev (int): maximum number of residual evaluations per sample
+        xtol (float): relative step size at which a sample has converged
+        ftol (float): relative cost reduction at which a sample has converged
+
+    Returns:
+        AT_fit: arrays of f, AT, final cost, evaluations and convergence per sample
+    """
+    n_problems = len(problems)
+    length = max(len(titration.weight) for _, titration in problems)
+    # padded points get H = 1, m = 0 and unit constants to stay finite, and
+    # are masked out
+    H = np.ones((n_problems, length))
+    m = np.zeros((n_problems, length))
+    mask = np.zeros((n_problems, length))
+    # sample constants can be scalars or per point arrays (Solution.at)
+    ST, KS, FT, KF, KW = np.ones((5, n_problems, length))
+    m0 = np.empty((n_problems, 1))
+    CHCl = np.empty((n_problems, 1))
+    for i, (sample, titration) in enumerate(problems):
+        n = len(titration.weight)
+        H[i, :n] = 10 ** -(titration.pH_est)
+        m[i, :n] = titration.weight
+        mask[i, :n] = 1
+        ST[i, :n] = sample.ST
+        KS[i, :n] = sample.KS
+        FT[i, :n] = sample.FT
+        KF[i, :n] = sample.KF
+        KW[i, :n] = sample.KW
+        m0[i] = sample.m0
+        CHCl[i] = titration.titrant.concentration
+
+    return _fit_AT_stacked(
+        H, m, mask, m0, ST, KS, FT, KF, KW, CHCl, x0, max_nfev, xtol, ftol
+    )
+
+
+def _fit_AT_stacked(
+    H, m, mask, m0, ST, KS, FT, KF, KW, CHCl, x0, max_nfev, xtol, ftol
+) -> AT_fit:
+    # Levenberg-Marquardt over stacked titrations of shape (n, points)
+    n_problems = len(H)
+
+    def residuals(f, AT):
+        return _AT_residual(f, AT, H, m, m0, ST, KS, FT, KF, KW, CHCl) * mask
+
+    x = np.array(x0, dtype=np.float64).reshape(n_problems, 2)
+    f, AT = x[:, :1].copy(), x[:, 1:].copy()
+    r = residuals(f, AT)
+    cost = 0.5 * np.sum(r**2, axis=1)
+    nfev = np.ones(n_problems, dtype=int)
+    damping = np.full(n_problems, 1e-3)
+    active = np.ones(n_problems, dtype=bool)
+    converged = np.zeros(n_problems, dtype=bool)
+    # dresidual/dAT is m0 on every real point
+    J_AT = m0 * mask
+    c = np.sum(J_AT**2, axis=1)
+    while active.any():
+        J_f = _AT_residual_df(f, H, m, m0, ST, KS, FT, KF, KW) * mask
+        a = np.sum(J_f**2, axis=1)
+        b = np.sum(J_f * J_AT, axis=1)
+        g_f = np.sum(J_f * r, axis=1)
+        g_AT = np.sum(J_AT * r, axis=1)
+        # Marquardt scaling of the diagonal keeps the step independent of the
+        # very different magnitudes of f and AT
+        a_damped = a * (1 + damping)
+        c_damped = c * (1 + damping)
+        det = a_damped * c_damped - b**2
+        step_f = -(c_damped * g_f - b * g_AT) / det
+        step_AT = -(a_damped * g_AT - b * g_f) / det
+        step_f[~active] = 0
+        step_AT[~active] = 0
+        f_new = f + step_f[:, None]
+        AT_new = AT + step_AT[:, None]
+        r_new = residuals(f_new, AT_new)
+        cost_new = 0.5 * np.sum(r_new**2, axis=1)
+        nfev += active
+        better = active & (cost_new < cost)
+        small_step = (np.abs(step_f) <= xtol * (np.abs(f[:, 0]) + xtol)) & (
+            np.abs(step_AT) <= xtol * (np.abs(AT[:, 0]) + xtol)
+        )
+        small_gain = better & (cost - cost_new <= ftol * cost)
+        f[better] = f_new[better]
+        AT[better] = AT_new[better]
+        r[better] = r_new[better]
+        cost[better] = cost_new[better]
+        damping = np.where(better, damping / 10, damping * 10)
+        done = active & (small_step | small_gain)
+        converged |= done
+        active &= ~done & (nfev < max_nfev) & (damping < 1e20)
+    return AT_fit(f[:, 0], AT[:, 0], cost, nfev, converged)
+
+
+# 1 sigma uncertainties for AT_monte_carlo
+AT_uncertainties = {
+    # relative, titrant concentration
+    "concentration": 1e-4,
+    # relative, burette calibration, i.e., a systematic error of all masses
+    "burette": 1e-4,
+    # V, independent noise of every emf reading
+    "emf": 5e-5,
+    # relative, each of KS, KF and KW
+    "constants": 0.02,
+}
+
+AT_distribution = namedtuple("AT_distribution", ["f", "AT", "E0", "converged"])
+
+
+def AT_monte_carlo(
+    sample,
+    titration,
+    window: slice = None,
+    n_replicates: int = 1000,
+    seed: int = None,
+    uncertainties: dict = None,
+    auto_window: bool = False,
+) -> AT_distribution:
+    """
+    Propagates the uncertainties of the inputs to f, AT and E0 by Monte
+    Carlo. All replicates are drawn at once as stacked (replicate, point)
+    arrays of perturbed titrant concentration, masses, emf and constants, the
+    Gran estimate of every replicate is a masked linear fit over the stack
+    and all replicates are fitted together with the batch Levenberg-Marquardt
+    of fit_AT_batch. The Gran estimate is the one of estimate_AT_E0: with
+    auto_window the line is fitted to all points of the window where F1 of
+    the titration is linear, chosen once from the unperturbed titration,
+    otherwise to the points of window with F1 > 100
+
+    Args:
+        sample: Solution the fit uses, constants can be per point (Solution.at)
+        titration (Titration): full forward titration
+        window (slice): points of the titration used for the Gran estimate,
+            chosen as in Gran_F1 if auto_window
+        n_replicates (int): number of Monte Carlo replicates
+        seed (int): seed of the random generator, for reproducible results
+        uncertainties (dict): overrides of AT_uncertainties
+        auto_window (bool): choose the window by linearity of F1
+
+    Returns:
+        AT_distribution: f, AT, E0 and convergence of every replicate
+    """
+    sigma = {**AT_uncertainties, **(uncertainties or {})}
+    rng = np.random.default_rng(seed)
+    n = len(titration)
+    m0 = sample.m0
+    CHCl = titration.titrant.concentration * (
+        1 + sigma["concentration"] * rng.standard_normal((n_replicates, 1))
+    )
+    m = titration.weight * (
+        1 + sigma["burette"] * rng.standard_normal((n_replicates, 1))
+    )
+    emf_noise = sigma["emf"] * rng.standard_normal((n_replicates, n))
+    emf = titration.emf + emf_noise
+    # pH_est is exp((emf - E0) / k), so the noise scales H directly
+    H = 10 ** -(titration.pH_est) * np.exp(emf_noise / titration.k)
+    KS, KF, KW = (
+        np.asarray(K)
+        * np.exp(sigma["constants"] * rng.standard_normal((n_replicates, 1)))
+        for K in (sample.KS, sample.KF, sample.KW)
+    )
+
+    # Gran estimate of every replicate, as in estimate_AT_E0
+    if auto_window:
+        T = np.mean(titration.T)
+        window = slice(
+            *Gran_F1(titration.weight, titration.emf, T, m0, auto_window).indices
+        )
+    else:
+        T = np.mean(titration.T[window])
+    window_mass = m[:, window]
+    window_emf = emf[:, window]
+    k = k_boltz(T)
+    if auto_window:
+        gran = np.ones(window_emf.shape, dtype=bool)
+    else:
+        gran = m0 * np.exp(window_emf / k) > 100
+    counts = np.sum(gran, axis=1)
+    mean_mass = np.sum(window_mass * gran, axis=1) / counts
+    mean_F1 = np.sum(m0 * np.exp(window_emf / k) * gran, axis=1) / counts
+    dx = (window_mass - mean_mass[:, None]) * gran
+    dy = (m0 * np.exp(window_emf / k) - mean_F1[:, None]) * gran
+    slope = np.sum(dx * dy, axis=1) / np.sum(dx**2, axis=1)
+    mass_eq = (slope * mean_mass - mean_F1) / slope
+    titrant_moles = CHCl * (window_mass - mass_eq[:, None])
+    E0_est = np.mean(
+        window_emf - k * np.log(titrant_moles / (m0 + window_mass)), axis=1
+    )
+    AT_est = mass_eq * CHCl[:, 0] / m0
+
+    fit = _fit_AT_stacked(
+        H,
+        m,
+        np.ones((n_replicates, n)),
+        m0,
+        sample.ST,
+        KS,
+        sample.FT,
+        KF,
+        KW,
+        CHCl,
+        np.column_stack((np.ones(n_replicates), AT_est)),
+        max_nfev=200,
+        xtol=1e-14,
+        ftol=1e-15,
+    )
+    return AT_distribution(fit.f, fit.AT, E0_est - k * np.log(fit.f), fit.converged)
+
+
+AT_solution = namedtuple(
+    "AT_solution",
+    ["x", "fun", "cost", "iterations", "nfev", "njev", "status", "message"],
+)
+
+
+class ATSolver:
+    """
+    Prepared (f, AT) fit of one titration. Everything in the mass balance
+    that does not depend on f or AT (H, Z, m0 + m, the sample constants) is
+    computed once here instead of on every residual and Jacobian call. The
+    fit is a Gauss-Newton iteration in scaled variables (f and AT / AT0, both
+    of order one) whose 2x2 normal equations are solved in closed form.
+    """
+
+    def __init__(self, sample, titration):
+        H = 10 ** -(titration.pH_est)
+        m = titration.weight
+        ST = sample.ST
+        KS = sample.KS
+        KW = sample.KW
+        Z = 1 + ST / KS
+        self.m0 = sample.m0
+        self.n = len(m)
+        self._m0_ST = self.m0 * ST
+        self._m0_FT = self.m0 * sample.FT
+        self._ZKS_H = Z * KS / H
+        self._KF_H = sample.KF / H
+        self._H_Z = H / Z
+        self._ZKW_H = Z * KW / H
+        self._m0_m = self.m0 + m
+        self._acid = m * titration.titrant.concentration
+
+    def residuals(self, f: float, AT: float) -> np.ndarray:
+        HSO4 = self._m0_ST / (1 + self._ZKS_H / f)
+        HF = self._m0_FT / (1 + self._KF_H / f)
+        term = f * self._H_Z - self._ZKW_H / f
+        return self.m0 * AT + HSO4 + HF - self._acid + self._m0_m * term
+
+    def residuals_df(self, f: float) -> np.ndarray:
+        u = self._ZKS_H / f
+        v = self._KF_H / f
+        dHSO4_df = self._m0_ST * u / (f * (1 + u) ** 2)
+        dHF_df = self._m0_FT * v / (f * (1 + v) ** 2)
+        dterm_df = self._H_Z + self._ZKW_H / f**2
+        return dHSO4_df + dHF_df + self._m0_m * dterm_df
+
+    def solve(
+        self,
+        x0,
+        xtol: float = 1e-10,
+        ftol: float = 1e-12,
+        max_iterations: int = 50,
+    ) -> AT_solution:
+        """
+        Gauss-Newton fit from x0, halving the step whenever it would increase
+        the cost
+
+        Args:
+            x0: starting (f, AT)
+            xtol (float): relative step in the scaled variables at which to stop
+            ftol (float): relative cost reduction at which to stop
+            max_iterations (int): maximum number of Gauss-Newton steps
+
+        Returns:
+            AT_solution: x = (f, AT), residuals, cost, iterations and evaluation counts
+        """
+        f, AT = (float(value) for value in x0)
+        AT_scale = abs(AT) or 1e-3
+        # in the scaled variable a = AT / AT_scale, dresidual/da is constant
+        J_a = self.m0 * AT_scale
+        c = self.n * J_a**2
+        r = self.residuals(f, AT)
+        cost = 0.5 * np.dot(r, r)
+        nfev = 1
+        njev = 0
+        status = 0
+        message = "Maximum number of iterations reached."
+        for iteration in range(1, max_iterations + 1):
+            J_f = self.residuals_df(f)
+            njev += 1
+            a = np.dot(J_f, J_f)
+            b = J_a * np.sum(J_f)
+            g_f = np.dot(J_f, r)
+            g_a = J_a * np.sum(r)
+            det = a * c - b**2
+            if not det > 0:
+                status = -1
+                message = "Singular normal equations."
+                break
+            step_f = -(c * g_f - b * g_a) / det
+            step_a = -(a * g_a - b * g_f) / det
+            small_step = abs(step_f) <= xtol * (abs(f) + xtol) and abs(
+                step_a
+            ) <= xtol * (abs(AT / AT_scale) + xtol)
+            # step halving keeps the iteration from overshooting far from the
+            # minimum, close to it the full step is taken as is
+            for _ in range(30):
+                f_new = f + step_f
+                AT_new = AT + step_a * AT_scale
+                r_new = self.residuals(f_new, AT_new)
+                nfev += 1
+                cost_new = 0.5 * np.dot(r_new, r_new)
+                if cost_new <= cost or small_step:
+                    break
+                step_f /= 2
+                step_a /= 2
+            else:
+                status = 2
+                message = "No further reduction of the cost possible."
+                break
+            reduction = cost - cost_new
+            f, AT, r, cost = f_new, AT_new, r_new, cost_new
+            if small_step:
+                status = 3
+                message = "`xtol` termination condition is satisfied."
+                break
+            if reduction <= ftol * cost:
+                status = 2
+                message = "`ftol` termination condition is satisfied."
+                break
+        return AT_solution(
+            np.array([f, AT]), r, cost, iteration, nfev, njev, status, message
+        )
@@ -0,0 +1,57 @@
+# Throughput of fit_AT_batch against one least_squares call per titration
+# Run from the repository root: python -m benchmarks.bench_batch_fit
+import argparse
+import tempfile
+import time
+import numpy as np
+from ax_maths import fit_AT_batch
+from benchmarks.fixtures import write_ax_files
+from tests.reference import fit_one_by_one, prepare_problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n",
+        "--titrations",
+        help="batch sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+    )
+    parser.add_argument(
+        "--files",
+        help="distinct synthetic files, reused to fill the batches",
+        type=int,
+        default=50,
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        files = write_ax_files(folder, args.files)
+        problems, x0 = prepare_problems(files)
+
+    print(
+        f"{'titrations':>10} {'loop (s)':>9} {'batch (s)':>9} {'speedup':>8} "
+        f"{'max |dAT|/AT':>13} {'max |df|':>9}"
+    )
+    for n in args.titrations:
+        batch_problems = [problems[i % len(problems)] for i in range(n)]
+        batch_x0 = x0[np.arange(n) % len(problems)]
+        start = time.perf_counter()
+        x_loop = fit_one_by_one(batch_problems, batch_x0)
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        fit = fit_AT_batch(batch_problems, batch_x0)
+        batch = time.perf_counter() - start
+        print(
+            f"{n:>10} {loop:>9.3f} {batch:>9.3f} {loop / batch:>8.1f} "
+            f"{np.max(np.abs(fit.AT - x_loop[:, 1]) / x_loop[:, 1]):>13.2e} "
+            f"{np.max(np.abs(fit.f - x_loop[:, 0])):>9.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
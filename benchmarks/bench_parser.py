@@ -0,0 +1,52 @@
+# Benchmark of the titration file parser against the previous row-list parser
+# Run from the repository root: python -m benchmarks.bench_parser
+import argparse
+import tempfile
+import timeit
+from extract_data import read_titration_file
+from benchmarks.fixtures import write_ax_file
+from tests.reference import legacy_read_titration_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n",
+        "--points",
+        help="number of points per titration section",
+        type=int,
+        nargs="+",
+        default=[100, 2000, 20000],
+    )
+    parser.add_argument("-r", "--repeat", help="timing repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'points':>8} {'legacy (ms)':>12} {'numpy (ms)':>12} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for points in args.points:
+            filename = write_ax_file(folder, n_fwd=points, n_bwd=points)
+            number = max(1, 20000 // points)
+            legacy = min(
+                timeit.repeat(
+                    lambda: legacy_read_titration_file(filename),
+                    number=number,
+                    repeat=args.repeat,
+                )
+            )
+            numpy = min(
+                timeit.repeat(
+                    lambda: read_titration_file(filename),
+                    number=number,
+                    repeat=args.repeat,
+                )
+            )
+            print(
+                f"{points:>8} {legacy / number * 1e3:>12.3f} "
+                f"{numpy / number * 1e3:>12.3f} {legacy / numpy:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Synthetic titration files in the LabVIEW layout read by extract_data
+# Header row, FWD (HCl) rows, a "BWD" marker row, then BWD (NaOH) rows.
+# Column order follows extract_data.datatypes.
+import math
+import os
+import random
+
+# titrant/burette ids that exist in auxiliary_data/
+HCL_ID = "A21"
+NAOH_ID = "J"
+E0 = 0.41
+KW = 10**-13.3
+BURETTE = (0, 1.006434, -0.000267)
+HCL_DENSITY = (1.02888, -1.069e-4, -4.10e-6)
+NAOH_DENSITY = (1.03121, -1.172e-4, -4e-6)
+HCL_CONC = 0.100179
+NAOH_CONC = 0.068732
+
+
+def _poly(coefficients, x):
+    return sum(c * x**i for i, c in enumerate(coefficients))
+
+
+def _mass(volume, temperature, density):
+    # raw burette volume (mL) to kg, same chain as extract_data
+    return _poly(density, temperature) * _poly(BURETTE, volume) / 1000
+
+
+def _emf(excess_acid, t, rng, noise):
+    # free H+ from H - KW/H = excess acid (mol/kg-soln)
+    H = (excess_acid + math.sqrt(excess_acid**2 + 4 * KW)) / 2
+    k = 8.31451 * (t + 273.15) / 96484.56
+    return E0 + k * math.log(H) + rng.gauss(0, noise)
+
+
+def _row(time, emf, t, weight, volume, t_HCl, t_NaOH):
+    pH = -(emf - E0) / (8.31451 * (t + 273.15) / 96484.56) / math.log(10)
+    return (
+        f"{time},{emf:.6f},{t:.3f},{weight:.4f},{pH:.4f},"
+        f"{volume:.4f},{t_HCl:.3f},{t_NaOH:.3f},{t + 0.5:.3f}\n"
+    )
+
+
+def write_ax_file(
+    folder: str,
+    index: int = 0,
+    n_fwd: int = 60,
+    n_bwd: int = 80,
+    AT: float = 2200e-6,
+    w0: float = 100.0,
+    S: float = 33.5,
+    noise: float = 5e-5,
+    seed: int = None,
+) -> str:
+    """
+    Writes one synthetic AX titration file (HCl forward, NaOH back titration)
+
+    Args:
+        folder (str): where to write the file
+        index (int): used to make the file name unique
+        n_fwd (int): number of forward titration points
+        n_bwd (int): number of back titration points
+        AT (float): alkalinity of the synthetic sample in mol/kg
+        w0 (float): sample weight in g
+        S (float): salinity
+        noise (float): standard deviation of emf noise in V
+        seed (int): random seed, defaults to index
+
+    Returns:
+        str: path of the written file
+    """
+    rng = random.Random(index if seed is None else seed)
+    m0 = w0 / 1000
+    t0 = 20 + rng.uniform(-0.5, 0.5)
+    # most points go in the acid region used for the fit
+    eq_volume = AT * m0 / HCL_CONC * 1000
+    fwd_volumes = [eq_volume * 1.6 * (i + 1) / n_fwd for i in range(n_fwd)]
+    name = os.path.join(folder, f"{20210101 + index % 28:08d} SW{index}-A.csv")
+    lines = [
+        f"{w0:.4f},{S:.3f},{E0:.4f},{t0:.2f},0,{HCL_CONC},"
+        f"{NAOH_ID}-{index},{HCL_ID}-{index}\n"
+    ]
+    HCl_moles = 0
+    m = 0
+    for i, volume in enumerate(fwd_volumes):
+        t = t0 + 0.002 * i
+        m = _mass(volume, t, HCL_DENSITY)
+        HCl_moles = m * HCL_CONC
+        emf = _emf((HCl_moles - AT * m0) / (m0 + m), t, rng, noise)
+        lines.append(_row(f"10:{i // 60:02d}:{i % 60:02d}", emf, t, w0, volume, t, t))
+    lines.append("BWD,,,,,,,,\n")
+    # back titrate the excess acid until alkaline
+    excess = HCl_moles - AT * m0
+    end_volume = 1.3 * excess / NAOH_CONC * 1000
+    for i in range(n_bwd):
+        volume = end_volume * (i + 1) / n_bwd
+        t = t0 + 0.1 + 0.002 * i
+        mNaOH = _mass(volume, t, NAOH_DENSITY)
+        emf = _emf((excess - mNaOH * NAOH_CONC) / (m0 + m + mNaOH), t, rng, noise)
+        lines.append(_row(f"11:{i // 60:02d}:{i % 60:02d}", emf, t, w0, volume, t, t))
+    with open(name, "w") as datafile:
+        datafile.writelines(lines)
+    return name
+
+
+def write_ax_files(folder: str, n_files: int, **kwargs) -> list[str]:
+    os.makedirs(folder, exist_ok=True)
+    return [write_ax_file(folder, i, **kwargs) for i in range(n_files)]
+
+
+def write_calibration_files(
+    folder: str,
+    batch: int = 0,
+    n_files: int = 5,
+    n_bwd: int = 80,
+    w0: float = 50.0,
+    aliquot: float = 5.0,
+    noise: float = 5e-5,
+) -> list[str]:
+    """
+    Writes one batch of synthetic NaOH calibration files: HCl aliquots added
+    one after the other to a NaCl solution, each back titrated with NaOH
+
+    Args:
+        folder (str): where to write the files
+        batch (int): batch number, makes the batch id unique
+        n_files (int): number of titrations in the batch
+        n_bwd (int): number of NaOH titration points per file
+        w0 (float): initial NaCl weight in g
+        aliquot (float): HCl aliquot weight in g
+        noise (float): standard deviation of emf noise in V
+
+    Returns:
+        list: paths of the written files, in titration order
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(batch)
+    t0 = 20 + rng.uniform(-0.5, 0.5)
+    mass = w0 / 1000
+    # excess NaOH left from the previous titration
+    excess_base = 0
+    files = list()
+    for n in range(n_files):
+        name = os.path.join(
+            folder, f"{20210601 + batch % 28:08d} NaCl-{batch}-{chr(65 + n)}.csv"
+        )
+        lines = [
+            f"{w0:.4f},0.7,{E0:.4f},{t0:.2f},0,{HCL_CONC},"
+            f"{NAOH_ID}-{batch},{HCL_ID}-{batch}\n",
+            _row("09:00:00", E0, t0, aliquot, 0, t0, t0),
+            "BWD,,,,,,,,\n",
+        ]
+        mass += aliquot / 1000
+        acid = aliquot / 1000 * HCL_CONC - excess_base
+        end_volume = 1.3 * acid / NAOH_CONC * 1000
+        for i in range(n_bwd):
+            volume = end_volume * (i + 1) / n_bwd
+            t = t0 + 0.002 * i
+            mNaOH = _mass(volume, t, NAOH_DENSITY)
+            emf = _emf((acid - mNaOH * NAOH_CONC) / (mass + mNaOH), t, rng, noise)
+            lines.append(
+                _row(
+                    f"09:{1 + i // 60:02d}:{i % 60:02d}", emf, t, aliquot, volume, t, t
+                )
+            )
+        mass += mNaOH
+        excess_base = mNaOH * NAOH_CONC - acid
+        with open(name, "w") as datafile:
+            datafile.writelines(lines)
+        files.append(name)
+    return files
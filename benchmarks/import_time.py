@@ -0,0 +1,91 @@
+# Start up time of the command line tools against a fixed budget
+# Run from the repository root: python -m benchmarks.import_time
+# Every command runs in a fresh interpreter, the best of --repeat runs is
+# compared to its budget, and the exit code is 1 if any is over budget or
+# if one of the heavy optional packages is imported where it is not needed.
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.fixtures import write_ax_file
+
+# (label, python arguments, budget in ms); measured at about 14, 40, 145,
+# 150 and 200 ms on the development machine, where importing titrate_ax took
+# 820 ms while it pulled in scipy.stats and gsw at import time
+budgets = [
+    ("python -c pass", ["-c", "pass"], 50),
+    ("cli.py --help", ["cli.py", "--help"], 100),
+    ("import calibrate_NaOH", ["-c", "import calibrate_NaOH"], 300),
+    ("import titrate_ax", ["-c", "import titrate_ax"], 300),
+    ("cli.py titrate (1 file)", ["cli.py", "titrate", "-p", "{file}"], 600),
+]
+
+# packages that may only be imported on the code paths that use them
+lazy_modules = ["scipy", "pandas", "gsw"]
+
+
+def best_time(arguments: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *arguments],
+            capture_output=True,
+            check=True,
+        )
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def eager_imports(module: str) -> list:
+    code = (
+        f"import sys, {module}; "
+        f"print(' '.join(name for name in {lazy_modules!r} if name in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return output.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-r", "--repeat", help="runs per command", type=int, default=5)
+    parser.add_argument(
+        "--scale",
+        help="factor applied to all budgets, e.g., for slower machines",
+        type=float,
+        default=1.0,
+    )
+    args = parser.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as folder:
+        file = write_ax_file(folder)
+        print(f"{'command':<26} {'time (ms)':>10} {'budget (ms)':>12}")
+        for label, arguments, budget in budgets:
+            arguments = [argument.format(file=file) for argument in arguments]
+            milliseconds = best_time(arguments, args.repeat) * 1e3
+            over = milliseconds > budget * args.scale
+            ok &= not over
+            print(
+                f"{label:<26} {milliseconds:>10.1f} {budget * args.scale:>12.0f}"
+                + ("  OVER BUDGET" if over else "")
+            )
+    for module in ("cli", "titrate_ax", "calibrate_NaOH"):
+        eager = eager_imports(module)
+        if eager:
+            ok = False
+            print(f"import {module} also imports {', '.join(eager)}")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # the commands above are run relative to the repository root
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main()
@@ -0,0 +1,251 @@
+# End-to-end benchmark of the AX pipeline on synthetic titration files
+# Run from the repository root:
+#   python -m benchmarks.run_benchmarks -o bench.json
+#   python -m benchmarks.run_benchmarks --compare bench.json
+#   python -m benchmarks.run_benchmarks --sizes 1 1000 50000 -o bench_large.json
+# The default sizes take seconds. With the memory pass 1000 files take about
+# half a minute and 50k files the better part of an hour, so large batches are
+# only run when asked for.
+# Every stage is timed separately over all files of a batch, the peak memory
+# of the batch is traced in a second pass, and the results are written as json
+# so that two versions can be compared.
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import partial
+import numpy as np
+from scipy.optimize import least_squares
+import calibrate_NaOH
+import titrate_ax
+from ax_maths import AT_jacobian, AT_residuals, ATSolver, estimate_AT_E0
+from calibrate_NaOH import CalibrateNaOH
+from extract_data import (
+    correct_burette_volume,
+    read_titration_file,
+    titration_data,
+    v_to_w,
+    volumes_to_weights,
+)
+from titrate_ax import TitrateAX
+from benchmarks.fixtures import write_ax_files, write_calibration_files
+
+# files per calibration batch
+calibration_batch = 5
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    @contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+
+
+def run_ax_stages(files: list, timer: StageTimer, titrate: TitrateAX):
+    # (volume, temperature, titrant, lot) of all files, for the batch stage
+    sections = list()
+    for file in files:
+        with timer("parse"):
+            sample_info, fwd_data, bwd_data = read_titration_file(file)
+        with timer("volume_to_mass"):
+            for data, titrant, column, id in (
+                (fwd_data, "HCl", "t_HCl", sample_info[7]),
+                (bwd_data, "NaOH", "t_NaOH", sample_info[6]),
+            ):
+                sections.append((data["volume"], data[column], titrant, id))
+                v_to_w(
+                    correct_burette_volume("dosimat 12", data["volume"]),
+                    data[column],
+                    titrant,
+                    id.split("-")[0],
+                )
+        # objects for the later stages, not timed since it repeats the above
+        sample, HCl_titration_data, _ = titration_data(file)
+        with timer("gran"):
+            window = HCl_titration_data.window(3, 3.5)
+            AT_est, _ = estimate_AT_E0(
+                window.weight,
+                window.emf,
+                np.mean(window.T),
+                sample.m0,
+                HCl_titration_data.titrant.concentration,
+            )
+        fit_sample = sample.at(T=HCl_titration_data.T)
+        with timer("solve_gn"):
+            ATSolver(fit_sample, HCl_titration_data).solve([1, AT_est])
+        with timer("solve_lm"):
+            least_squares(
+                fun=partial(
+                    AT_residuals, sample=fit_sample, titration=HCl_titration_data
+                ),
+                x0=[1, AT_est],
+                jac=partial(
+                    AT_jacobian, sample=fit_sample, titration=HCl_titration_data
+                ),
+                method="lm",
+            )
+        with timer("process_titration"):
+            titrate.process_titration(file)
+    with timer("volume_to_mass_batch"):
+        volumes_to_weights("dosimat 12", sections)
+
+
+def run_calibration_stages(batches: list, timer: StageTimer):
+    for batch_id, folder in batches:
+        with timer("calibration_chain"):
+            CalibrateNaOH(folder, batch_id, file_extension="csv").calibrate()
+
+
+def run_batch(files: list, batches: list, titrate: TitrateAX) -> StageTimer:
+    timer = StageTimer()
+    run_ax_stages(files, timer, titrate)
+    run_calibration_stages(batches, timer)
+    return timer
+
+
+def benchmark(n_files: int, folder: str, memory: bool) -> dict:
+    files = write_ax_files(f"{folder}/ax_{n_files}", n_files)
+    batches = list()
+    for batch in range(max(1, n_files // calibration_batch)):
+        calibration_folder = f"{folder}/cal_{n_files}"
+        write_calibration_files(calibration_folder, batch, calibration_batch)
+        batches.append((f"NaCl-{batch}-", calibration_folder))
+    titrate = TitrateAX(files[0])
+
+    timer = run_batch(files, batches, titrate)
+    result = {
+        "files": n_files,
+        "calibration_batches": len(batches),
+        "stages": {
+            stage: {
+                "seconds": seconds,
+                "calls": timer.calls[stage],
+                "ms_per_call": seconds / timer.calls[stage] * 1e3,
+            }
+            for stage, seconds in timer.seconds.items()
+        },
+    }
+    if memory:
+        # separate pass, tracing allocations slows everything down
+        tracemalloc.start()
+        run_batch(files, batches, titrate)
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Prints the per call time of every stage relative to a previous report
+
+    Returns:
+        bool: True if no stage is slower than tolerance times the baseline
+    """
+    ok = True
+    previous = {run["files"]: run for run in baseline["runs"]}
+    print(
+        f"{'files':>7} {'stage':<18} {'before (ms)':>12} {'now (ms)':>10} {'ratio':>6}"
+    )
+    for run in report["runs"]:
+        if run["files"] not in previous:
+            continue
+        for stage, timing in run["stages"].items():
+            before = previous[run["files"]]["stages"].get(stage)
+            if not before:
+                continue
+            ratio = timing["ms_per_call"] / before["ms_per_call"]
+            regression = ratio > tolerance
+            ok &= not regression
+            print(
+                f"{run['files']:>7} {stage:<18} {before['ms_per_call']:>12.3f} "
+                f"{timing['ms_per_call']:>10.3f} {ratio:>6.2f}"
+                + ("  REGRESSION" if regression else "")
+            )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        help="number of titration files per run",
+        type=int,
+        nargs="+",
+        default=[1, 100],
+    )
+    parser.add_argument("-o", "--output", help="json file for the results")
+    parser.add_argument(
+        "--compare", help="json file of a previous run to check for regressions"
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="slowdown factor of a stage that counts as a regression",
+        type=float,
+        default=1.2,
+    )
+    parser.add_argument(
+        "--no_memory", help="skip the peak memory pass", action="store_true"
+    )
+    args = parser.parse_args()
+
+    # the pipeline logs every file, which would dominate the timings
+    for module in (titrate_ax, calibrate_NaOH):
+        module.logger.setLevel(logging.WARNING)
+    logging.getLogger("extract_data").setLevel(logging.WARNING)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "runs": list(),
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        for n_files in args.sizes:
+            run = benchmark(n_files, folder, not args.no_memory)
+            report["runs"].append(run)
+            print(json.dumps(run), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as previous:
+            if not compare(report, json.load(previous), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,51 @@
-import argparse
 from exceptions import CalibrationDataMissing
 import os, sys
+import re
 from util import *
 from extract_data import NaOH_calibration_data
 import logging
 from solutions import *
-import math
 import numpy as np
-from scipy.stats import linregress
 from ax_maths import Gran_F1
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from auxiliary import registry
+import profiling
 
+# handlers are set up by the command line entry point (cli.py)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.DEBUG)
 
-# Create a formatter
-formatter = logging.Formatter("%(levelname)s - %(message)s")
 
-# Set the formatter for the stream handler
-stream_handler.setFormatter(formatter)
-
-# Add the stream handler to the logger
-logger.addHandler(stream_handler)
+CalibrationResult = namedtuple(
+    "CalibrationResult",
+    [
+        "titration_id",
+        "titrant_id",
+        "files",
+        "concentration",
+        "std_percent",
+        "E0",
+        "flag",
+    ],
+)
 
 
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+def _init_worker():
+    # load the auxiliary tables once per worker instead of once per file
+    registry.warm()
 
-parser.add_argument(
-    "-p",
-    "--path",
-    help="path to NaOH calibration data files",
-    default=argparse.SUPPRESS,
-)
-parser.add_argument(
-    "-id",
-    "--titration_id",
-    help="batch identifier that will uniquely identify all files that are used to calculate avg cNaOH",
-    default=argparse.SUPPRESS,
-)
-parser.add_argument(
-    "-ext",
-    "--file_extension",
-    help="optional file extension if not using csv",
-    default="csv",
-)
-parser.add_argument(
-    "-hcl",
-    "--hcl_concentration",
-    help="optional HCl concentration, if e.g., incorrect information was entered during calibration (or missing). Will be treated as mol/kg-sol",
-)
 
-args = parser.parse_args()
+def _read_calibration_file(
+    file: str, sample: Solution, titrant: Solution
+) -> tuple[str, Solution, Titration, dict]:
+    # runs in a worker process, so the flag set on the copy of the sample and
+    # the profiling records have to be sent back with the data
+    with profiling.stage("read", file):
+        _, sample, HCl_aliquot, titration_data = NaOH_calibration_data(
+            file, sample=sample, titrant=titrant
+        )
+    return sample.flag, HCl_aliquot, titration_data, profiling.pop(file)
 
 
 class CalibrateNaOH:
@@ -61,6 +55,8 @@ class CalibrateNaOH:
         titration_id: str,
         hcl_concentration: float = None,
         file_extension: str = None,
+        auto_window: bool = False,
+        workers: int = 1,
     ):
         logger.info("Let's get calibrating!\n\n")
         # initialize
@@ -68,23 +64,24 @@ class CalibrateNaOH:
         self.titration_id = titration_id
         self.hcl_concentration = hcl_concentration
         self.file_extension = file_extension
+        self.auto_window = auto_window
+        self.workers = workers
 
     def calibrate(self):
         e0 = []
         NaOH_concentration = []
         # will raise exception if invalid inputs
         calibration_files = self._process_inputs()
-        # process first titration
-        HCl_neutr_weight, E0_est, NaOH_conc_est = self.process_titration(
-            calibration_files[0], first=True
-        )
-        e0.append(E0_est)
-        NaOH_concentration.append(NaOH_conc_est)
-        # process remaining titrations
-        for file in calibration_files[1:]:
-            HCl_neutr_weight, E0_est, NaOH_conc_est = self.process_titration(
-                file, HCl_neutr_weight
-            )
+        # reading the files does not depend on the previous titration, only
+        # the reduction below carries HCl_neutr_weight and sample.w0 forward
+        parsed = self.read_files(calibration_files)
+        HCl_neutr_weight = 0
+        for file, (HCl_aliquot, titration_data) in zip(calibration_files, parsed):
+            logger.debug(f"Processing file: {file}")
+            with profiling.stage("reduce", file):
+                HCl_neutr_weight, E0_est, NaOH_conc_est = self.reduce_titration(
+                    HCl_aliquot, titration_data, HCl_neutr_weight
+                )
             e0.append(E0_est)
             NaOH_concentration.append(NaOH_conc_est)
         # disregard first titration
@@ -95,9 +92,66 @@ class CalibrateNaOH:
               The mean NaOH concentration estimated from this titration is:\n
               {NaOH_conc_mean:.5g} mol/kg-sol, with a standard deviation of
               +/-{NaOH_conc_std_percent:.2g} %.
-              Update the value in the NaOH_summary file manually if needed."""
+              Use --update_summary to store it in the NaOH_summary file."""
+        )
+        return CalibrationResult(
+            self.titration_id,
+            self.titrant.id,
+            len(calibration_files),
+            float(NaOH_conc_mean),
+            float(NaOH_conc_std_percent),
+            float(np.mean(e0[1:])),
+            self.sample.flag,
         )
 
+    def read_files(self, calibration_files: list) -> list[tuple[Solution, Titration]]:
+        """
+        Method to read all files of a calibration batch, including the volume
+        to mass conversion, before any of them is reduced. The first file sets
+        up the sample and titrant and is read on its own, the rest are spread
+        over worker processes if there is more than one
+
+        Args:
+            calibration_files (list): files of the batch, in titration order
+
+        Returns:
+            list: HCl aliquot and titration data of every file, in order
+        """
+        with profiling.stage("read", calibration_files[0]):
+            self.titrant, self.sample, HCl_aliquot, titration_data = (
+                NaOH_calibration_data(calibration_files[0])
+            )
+        parsed = [(HCl_aliquot, titration_data)]
+        rest = calibration_files[1:]
+        if self.workers > 1 and len(rest) > 1:
+            with ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker
+            ) as executor:
+                results = list(
+                    executor.map(
+                        _read_calibration_file,
+                        rest,
+                        [self.sample] * len(rest),
+                        [self.titrant] * len(rest),
+                    )
+                )
+            # reading a file can only ever flag the sample as questionable
+            for file, (flag, HCl_aliquot, titration_data, profile) in zip(
+                rest, results
+            ):
+                if flag == "Q":
+                    self.sample.flag = "Q"
+                profiling.merge(file, profile)
+                parsed.append((HCl_aliquot, titration_data))
+        else:
+            for file in rest:
+                with profiling.stage("read", file):
+                    _, _, HCl_aliquot, titration_data = NaOH_calibration_data(
+                        file, sample=self.sample, titrant=self.titrant
+                    )
+                parsed.append((HCl_aliquot, titration_data))
+        return parsed
+
     def process_titration(
         self, titration_file, HCl_neutr_weight: float = 0, first=False
     ):
@@ -112,10 +166,36 @@ class CalibrateNaOH:
             _, _, HCl_aliquot, titration_data = NaOH_calibration_data(
                 titration_file, sample=self.sample, titrant=self.titrant
             )
+        return self.reduce_titration(HCl_aliquot, titration_data, HCl_neutr_weight)
+
+    def reduce_titration(
+        self,
+        HCl_aliquot: Solution,
+        titration_data: Titration,
+        HCl_neutr_weight: float = 0,
+    ) -> tuple[float, float, float]:
+        """
+        Method to get the NaOH concentration and E0 of one read calibration
+        titration and the state for the next one: the HCl neutralized by the
+        NaOH left over, and the sample weight (self.sample.w0)
+
+        Args:
+            HCl_aliquot (Solution): HCl aliquot added before the titration
+            titration_data (Titration): NaOH titration
+            HCl_neutr_weight (float): HCl neutralized by the previous titration
+
+        Returns:
+            tuple: HCl_neutr_weight for the next titration, E0, NaOH concentration
+        """
         w0_gran = self.sample.w0 + HCl_aliquot.weight
-        gran_data = Gran_F1(
-            titration_data.weight, titration_data.emf, self.sample.T, w0_gran
-        )
+        with profiling.stage("gran"):
+            gran_data = Gran_F1(
+                titration_data.weight,
+                titration_data.emf,
+                self.sample.T,
+                w0_gran,
+                self.auto_window,
+            )
 
         equivalence_weight = -gran_data.slope / gran_data.intercept
         NaOH_conc_est = (
@@ -181,10 +261,104 @@ class CalibrateNaOH:
             return calibration_files
 
 
-try:
-    calibration = CalibrateNaOH(**vars(args))
-except TypeError as e:
-    logger.critical(f"Error in command line inputs: {e}")
-    sys.exit(1)
+def find_calibration_batches(path: str, file_extension: str = "csv") -> list[str]:
+    """
+    Method to find all calibration batches in a folder. The files of a batch
+    only differ in the letter before the extension, e.g., batch
+    "20210611 NaCl-38-" has "20210611 NaCl-38-A.csv", "20210611 NaCl-38-B.csv"
+
+    Args:
+        path (str): folder with calibration files
+        file_extension (str): extension of the calibration files
+
+    Returns:
+        list: batch identifiers, usable as titration_id, sorted by name
+    """
+    pattern = re.compile(rf"(.+-)[A-Za-z]\.{re.escape(file_extension)}$")
+    batches = dict()
+    for file in get_matching_files(path, "", file_extension):
+        match = pattern.match(os.path.basename(file))
+        if match:
+            batches.setdefault(match.group(1))
+    return list(batches)
+
+
+def _calibrate_batch(
+    path: str, titration_id: str, options: dict
+) -> tuple[CalibrationResult, dict]:
+    result = CalibrateNaOH(path, titration_id, **options).calibrate()
+    return result, profiling.pop_all()
+
+
+def calibrate_all(
+    path: str, file_extension: str = "csv", workers: int = 1, **options
+) -> list[CalibrationResult]:
+    """
+    Method to calibrate every batch in a folder, spread over worker processes.
+    A batch that fails is logged and left out, the others still finish
+
+    Args:
+        path (str): folder with calibration files
+        file_extension (str): extension of the calibration files
+        workers (int): number of batches calibrated at the same time
+        **options: passed on to CalibrateNaOH, e.g., auto_window
+
+    Returns:
+        list: CalibrationResult of every batch that could be calibrated
+    """
+    batches = find_calibration_batches(path, file_extension)
+    if not batches:
+        raise CalibrationDataMissing(f"No calibration batches in {path}")
+    logger.info(f"Calibrating {len(batches)} batches: {', '.join(batches)}")
+    options = {**options, "file_extension": file_extension}
+    results = list()
+    with ProcessPoolExecutor(
+        max_workers=max(1, workers), initializer=_init_worker
+    ) as executor:
+        futures = [
+            executor.submit(_calibrate_batch, path, batch, options) for batch in batches
+        ]
+        for batch, future in zip(batches, futures):
+            try:
+                result, profiles = future.result()
+            except Exception as e:
+                logger.error(f"Failed to calibrate batch {batch}: {e!r}")
+                continue
+            results.append(result)
+            for file, profile in (profiles or {}).items():
+                profiling.merge(file, profile)
+    return results
+
+
+def update_NaOH_summary(results: list[CalibrationResult]):
+    """
+    Method to store calibrated NaOH concentrations in the NaOH_summary table,
+    every change replaces the file in one step, so titrations processed at
+    the same time never read a partly written table. Questionable (flagged) or
+    invalid results are not stored. If several batches calibrated the same
+    NaOH, the last one in the list is kept; all of them are in the history
+
+    Args:
+        results (list): results of CalibrateNaOH.calibrate
+    """
+    for result in results:
+        if result.flag == "Q" or not np.isfinite(result.concentration):
+            logger.warning(
+                f"Not storing the result of {result.titration_id} for NaOH {result.titrant_id}, it is flagged or invalid"
+            )
+            continue
+        # one replace per result keeps the source of every change in the history
+        registry.update(
+            "NaOH_summary",
+            {result.titrant_id: {"c": f"{result.concentration:.6g}"}},
+            source=result.titration_id,
+        )
+        logger.info(
+            f"NaOH {result.titrant_id}: c = {result.concentration:.6g} mol/kg-sol from {result.titration_id}"
+        )
+
+
+if __name__ == "__main__":
+    from cli import main
 
-calibration.calibrate()
+    sys.exit(main(["calibrate", *sys.argv[1:]]))
@@ -0,0 +1,365 @@
+## Command line entry point for AX processing
+#   python cli.py titrate -p <file or folder> [options]
+#   python cli.py calibrate -p <folder> (-id <batch> | --all) [options]
+#   python cli.py serve [--port PORT] [options]
+#   python cli.py reprocess -o <results file> [--changed] [options]
+#   python cli.py archive -p <file or folder> -a <archive folder>
+# Only argparse and logging are imported up front; the processing modules
+# (and numpy with them) are imported by the chosen subcommand, so --help and
+# input errors return right away.
+import argparse
+import logging
+import os
+import sys
+import profiling
+
+logger = logging.getLogger(__name__)
+
+
+def add_fit_arguments(parser: argparse.ArgumentParser):
+    # processing options shared by titrate and serve
+    parser.add_argument(
+        "-o",
+        "--results",
+        help="csv file that results are appended to; titrate skips files that already have a result for the same content and parameters",
+        default=None,
+    )
+    parser.add_argument(
+        "--solver",
+        help="gn: prepared Gauss-Newton fit (ax_maths.ATSolver), lm: scipy least_squares",
+        choices=["gn", "lm"],
+        default="gn",
+    )
+    parser.add_argument(
+        "--mean_temperature",
+        help="evaluate the constants once at the mean temperature of the titration instead of at every titration point",
+        dest="point_temperature",
+        action="store_false",
+    )
+    parser.add_argument(
+        "--auto_window",
+        help="choose the points for the Gran estimate by linearity of F1 instead of the pH range",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--replicates",
+        help="number of Monte Carlo replicates for the uncertainty of f, AT and E0, 0 to skip",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--seed",
+        help="random seed of the Monte Carlo replicates",
+        type=int,
+        default=None,
+    )
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        help="time every processing stage and print a summary at the end, same as AX_PROFILE=1",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile_json",
+        help="also append the timings per file and stage as json lines to this file",
+        default=None,
+    )
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cache",
+        help="folder for parsed titration files, reused while a file is unchanged, same as AX_CACHE=<folder>",
+        default=None,
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="cli.py",
+        description="Process AX titrations and NaOH calibrations",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    titrate = commands.add_parser(
+        "titrate",
+        help="fit AT, f and E0 of one titration file or a folder of them",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    titrate.add_argument(
+        "-p",
+        "--path",
+        help="path to one file or all files in a folder",
+        default=argparse.SUPPRESS,
+    )
+    titrate.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes to spread a folder of titrations over",
+        type=int,
+        default=1,
+    )
+    add_fit_arguments(titrate)
+    add_profile_arguments(titrate)
+    add_cache_arguments(titrate)
+    titrate.add_argument(
+        "--solver_stats",
+        help="print evaluations, cost, termination and time of the fits of the batch, with histograms",
+        action="store_true",
+    )
+    titrate.add_argument(
+        "--solver_stats_csv",
+        help="also write the solver telemetry of every fit to this csv file",
+        default=None,
+    )
+    titrate.add_argument(
+        "--watch",
+        help="keep watching the folder and process each new or changed file once it is complete",
+        action="store_true",
+    )
+    titrate.add_argument(
+        "--settle_time",
+        help="seconds a file has to stay unchanged before it counts as complete in watch mode, well above the ~15 s between points",
+        type=float,
+        default=60.0,
+    )
+
+    serve = commands.add_parser(
+        "serve",
+        help="keep the processing loaded and serve titration requests over localhost http",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    serve.add_argument(
+        "--host",
+        help="interface to listen on, keep it local unless the network is trusted",
+        default="127.0.0.1",
+    )
+    serve.add_argument("--port", help="port to listen on", type=int, default=8765)
+    add_fit_arguments(serve)
+    add_profile_arguments(serve)
+
+    reprocess = commands.add_parser(
+        "reprocess",
+        help="process the files of a results file again, e.g., after the auxiliary tables changed",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    reprocess.add_argument(
+        "--changed",
+        help="only files whose last result used auxiliary rows that have changed since",
+        action="store_true",
+    )
+    reprocess.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes to spread the titrations over",
+        type=int,
+        default=1,
+    )
+    add_fit_arguments(reprocess)
+    add_profile_arguments(reprocess)
+    add_cache_arguments(reprocess)
+
+    archive = commands.add_parser(
+        "archive",
+        help="add titration files to an archive of all curves, see archive.py",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    archive.add_argument(
+        "-p",
+        "--path",
+        help="path to one file or all files in a folder",
+        required=True,
+    )
+    archive.add_argument(
+        "-a",
+        "--archive",
+        help="archive folder, created if missing; files already in it are skipped",
+        required=True,
+    )
+    add_profile_arguments(archive)
+    add_cache_arguments(archive)
+
+    calibrate = commands.add_parser(
+        "calibrate",
+        help="estimate the NaOH concentration from a batch of calibration titrations",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    calibrate.add_argument(
+        "-p",
+        "--path",
+        help="path to NaOH calibration data files",
+        default=argparse.SUPPRESS,
+    )
+    batch = calibrate.add_mutually_exclusive_group()
+    batch.add_argument(
+        "-id",
+        "--titration_id",
+        help="batch identifier that will uniquely identify all files that are used to calculate avg cNaOH",
+        default=argparse.SUPPRESS,
+    )
+    batch.add_argument(
+        "--all",
+        help="calibrate every batch in the folder, in parallel with --workers",
+        dest="all_batches",
+        action="store_true",
+    )
+    calibrate.add_argument(
+        "-ext",
+        "--file_extension",
+        help="optional file extension if not using csv",
+        default="csv",
+    )
+    calibrate.add_argument(
+        "-hcl",
+        "--hcl_concentration",
+        help="optional HCl concentration, if e.g., incorrect information was entered during calibration (or missing). Will be treated as mol/kg-sol",
+    )
+    calibrate.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes to read the calibration files with, or to calibrate batches with --all",
+        type=int,
+        default=1,
+    )
+    calibrate.add_argument(
+        "--auto_window",
+        help="fit the Gran function where it is linear instead of above the fixed F1 cutoff",
+        action="store_true",
+    )
+    calibrate.add_argument(
+        "--update_summary",
+        help="store the new concentrations in the NaOH_summary table, old values go to auxiliary_data/history",
+        action="store_true",
+    )
+    add_profile_arguments(calibrate)
+    add_cache_arguments(calibrate)
+    return parser
+
+
+def configure_logging():
+    # the same output the scripts used to set up when they were imported
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.DEBUG)
+    stream_handler.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
+    for name in (__name__, "titrate_ax", "calibrate_NaOH", "server", "archive"):
+        logging.getLogger(name).addHandler(stream_handler)
+        logging.getLogger(name).setLevel(logging.DEBUG)
+
+
+def titrate(args: dict) -> int:
+    from titrate_ax import TitrateAX
+
+    watch = args.pop("watch")
+    settle_time = args.pop("settle_time")
+    if "path" not in args:
+        logger.critical("Error in command line inputs: no path (-p) was given")
+        return 1
+    try:
+        titration = TitrateAX(**args)
+    except TypeError as e:
+        logger.critical(f"Error in command line inputs: {e}")
+        return 1
+
+    if watch:
+        titration.watch(settle_time)
+    else:
+        titration.titrate()
+    return 0
+
+
+def serve(args: dict) -> int:
+    import server
+    from titrate_ax import TitrateAX
+
+    host = args.pop("host")
+    port = args.pop("port")
+    results = args.pop("results")
+    server.serve(TitrateAX(**args), host, port, results)
+    return 0
+
+
+def reprocess(args: dict) -> int:
+    from titrate_ax import TitrateAX
+
+    changed = args.pop("changed")
+    if not args.get("results"):
+        logger.critical("Error in command line inputs: no results file (-o) was given")
+        return 1
+    TitrateAX(**args).reprocess(changed)
+    return 0
+
+
+def archive(args: dict) -> int:
+    from archive import TitrationArchive
+    from util import get_matching_files
+
+    path = args["path"]
+    if os.path.isdir(path):
+        files = get_matching_files(path, "", "csv")
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        logger.critical(f"Error in command line inputs: no file or folder {path}")
+        return 1
+    TitrationArchive(args["archive"]).add(files)
+    return 0
+
+
+def calibrate(args: dict) -> int:
+    from calibrate_NaOH import CalibrateNaOH, calibrate_all, update_NaOH_summary
+
+    update_summary = args.pop("update_summary")
+    if args.pop("all_batches"):
+        if "path" not in args:
+            logger.critical("Error in command line inputs: no path (-p) was given")
+            return 1
+        results = calibrate_all(**args)
+    else:
+        try:
+            calibration = CalibrateNaOH(**args)
+        except TypeError as e:
+            logger.critical(f"Error in command line inputs: {e}")
+            return 1
+        results = [calibration.calibrate()]
+
+    if update_summary:
+        update_NaOH_summary(results)
+    return 0
+
+
+commands = {
+    "titrate": titrate,
+    "serve": serve,
+    "reprocess": reprocess,
+    "archive": archive,
+    "calibrate": calibrate,
+}
+
+
+def main(argv: list = None) -> int:
+    args = vars(build_parser().parse_args(argv))
+    configure_logging()
+    profile_json = args.pop("profile_json")
+    if args.pop("profile") or profile_json:
+        # through the environment, so that worker processes profile as well
+        os.environ["AX_PROFILE"] = "1"
+        if profile_json:
+            os.environ["AX_PROFILE_JSON"] = profile_json
+        profiling.enable(profile_json)
+    cache = args.pop("cache", None)
+    if cache:
+        import parse_cache
+
+        os.environ["AX_CACHE"] = cache
+        parse_cache.enable(cache)
+    try:
+        return commands[args.pop("command")](args)
+    finally:
+        profiling.report()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
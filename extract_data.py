@@ -11,11 +11,12 @@ import re
 import os
 from exceptions import *
 from typing import Union
-import pandas as pd
 import logging
 from solutions import *
-import statistics
-from util import get_matching_files
+import numpy as np
+from auxiliary import registry
+import profiling
+import parse_cache
 
 logger = logging.getLogger(__name__)
 
@@ -33,12 +34,59 @@ datatypes = {
     "t_air": float,
 }
 
+# structured row type of the FWD/BWD sections, same columns and order as datatypes
+titration_dtype = np.dtype(
+    [
+        (key, "U32" if datatype is str else np.float64)
+        for key, datatype in datatypes.items()
+    ]
+)
+
+
+def read_titration_file(filename: str) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Reads a titration file into its header row and the FWD and BWD sections,
+    each section parsed straight into a structured array of titration_dtype
+
+    Args:
+        filename (str): titration file
+
+    Returns:
+        tuple: header row, FWD data, BWD data (empty arrays if no data)
+    """
+    with open(filename, "r") as datafile:
+        lines = datafile.read().splitlines()
+    sample_info = next(csv.reader(lines[:1]))
+    # the BWD marker row splits the two sections
+    bwd_start = len(lines)
+    for i, line in enumerate(lines[1:], start=1):
+        if "BWD" in line and "BWD" in next(csv.reader([line])):
+            bwd_start = i
+            break
+    fwd_data = _read_section(lines[1:bwd_start])
+    bwd_data = _read_section(lines[bwd_start + 1 :])
+    return sample_info, fwd_data, bwd_data
+
+
+def _read_section(lines: list[str]) -> np.ndarray:
+    if not any(lines):
+        return np.empty(0, dtype=titration_dtype)
+    return np.loadtxt(
+        lines,
+        delimiter=",",
+        dtype=titration_dtype,
+        usecols=range(len(datatypes)),
+        ndmin=1,
+    )
+
 
 # TODO make a class that has all these methods in the generic form,
 # Then child classes that have extra specific methods
 # and use other custom classes to hold the final data so that they don't have anyhting else
 def titration_data(
-    filename: str, burette_id: str = "dosimat 12"
+    filename: str,
+    burette_id: str = "dosimat 12",
+    parsed: parse_cache.CachedTitration = None,
 ) -> tuple[Solution, Titration, Titration]:
     # assumes calibration solution type found in file name
     if "nacl" in filename.lower():
@@ -47,97 +95,79 @@ def titration_data(
         sample = KCl()
     else:
         sample = SW()
-    # # Open filename and extract data
-    with open(filename, "r") as datafile:
-        csvreader = csv.reader(datafile)
-        sample_info = next(csvreader)
-        sample.w0 = float(sample_info[0]) / 1000
-        if sample.type.lower() == "sw":
-            sample.S = float(sample_info[1])
-        else:
-            sample.I = float(sample_info[1])
-        sample.emf0 = float(sample_info[2])
-        t0 = float(sample_info[3])
-        HCl_id = sample_info[7].split("-")[0]
-        NaOH_id = sample_info[6].split("-")[0]
-        # check for nutrient data
-        match = re.match(r"\d{8} ([^-]+)-[A-Za-z]\.csv", os.path.basename(filename))
-        if match:
-            sample.id = match.group(1)
-        else:
-            sample.id = "any"
-
-        # check if FWD
-        fwd_data = list()
-        for row in csvreader:
-            # check if bwd
-            if "BWD" in row:
-                bwd_data = list()
-                break
-            else:
-                fwd_data.append(row)
-        if fwd_data:
-            # get titrant data
-            HCl_conc, HCl_I = get_concentration_ionicstrength("HCl", HCl_id)
-            HCl_titrant = Titrant("HCl", HCl_id, HCl_conc, HCl_I)
-            # maps the column data, assuming the order of types in datatypes
-            fwd_data_processed = dict(zip(datatypes.keys(), map(list, zip(*fwd_data))))
-            # type cast
-            fwd_typecast = {
-                key: [datatypes[key](value) for value in values]
-                for key, values in fwd_data_processed.items()
-            }
-            HCl_vol_burette_corrected = correct_burette_volume(
-                burette_id, fwd_typecast["volume"]
-            )
-            HCl_weights = v_to_w(
-                HCl_vol_burette_corrected,
-                fwd_typecast["t_HCl"],
-                "HCl",
-                HCl_id,
-            )
-            titration_emf = fwd_typecast["emf"]
-            titration_temp = fwd_typecast["t_sample"]
-            HCl_titration_data = Titration(
-                HCl_weights, titration_emf, titration_temp, HCl_titrant
-            )
-        else:
-            HCl_titration_data = None
-
-        if "bwd_data" in locals():
-            for row in csvreader:
-                bwd_data.append(row)
-        if bwd_data:
-            NaOH_conc, NaOH_I = get_concentration_ionicstrength("NaOH", NaOH_id)
-            NaOH_titrant = Titrant("NaOH", NaOH_id, NaOH_conc, NaOH_I)
-            # maps the column data, assuming the order of types in datatypes
-            bwd_data_processed = dict(zip(datatypes.keys(), map(list, zip(*bwd_data))))
-            # type cast
-            bwd_typecast = {
-                key: [datatypes[key](value) for value in values]
-                for key, values in bwd_data_processed.items()
-            }
-            NaOH_vol_burette_corrected = correct_burette_volume(
-                burette_id, bwd_typecast["volume"]
-            )
-            NaOH_weights = v_to_w(
-                NaOH_vol_burette_corrected,
-                bwd_typecast["t_NaOH"],
-                "NaOH",
-                NaOH_id,
+    # # Open filename and extract data, unless the caller already has
+    if parsed is None:
+        with profiling.stage("parse"):
+            parsed = parse_cache.load(filename, read_titration_file)
+    sample_info, fwd_data, bwd_data = (
+        parsed.sample_info,
+        parsed.fwd_data,
+        parsed.bwd_data,
+    )
+    sample.w0 = float(sample_info[0]) / 1000
+    if sample.type.lower() == "sw":
+        sample.S = float(sample_info[1])
+    else:
+        sample.I = float(sample_info[1])
+    sample.emf0 = float(sample_info[2])
+    t0 = float(sample_info[3])
+    HCl_id = sample_info[7].split("-")[0]
+    NaOH_id = sample_info[6].split("-")[0]
+    # check for nutrient data
+    match = re.match(r"\d{8} ([^-]+)-[A-Za-z]\.csv", os.path.basename(filename))
+    if match:
+        sample.id = match.group(1)
+    else:
+        sample.id = "any"
+
+    if fwd_data.size:
+        # get titrant data
+        HCl_conc, HCl_I = get_concentration_ionicstrength("HCl", HCl_id)
+        HCl_titrant = Titrant("HCl", HCl_id, HCl_conc, HCl_I)
+        with profiling.stage("volume_to_mass"):
+            HCl_weights = parsed.get(
+                "HCl_weights",
+                lambda: v_to_w(
+                    correct_burette_volume(burette_id, fwd_data["volume"]),
+                    fwd_data["t_HCl"],
+                    "HCl",
+                    HCl_id,
+                ),
+                get_density_coefficients("burette_density", burette_id),
+                get_density_coefficients("HCl", HCl_id),
             )
-            titration_emf = bwd_typecast["emf"]
-            titration_temp = bwd_typecast["t_sample"]
-            NaOH_titration_data = Titration(
-                NaOH_weights, titration_emf, titration_temp, NaOH_titrant
+        HCl_titration_data = Titration(
+            HCl_weights, fwd_data["emf"], fwd_data["t_sample"], HCl_titrant
+        )
+    else:
+        HCl_titration_data = None
+
+    if bwd_data.size:
+        NaOH_conc, NaOH_I = get_concentration_ionicstrength("NaOH", NaOH_id)
+        NaOH_titrant = Titrant("NaOH", NaOH_id, NaOH_conc, NaOH_I)
+        with profiling.stage("volume_to_mass"):
+            NaOH_weights = parsed.get(
+                "NaOH_weights",
+                lambda: v_to_w(
+                    correct_burette_volume(burette_id, bwd_data["volume"]),
+                    bwd_data["t_NaOH"],
+                    "NaOH",
+                    NaOH_id,
+                ),
+                get_density_coefficients("burette_density", burette_id),
+                get_density_coefficients("NaOH", NaOH_id),
             )
-        else:
-            NaOH_titration_data = None
+        NaOH_titration_data = Titration(
+            NaOH_weights, bwd_data["emf"], bwd_data["t_sample"], NaOH_titrant
+        )
+    else:
+        NaOH_titration_data = None
 
     # flag sample as Q (questionable) if temperature very out of range
     if t0 < 15 or t0 > 30:
         sample.flag = "Q"
 
+    parsed.save()
     return sample, HCl_titration_data, NaOH_titration_data
 
 
@@ -149,41 +179,33 @@ def NaOH_calibration_data(
 ) -> tuple[Solution, Solution, Solution, Titration]:
     HCl_aliquot = Solution()
 
-    fwd_data = list()
     # # Open filename and extract data
-    with open(filename, "r") as datafile:
-        csvreader = csv.reader(datafile)
-        sample_info = next(csvreader)
-        # if first time initializing sample
-        if not sample:
-            # assumes calibration solution type found in file name
-            if "nacl" in filename.lower():
-                sample = NaCl()
-            elif "kcl" in filename.lower():
-                sample = KCl()
-
-            sample.w0 = float(sample_info[0]) / 1000
-            sample.salt_value = float(sample_info[1])
-            sample.salt_type = "ionic strength"
-            sample.emf0 = float(sample_info[2])
-
-        if not titrant:
-            titrant = Solution()
-            if sample_info[6]:
-                titrant.id = sample_info[6].split("-")[0]
-            else:
-                titrant.id = "nan"
-
-        # check if FWD
-        for row in csvreader:
-            if "BWD" in row:
-                bwd_data = list()
-                break
-            else:
-                fwd_data.append(row)
-        if "bwd_data" in locals():
-            for row in csvreader:
-                bwd_data.append(row)
+    with profiling.stage("parse"):
+        parsed = parse_cache.load(filename, read_titration_file)
+    sample_info, fwd_data, bwd_data = (
+        parsed.sample_info,
+        parsed.fwd_data,
+        parsed.bwd_data,
+    )
+    # if first time initializing sample
+    if not sample:
+        # assumes calibration solution type found in file name
+        if "nacl" in filename.lower():
+            sample = NaCl()
+        elif "kcl" in filename.lower():
+            sample = KCl()
+
+        sample.w0 = float(sample_info[0]) / 1000
+        sample.salt_value = float(sample_info[1])
+        sample.salt_type = "ionic strength"
+        sample.emf0 = float(sample_info[2])
+
+    if not titrant:
+        titrant = Solution()
+        if sample_info[6]:
+            titrant.id = sample_info[6].split("-")[0]
+        else:
+            titrant.id = "nan"
 
     t0 = float(sample_info[3])
     # flag sample as Q (questionable) if temperature very out of range
@@ -192,79 +214,135 @@ def NaOH_calibration_data(
 
     HCl_aliquot.conc = float(sample_info[5])
 
-    # process and pivot
-    if fwd_data:
-        # make dict of data
-        fwd_data_processed = dict(zip(datatypes.keys(), map(list, zip(*fwd_data))))
-        # type cast
-        fwd_typecast = {
-            key: [datatypes[key](value) for value in values]
-            for key, values in fwd_data_processed.items()
-        }
-        HCl_aliquot.weight = fwd_typecast["weight"][0] / 1000
+    if fwd_data.size:
+        HCl_aliquot.weight = fwd_data["weight"][0] / 1000
 
     else:
         raise DataMissing(f"There is no HCl data in {filename}, unable to proceed.")
         # TODO maybe if there are enough files ahead of it, use all of them and don't count the last one, but I can't keep going bc
         # need this data for the rest to be valid
 
-    if bwd_data:
-        bwd_data_processed = dict(zip(datatypes.keys(), map(list, zip(*bwd_data))))
-        # type cast
-        bwd_typecast = {
-            key: [datatypes[key](value) for value in values]
-            for key, values in bwd_data_processed.items()
-        }
+    if bwd_data.size:
         # take burette name, read in burette_density, grab formula
-        volume_corrected = correct_burette_volume(burette_id, bwd_typecast["volume"])
-
-        titration_weights = v_to_w(
-            volume_corrected, bwd_typecast["t_NaOH"], "NaOH", titrant.id
-        )
+        with profiling.stage("volume_to_mass"):
+            titration_weights = parsed.get(
+                "NaOH_weights",
+                lambda: v_to_w(
+                    correct_burette_volume(burette_id, bwd_data["volume"]),
+                    bwd_data["t_NaOH"],
+                    "NaOH",
+                    titrant.id,
+                ),
+                get_density_coefficients("burette_density", burette_id),
+                get_density_coefficients("NaOH", titrant.id),
+            )
     else:
         raise TitrantDataMissing(
             f"There is no NaOH data in {filename}, unable to proceed."
         )
 
-    titration_emf = bwd_typecast["emf"]
-    titration_temp = fwd_typecast["t_sample"]
-    titration_data = Titration(titration_weights, titration_emf, titration_temp)
+    titration_data = Titration(titration_weights, bwd_data["emf"], fwd_data["t_sample"])
+    parsed.save()
 
     return titrant, sample, HCl_aliquot, titration_data
 
 
 def correct_burette_volume(
-    burette_id: str, volume: Union[str, list]
-) -> Union[str, list]:
-
-    x0, x1, x2, x3, x4, x5 = get_density_coefficients("burette_density", burette_id)
-
-    return [
-        x0 + x1 * vol + x2 * (vol**2) + x3 * (vol**3) + x4 * (vol**4) + x5 * (vol**5)
-        for vol in volume
-    ]
+    burette_id: str, volume: Union[list, np.ndarray]
+) -> np.ndarray:
+    return np.polyval(
+        density_polynomial("burette_density", burette_id),
+        np.asarray(volume, dtype=np.float64),
+    )
 
 
 def v_to_w(
-    volume: list[float], temperature: list[float], solution_type: str, solution_id: str
-) -> list[float]:
+    volume: Union[list, np.ndarray],
+    temperature: Union[list, np.ndarray],
+    solution_type: str,
+    solution_id: str,
+) -> np.ndarray:
     # TODO if solution_id is missing, use a generic formula, add flag to all results so poorer flag if not use specific coefficients
 
     if "-" in solution_id:
         solution_id = solution_id.split("-")[0]
 
-    x0, x1, x2, x3, x4, x5 = get_density_coefficients(solution_type, solution_id)
-    NaOH_density = [
-        x0
-        + x1 * temp
-        + x2 * (temp**2)
-        + x3 * (temp**3)
-        + x4 * (temp**4)
-        + x5 * (temp**5)
-        for temp in temperature
-    ]
+    density = np.polyval(
+        density_polynomial(solution_type, solution_id),
+        np.asarray(temperature, dtype=np.float64),
+    )
     # returns the air buoyancy corrected value
-    return [rho * v / 1000 for rho, v in zip(NaOH_density, volume)]
+    return density * np.asarray(volume, dtype=np.float64) / 1000
+
+
+def volumes_to_weights(burette_id: str, sections: list[tuple]) -> list[np.ndarray]:
+    """
+    Method to convert the burette volumes of many titrations at once: every
+    polynomial is evaluated once, on the points of all sections that use it
+
+    Args:
+        burette_id (str): burette of all sections
+        sections (list): (volume, temperature, solution_type, solution_id) per section
+
+    Returns:
+        list: weights of every section, same as v_to_w(correct_burette_volume(...))
+    """
+    if not sections:
+        return list()
+    lengths = [len(section[0]) for section in sections]
+    bounds = np.cumsum(lengths)[:-1]
+    volume = correct_burette_volume(
+        burette_id, np.concatenate([section[0] for section in sections])
+    )
+    temperature = np.concatenate(
+        [np.asarray(section[1], dtype=np.float64) for section in sections]
+    )
+    # section positions of every titrant lot
+    lots = dict()
+    for i, (_, _, solution_type, solution_id) in enumerate(sections):
+        lots.setdefault((solution_type, solution_id.split("-")[0]), list()).append(i)
+    starts = np.concatenate([[0], bounds])
+    density = np.empty_like(temperature)
+    for (solution_type, solution_id), members in lots.items():
+        points = np.concatenate(
+            [np.arange(starts[i], starts[i] + lengths[i]) for i in members]
+        )
+        density[points] = np.polyval(
+            density_polynomial(solution_type, solution_id), temperature[points]
+        )
+    return np.split(density * volume / 1000, bounds)
+
+
+# (solution_type, id) -> (table row, coefficients for np.polyval)
+_polynomials = dict()
+
+
+def density_polynomial(solution_type: str, id: str) -> np.ndarray:
+    """
+    Method to get the coefficients of a burette or density formula, highest
+    order first as np.polyval takes them. They are kept per burette and
+    titrant lot, and made again when the registry has read the table again
+
+    Args:
+        solution_type (str): table keyword, e.g., burette_density, HCl, NaOH
+        id (str): identifier
+
+    Returns:
+        np.ndarray: x5, x4, x3, x2, x1, x0
+    """
+    if id is None or id == "nan":
+        raise CalibrationDataMissing("Solution identifier is invalid")
+    # always through the registry, which notices changed tables and records
+    # the row for the dependencies of a result
+    row = registry.row(solution_type, id)
+    cached = _polynomials.get((solution_type, id))
+    if cached is None or cached[0] is not row:
+        cached = (
+            row,
+            np.array([float(row[f"x{power}"]) for power in range(5, -1, -1)]),
+        )
+        _polynomials[(solution_type, id)] = cached
+    return cached[1]
 
 
 def get_density_coefficients(
@@ -281,20 +359,17 @@ def get_density_coefficients(
         float: coefficients appropriate for a x0 + x1 * y + x2 * (y**2) + x3 * (y**3) + x4 * (y**4) + x5 * (y**5) equation
 
     """
-    batch_data = get_matching_files("auxiliary_data/", solution_type, "csv")[0]
-
     if id is None or id == "nan":
         raise CalibrationDataMissing("Solution identifier is invalid")
 
-    df = pd.read_csv(batch_data)
-    coefficients = df[df["id"] == id]
+    coefficients = registry.row(solution_type, id)
 
-    x0 = float(coefficients["x0"].values[0])
-    x1 = float(coefficients["x1"].values[0])
-    x2 = float(coefficients["x2"].values[0])
-    x3 = float(coefficients["x3"].values[0])
-    x4 = float(coefficients["x4"].values[0])
-    x5 = float(coefficients["x5"].values[0])
+    x0 = float(coefficients["x0"])
+    x1 = float(coefficients["x1"])
+    x2 = float(coefficients["x2"])
+    x3 = float(coefficients["x3"])
+    x4 = float(coefficients["x4"])
+    x5 = float(coefficients["x5"])
 
     return x0, x1, x2, x3, x4, x5
 
@@ -314,12 +389,9 @@ def get_concentration_ionicstrength(keyword: str, id: str) -> tuple[float, float
     if id is None or id == "nan":
         raise CalibrationDataMissing("Solution identifier is invalid")
 
-    batch_data = get_matching_files("auxiliary_data/", keyword, "csv")[0]
-
-    df = pd.read_csv(batch_data)
-    coefficients = df[df["id"] == id]
+    coefficients = registry.row(keyword, id)
 
-    concentration = float(coefficients["c"].values[0])
-    ionic_strength = float(coefficients["I"].values[0])
+    concentration = float(coefficients["c"])
+    ionic_strength = float(coefficients["I"])
 
     return concentration, ionic_strength
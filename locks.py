@@ -0,0 +1,44 @@
+## Advisory file locks shared between processes
+# Used around read-modify-write of files that several processes may change at
+# the same time, e.g., two calibrations updating NaOH_summary, or watch mode
+# and a batch appending to the same archive. The lock is taken on a separate
+# .lock file next to the data, so the data file itself can be replaced.
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def exclusive_lock(path: str):
+    """
+    Holds an exclusive lock on path + ".lock" for the with block, waiting
+    for other processes that hold it
+
+    Args:
+        path (str): file the lock protects
+    """
+    with open(f"{path}.lock", "a+b") as lockfile:
+        if fcntl:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        else:
+            lockfile.seek(0)
+            # LK_LOCK retries for 10 s, keep waiting like flock does
+            while True:
+                try:
+                    msvcrt.locking(lockfile.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+            else:
+                lockfile.seek(0)
+                msvcrt.locking(lockfile.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,202 @@
+## Binary cache of parsed titration files
+# Off by default. Turned on by the AX_CACHE environment variable or the
+# --cache option of cli.py, both naming the cache folder. Every titration file
+# gets one entry there with its header row and the FWD and BWD sections as
+# structured arrays, plus arrays derived from them (the titrant weights), so
+# reprocessing loads arrays instead of parsing the csv again.
+#
+# An entry is one json line (metadata, header row, and dtype, length and
+# offset of every array) followed by the raw bytes of the arrays, which are
+# read back as read-only views with np.frombuffer. This takes tens of
+# microseconds, where np.load of an .npz spends most of a millisecond on the
+# zip and npy headers.
+#
+# An entry is used while the file has the same path, size and modification
+# time. If the size or time changed, the content hash decides: same content
+# (e.g., a copied or touched file) keeps the entry, anything else is parsed
+# again. Derived arrays are stored with the auxiliary values they were
+# computed from and recomputed when those change, e.g., new burette or
+# density coefficients.
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+from results import file_hash
+
+# bump when the layout of an entry changes, older entries are then ignored
+cache_version = 1
+cache_extension = ".axc"
+
+folder = None
+
+
+def enable(cache_folder: str):
+    """
+    Method to turn the cache on for this process
+
+    Args:
+        cache_folder (str): folder for the cache entries, created if missing
+    """
+    global folder
+    os.makedirs(cache_folder, exist_ok=True)
+    folder = cache_folder
+
+
+class CachedTitration:
+    def __init__(
+        self,
+        sample_info: list,
+        fwd_data: np.ndarray,
+        bwd_data: np.ndarray,
+        meta: dict = None,
+        derived: dict = None,
+        path: str = None,
+    ):
+        self.sample_info = sample_info
+        self.fwd_data = fwd_data
+        self.bwd_data = bwd_data
+        # path of the entry, None if the cache is off
+        self.path = path
+        self.meta = meta or dict()
+        self.meta.setdefault("derived", dict())
+        self.derived = derived or dict()
+        self.modified = False
+
+    def get(self, name: str, compute, *dependencies) -> np.ndarray:
+        """
+        Method to get an array derived from the file, from the cache if it was
+        computed from the same dependencies before
+
+        Args:
+            name (str): name of the array
+            compute (callable): computes the array if it is not cached
+            dependencies: json serializable values the array depends on
+
+        Returns:
+            np.ndarray: derived array
+        """
+        if self.path is None:
+            return compute()
+        key = json.dumps(dependencies)
+        if name in self.derived and self.meta["derived"].get(name) == key:
+            return self.derived[name]
+        self.derived[name] = np.asarray(compute(), dtype=np.float64)
+        self.meta["derived"][name] = key
+        self.modified = True
+        return self.derived[name]
+
+    def save(self):
+        """Method to write the entry if it is new or has new derived arrays"""
+        if self.path is None or not self.modified:
+            return
+        arrays = {
+            "fwd_data": self.fwd_data,
+            "bwd_data": self.bwd_data,
+            **{f"derived_{name}": values for name, values in self.derived.items()},
+        }
+        # name -> dtype, length, offset in the bytes after the json line
+        layout = dict()
+        offset = 0
+        for name, values in arrays.items():
+            dtype = values.dtype.descr if values.dtype.names else values.dtype.str
+            layout[name] = (dtype, len(values), offset)
+            offset += values.nbytes
+        header = json.dumps(
+            {"meta": self.meta, "sample_info": self.sample_info, "arrays": layout}
+        )
+        # written next to the entry and moved over it, so that parallel
+        # workers never read half an entry
+        handle, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(self.path), prefix=".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(handle, "wb") as cachefile:
+                cachefile.write(header.encode() + b"\n")
+                for values in arrays.values():
+                    cachefile.write(np.ascontiguousarray(values).tobytes())
+            os.replace(temporary, self.path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+        self.modified = False
+
+
+def _entry_path(filename: str) -> str:
+    name = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()[:24]
+    return os.path.join(folder, f"{name}{cache_extension}")
+
+
+def _read_entry(path: str) -> CachedTitration:
+    with open(path, "rb") as cachefile:
+        raw = cachefile.read()
+    end = raw.index(b"\n")
+    header = json.loads(raw[:end])
+    if header["meta"].get("version") != cache_version:
+        return None
+    body = memoryview(raw)[end + 1 :]
+    arrays = dict()
+    for name, (dtype, length, offset) in header["arrays"].items():
+        if isinstance(dtype, list):
+            dtype = [tuple(field) for field in dtype]
+        arrays[name] = np.frombuffer(
+            body, dtype=np.dtype(dtype), count=length, offset=offset
+        )
+    return CachedTitration(
+        header["sample_info"],
+        arrays.pop("fwd_data"),
+        arrays.pop("bwd_data"),
+        header["meta"],
+        {name[len("derived_") :]: values for name, values in arrays.items()},
+        path,
+    )
+
+
+def load(filename: str, reader) -> CachedTitration:
+    """
+    Method to get a parsed titration file, from the cache if it holds the
+    current content of the file
+
+    Args:
+        filename (str): titration file
+        reader (callable): parses the file into header row, FWD and BWD data
+
+    Returns:
+        CachedTitration: parsed file, call save() once derived arrays are added
+    """
+    if folder is None:
+        return CachedTitration(*reader(filename))
+    path = _entry_path(filename)
+    stat = os.stat(filename)
+    state = {
+        "path": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    try:
+        cached = _read_entry(path)
+    except (OSError, ValueError, KeyError):
+        # missing or unreadable, e.g., written by an older version
+        cached = None
+    if cached is not None and cached.meta["path"] == state["path"]:
+        if all(cached.meta[key] == value for key, value in state.items()):
+            return cached
+        digest = file_hash(filename)
+        if cached.meta["sha256"] == digest:
+            cached.meta.update(state)
+            cached.modified = True
+            return cached
+    else:
+        digest = file_hash(filename)
+    parsed = CachedTitration(
+        *reader(filename),
+        meta={**state, "sha256": digest, "version": cache_version},
+        path=path,
+    )
+    parsed.modified = True
+    return parsed
+
+
+if os.environ.get("AX_CACHE"):
+    enable(os.environ["AX_CACHE"])
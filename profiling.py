@@ -0,0 +1,198 @@
+## Per stage profiling of the processing pipeline
+# Off by default. Turned on by the AX_PROFILE environment variable (any value
+# but "" or "0") or the --profile flag of cli.py, and AX_PROFILE_JSON or
+# --profile_json add one json line per file and stage. When off, stage()
+# returns a shared no-op context manager, so instrumented code only pays for
+# one function call per stage.
+#
+#   with profiling.stage("process_titration", file):
+#       with profiling.stage("parse"):
+#           ...
+#
+# Stages record wall time, calls and the peak of memory allocated inside
+# them (tracemalloc) per file; a nested stage is attributed to the file of
+# the stage around it, and the time of a stage includes its nested stages.
+# Every thread has its own stack of open stages, but tracemalloc peaks are
+# process wide, so threads that profile must not overlap (the server
+# processes one request at a time while profiling is on).
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import nullcontext
+
+_disabled = nullcontext()
+
+enabled = False
+json_path = None
+# (file, stage) -> [seconds, calls, peak bytes]
+_records = defaultdict(lambda: [0.0, 0, 0])
+# open stages of each thread: [file, memory at start, highest peak of nested stages]
+_local = threading.local()
+
+
+def enable(json_lines: str = None):
+    """
+    Method to turn profiling on for this process
+
+    Args:
+        json_lines (str): optional file the records are appended to as json lines
+    """
+    global enabled, json_path
+    enabled = True
+    json_path = json_lines or json_path
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stage(name: str, file: str = None):
+    """
+    Method to get the context manager that profiles one stage
+
+    Args:
+        name (str): stage name
+        file (str): file the stage works on, default the file of the enclosing stage
+
+    Returns:
+        context manager
+    """
+    if not enabled:
+        return _disabled
+    return _Stage(name, file)
+
+
+class _Stage:
+    __slots__ = ("name", "file", "start")
+
+    def __init__(self, name: str, file: str = None):
+        self.name = name
+        self.file = file
+
+    def __enter__(self):
+        open_stages = _local.__dict__.setdefault("open", list())
+        if self.file is None:
+            self.file = open_stages[-1][0] if open_stages else ""
+        memory, peak = tracemalloc.get_traced_memory()
+        if open_stages:
+            # the peak of the enclosing stage so far, reset below
+            open_stages[-1][2] = max(open_stages[-1][2], peak)
+        open_stages.append([self.file, memory, memory])
+        tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        open_stages = _local.open
+        file, start_memory, nested_peak = open_stages.pop()
+        peak = max(tracemalloc.get_traced_memory()[1], nested_peak)
+        record = _records[(file, self.name)]
+        record[0] += seconds
+        record[1] += 1
+        record[2] = max(record[2], peak - start_memory)
+        if open_stages:
+            # the peak of the enclosing stage includes this one
+            open_stages[-1][2] = max(open_stages[-1][2], peak)
+        tracemalloc.reset_peak()
+
+
+def pop(file: str) -> dict:
+    """
+    Method to take the records of one file out of this process, e.g., to
+    send them from a worker process back with the result
+
+    Args:
+        file (str): file the records belong to
+
+    Returns:
+        dict: stage -> (seconds, calls, peak bytes), None if profiling is off
+    """
+    if not enabled:
+        return None
+    return {
+        name: tuple(_records.pop((record_file, name)))
+        for record_file, name in list(_records)
+        if record_file == file
+    }
+
+
+def pop_all() -> dict:
+    """
+    Method to take all records out of this process, see pop
+
+    Returns:
+        dict: file -> stage -> (seconds, calls, peak bytes), None if profiling is off
+    """
+    if not enabled:
+        return None
+    files = {file for file, _ in _records}
+    return {file: pop(file) for file in files}
+
+
+def merge(file: str, records: dict):
+    """
+    Method to add records taken with pop, e.g., in another process
+
+    Args:
+        file (str): file the records belong to
+        records (dict): stage -> (seconds, calls, peak bytes)
+    """
+    for name, (seconds, calls, peak) in (records or {}).items():
+        record = _records[(file, name)]
+        record[0] += seconds
+        record[1] += calls
+        record[2] = max(record[2], peak)
+
+
+def report(output=sys.stderr):
+    """
+    Method to print the summary table of all stages, append the json lines
+    if requested, and start over for the next batch. Does nothing if
+    profiling is off
+    """
+    if not enabled or not _records:
+        return
+    if json_path:
+        with open(json_path, "a") as jsonfile:
+            for (file, name), (seconds, calls, peak) in _records.items():
+                jsonfile.write(
+                    json.dumps(
+                        {
+                            "file": file,
+                            "stage": name,
+                            "seconds": seconds,
+                            "calls": calls,
+                            "peak_bytes": peak,
+                        }
+                    )
+                    + "\n"
+                )
+    # stage -> seconds, calls, files, slowest file seconds, peak bytes
+    stages = defaultdict(lambda: [0.0, 0, 0, 0.0, 0])
+    for (file, name), (seconds, calls, peak) in _records.items():
+        summary = stages[name]
+        summary[0] += seconds
+        summary[1] += calls
+        summary[2] += 1
+        summary[3] = max(summary[3], seconds)
+        summary[4] = max(summary[4], peak)
+    print(
+        f"{'stage':<20} {'files':>6} {'calls':>7} {'total (s)':>10} "
+        f"{'ms/file':>9} {'max ms':>9} {'peak MB':>8}",
+        file=output,
+    )
+    for name, (seconds, calls, files, slowest, peak) in sorted(
+        stages.items(), key=lambda item: -item[1][0]
+    ):
+        print(
+            f"{name:<20} {files:>6} {calls:>7} {seconds:>10.3f} "
+            f"{seconds / files * 1e3:>9.3f} {slowest * 1e3:>9.3f} {peak / 2**20:>8.2f}",
+            file=output,
+        )
+    _records.clear()
+
+
+if os.environ.get("AX_PROFILE", "0") not in ("", "0"):
+    enable(os.environ.get("AX_PROFILE_JSON"))
@@ -0,0 +1,184 @@
+## Incremental results file for batch processing
+# One row per processed titration file, appended and flushed as soon as the
+# file is done, so that an interrupted batch can be resumed by skipping the
+# files that already have a result for the same content and parameters.
+#
+# Every field of titrate_ax.TitrationResult is stored except the Monte Carlo
+# replicates themselves, of which the standard deviations and counts are kept
+# (the replicates can be drawn again with the same --seed), and the profiling
+# records, which are timings of this run rather than part of the result and
+# go to the profiling report instead.
+import csv
+import hashlib
+import json
+import os
+import tempfile
+
+results_columns = [
+    "sample_id",
+    "file",
+    "file_hash",
+    "params_hash",
+    "f",
+    "AT",
+    "E0",
+    "fit_quality",
+    "flag",
+    "error",
+    # json of the auxiliary rows used, table name -> id -> fingerprint
+    "dependencies",
+    # spread of the Monte Carlo replicates, if requested
+    "f_sd",
+    "AT_sd",
+    "E0_sd",
+    "replicates",
+    "replicates_converged",
+    # json of the solver_stats.SolverStats of the fit
+    "solver",
+]
+
+
+def file_hash(path: str) -> str:
+    """
+    Method to get the sha256 of the content of a file
+
+    Args:
+        path (str): file to hash
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as datafile:
+        for chunk in iter(lambda: datafile.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parameters_hash(parameters: dict) -> str:
+    """
+    Method to get a short, stable hash of processing parameters
+
+    Args:
+        parameters (dict): json serializable parameters
+
+    Returns:
+        str: hex digest
+    """
+    encoded = json.dumps(parameters, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class ResultsSink:
+    def __init__(self, path: str):
+        self.path = path
+        # (file_hash, params_hash) of files with a stored result
+        self._done = set()
+        if os.path.exists(path):
+            self._drop_partial_row()
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, newline="") as csvfile:
+                reader = csv.DictReader(csvfile)
+                rows = list(reader)
+            for row in rows:
+                if row.get("error") == "" and row.get("params_hash"):
+                    self._done.add((row["file_hash"], row["params_hash"]))
+            self.columns = list(reader.fieldnames)
+            missing = [
+                column for column in results_columns if column not in self.columns
+            ]
+            if missing:
+                # written by an older version, new rows would lose these
+                self.columns += missing
+                self._rewrite(rows)
+            self._file = open(path, "a", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns)
+        else:
+            self.columns = results_columns
+            self._file = open(path, "w", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns)
+            self._writer.writeheader()
+            self._file.flush()
+
+    def is_done(self, file_hash: str, params_hash: str) -> bool:
+        return (file_hash, params_hash) in self._done
+
+    def append(self, row: dict):
+        """
+        Method to write one result and flush it to disk
+
+        Args:
+            row (dict): values for results_columns, missing ones are left empty
+        """
+        self._writer.writerow(
+            {
+                column: "" if row.get(column) is None else row[column]
+                for column in self.columns
+            }
+        )
+        self._file.flush()
+        if not row.get("error"):
+            self._done.add((row["file_hash"], row["params_hash"]))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _rewrite(self, rows: list):
+        # the whole file with the widened header, moved over the old one so
+        # that an interruption leaves either the old or the new file
+        handle, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix=".",
+            suffix=".tmp",
+        )
+        try:
+            with os.fdopen(handle, "w", newline="") as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=self.columns, restval="")
+                writer.writeheader()
+                writer.writerows(rows)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+            os.replace(temporary, self.path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+
+    def _drop_partial_row(self):
+        # a crash can leave half a row at the end, cut back to the last newline
+        with open(self.path, "rb+") as csvfile:
+            csvfile.seek(0, os.SEEK_END)
+            size = csvfile.tell()
+            csvfile.seek(max(0, size - 65536))
+            tail = csvfile.read()
+            if tail.endswith(b"\n"):
+                return
+            csvfile.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+
+
+def latest_results(path: str, params_hash: str = None) -> dict:
+    """
+    Method to get the last result of every file in a results file, later
+    rows replace earlier ones for the same file
+
+    Args:
+        path (str): results csv
+        params_hash (str): only rows processed with these parameters, default all
+
+    Returns:
+        dict: file -> row
+    """
+    latest = dict()
+    if not os.path.exists(path):
+        return latest
+    with open(path, newline="") as csvfile:
+        for row in csv.DictReader(csvfile):
+            if params_hash is None or row.get("params_hash") == params_hash:
+                latest[row["file"]] = row
+    return latest
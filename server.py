@@ -0,0 +1,184 @@
+## Local titration service
+# Keeps one TitrateAX and the auxiliary tables loaded, so that acquisition
+# software can get results without starting a new process for every file.
+# Only listens on localhost by default. Requests:
+#   GET  /health                       -> {"status": "ok"}
+#   POST /titrate  {"path": "<file>"}  -> result of that file
+#   POST /titrate  {"filename": "<name>", "csv": "<file content>"}
+#   POST /titrate?filename=<name>      with the csv as a text/csv body
+# The sample type and id come from the file name, so a csv payload needs the
+# name the file would have on disk.
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import nullcontext
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+from auxiliary import registry
+import profiling
+from results import ResultsSink, file_hash, parameters_hash
+from titrate_ax import TitrateAX, TitrationResult
+
+logger = logging.getLogger(__name__)
+
+
+def result_to_json(result: TitrationResult) -> dict:
+    """
+    Method to turn a result into plain json types, with the spread of the
+    Monte Carlo replicates instead of the replicates themselves
+
+    Args:
+        result (TitrationResult): processed titration
+
+    Returns:
+        dict: json serializable result
+    """
+    response = {
+        key: float(value) if isinstance(value, (float, np.floating)) else value
+        for key, value in result._asdict().items()
+        if key not in ("uncertainty", "profile", "solver")
+    }
+    if result.uncertainty is not None:
+        for key in ("f", "AT", "E0"):
+            response[f"{key}_sd"] = float(np.std(getattr(result.uncertainty, key)))
+    if result.solver is not None:
+        response["solver"] = result.solver._asdict()
+    return response
+
+
+class TitrationServer(ThreadingHTTPServer):
+    # one thread per request, several stations can post at the same time
+    daemon_threads = True
+
+    def __init__(self, address: tuple, titrate: TitrateAX, results: str = None):
+        super().__init__(address, TitrationRequestHandler)
+        self.titrate = titrate
+        self.sink = ResultsSink(results) if results else None
+        self.params_hash = parameters_hash(titrate.parameters)
+        # the results file is shared by all request threads
+        self._sink_lock = threading.Lock()
+        # tracemalloc peaks are process wide, so profiled requests are
+        # processed one at a time to charge memory to the right file
+        self._profile_lock = threading.Lock() if profiling.enabled else nullcontext()
+        registry.warm()
+
+    def process(self, file: str, name: str = None) -> TitrationResult:
+        """
+        Method to process one titration file and record the result
+
+        Args:
+            file (str): titration file on disk
+            name (str): file name to report instead of file, e.g., for payloads
+
+        Returns:
+            TitrationResult: result, with the error if it failed
+        """
+        with self._profile_lock:
+            result = self.titrate._try_process_titration(file)
+        if name:
+            result = result._replace(file=name)
+        if self.sink:
+            digest = file_hash(file)
+            with self._sink_lock:
+                self.titrate._report(result, self.sink, digest, self.params_hash)
+        else:
+            self.titrate._report(result)
+        return result
+
+    def process_payload(self, filename: str, payload: str) -> TitrationResult:
+        # the parser works on files, so the payload is written to a temporary
+        # one with the name the station gave it
+        with tempfile.TemporaryDirectory() as folder:
+            file = os.path.join(folder, os.path.basename(filename))
+            with open(file, "w", newline="") as datafile:
+                datafile.write(payload)
+            return self.process(file, filename)
+
+    def server_close(self):
+        super().server_close()
+        if self.sink:
+            self.sink.close()
+
+
+class TitrationRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path == "/health":
+            self._send(HTTPStatus.OK, {"status": "ok"})
+        else:
+            self._send(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/titrate":
+            self._send(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type", "").startswith("text/csv"):
+                filename = parse_qs(url.query).get("filename", [None])[0]
+                request = {"filename": filename, "csv": body.decode()}
+            else:
+                request = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            self._send(HTTPStatus.BAD_REQUEST, {"error": f"Invalid request: {e}"})
+            return
+        if not isinstance(request, dict):
+            self._send(HTTPStatus.BAD_REQUEST, {"error": "Expected a json object"})
+            return
+
+        if request.get("path"):
+            if not os.path.isfile(request["path"]):
+                self._send(
+                    HTTPStatus.NOT_FOUND,
+                    {"error": f"No titration file {request['path']}"},
+                )
+                return
+            result = self.server.process(request["path"])
+        elif request.get("filename") and request.get("csv") is not None:
+            result = self.server.process_payload(request["filename"], request["csv"])
+        else:
+            self._send(
+                HTTPStatus.BAD_REQUEST,
+                {"error": "Send either a path or a filename and csv"},
+            )
+            return
+        status = HTTPStatus.UNPROCESSABLE_ENTITY if result.error else HTTPStatus.OK
+        self._send(status, result_to_json(result))
+
+    def _send(self, status: HTTPStatus, response: dict):
+        encoded = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve(
+    titrate: TitrateAX,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    results: str = None,
+):
+    """
+    Serves titration requests until interrupted (Ctrl+C)
+
+    Args:
+        titrate (TitrateAX): processing settings for all requests
+        host (str): interface to listen on
+        port (int): port to listen on
+        results (str): optional csv file that every result is appended to
+    """
+    with TitrationServer((host, port), titrate, results) as server:
+        logger.info(f"Serving titrations on http://{host}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Stopped serving")
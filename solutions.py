@@ -1,24 +1,15 @@
 # base class for any solution
-from statistics import mean
-from math import exp, log, log10
+from math import log
 from typing import Union
+from functools import wraps
+import copy
+import warnings
 import numpy as np
-from util import *
+from util import get_system_constant
 from ax_maths import k_boltz
-import csv
-import os
-
-try:
-    import gsw
-except:
-
-    def SW_rho():
-        return 1.026
-
-    print(
-        "GSW is not installed, will use a simple formula for seawater density if necessary"
-    )
-
+from auxiliary import registry
+from exceptions import FileMissing
+import profiling
 
 # TODO the point of the properties here is that some vlaues can be (re)calculated on the fly when the nsolution changes,
 # including temperature or adding stuff so that volume and concentartion and ionic strength/salinity changes
@@ -28,8 +19,32 @@ except:
 # TODO implement all constants for all solutions (or void options)
 salinity_aliases = ["salinity", "s", "sal"]
 ionic_strength_aliases = ["ionic strength", "i", "ionic", "ionic_strength"]
-
-nutrient_path = "auxiliary_data/nutrients.csv"
+# nutrients.csv column -> Solution attribute, the table is in umol/kg
+nutrient_attributes = {
+    "silicate": "SiT",
+    "phosphate": "PT",
+    "nitrite": "NO2T",
+    "nitrate": "NO3T",
+    "oxygen": "O2",
+}
+
+
+def cached_constant(method):
+    """
+    Property that is calculated once per state of the solution. The values
+    are dropped by Solution._invalidate, which the setters of everything the
+    constants depend on (S, I, T, t, w0, c) call.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def getter(self):
+        cache = self.__dict__.setdefault("_cache", dict())
+        if name not in cache:
+            cache[name] = method(self)
+        return cache[name]
+
+    return property(getter)
 
 
 class Solution:
@@ -44,19 +59,23 @@ class Solution:
         id: str = "any",
     ):
         self.type = type
+        # defaults, replaced by the nutrients table if id is in there
+        self.SiT = 1e-6
+        self.PT = 0e-6
+        self.NO2T = 0
+        self.NO3T = 0
+        self.O2 = 0
         self.id = id
         # parse salt
         if salt_type.lower() in salinity_aliases:
             self.S = salt_value
         elif salt_type.lower() in ionic_strength_aliases:
             self.I = salt_value
-        # parse temp
-        if temp > 200:
+        # parse temp, can also be an array of temperatures
+        if np.mean(temp) > 200:
             self.T = temp
-            self.t = self.T - 273.15
         else:
             self.t = temp
-            self.T = self.t + 273.15
 
         self.flag = "A"
         self.conc = None
@@ -64,8 +83,6 @@ class Solution:
         self.w0 = None
         self.emf0 = None
         self.CT_degas = 2.5e-6
-        self.SiT = 1e-6
-        self.PT = 0e-6
 
     @property
     def id(self):
@@ -85,6 +102,7 @@ class Solution:
     def S(self, value):
         self._S = value
         self._I = 19.924 * value / (1000 - 1.005 * value)
+        self._invalidate()
 
     @property
     def I(self):
@@ -94,21 +112,81 @@ class Solution:
     def I(self, value):
         self._I = value
         self._S = 1000 * value / (1.005 * value + 19.924)
-
-    @property
+        self._invalidate()
+
+    @property
+    def T(self):
+        return self._T
+
+    @T.setter
+    def T(self, value):
+        self._T = value
+        self._t = value - 273.15
+        self._invalidate()
+
+    @property
+    def t(self):
+        return self._t
+
+    @t.setter
+    def t(self, value):
+        self._t = value
+        self._T = value + 273.15
+        self._invalidate()
+
+    @property
+    def w0(self):
+        return self._w0
+
+    @w0.setter
+    def w0(self, value):
+        self._w0 = value
+        self._invalidate()
+
+    def _invalidate(self):
+        # state changed, cached constants have to be recalculated
+        self.__dict__.pop("_cache", None)
+
+    def at(self, T: np.ndarray = None, S: np.ndarray = None) -> "Solution":
+        """
+        Method to get a copy of the solution at other temperatures and/or
+        salinities, e.g., the temperature of every titration point. All
+        constants of the copy are then arrays, evaluated at every value in
+        one call. The copy keeps the m0 of this solution, since the sample
+        was only weighed once
+
+        Args:
+            T (np.ndarray): temperatures in K
+            S (np.ndarray): salinities
+
+        Returns:
+            Solution: copy with array valued state
+        """
+        solution = copy.copy(self)
+        # the copy would otherwise share the cache dict with this solution
+        solution._invalidate()
+        if T is not None:
+            solution.T = np.asarray(T, dtype=np.float64)
+        if S is not None:
+            solution.S = np.asarray(S, dtype=np.float64)
+        if self.w0 is not None:
+            solution.__dict__.setdefault("_cache", dict())["m0"] = self.m0
+        return solution
+
+    @cached_constant
     def m0(self):
         return self.w0 * ((1 - (0.0012013 / 8)) / (1 - (0.0012013 / self.rho)))
 
-    @property
+    @cached_constant
     def k(self):
         return 8.31451 * self.T / 96484.56
 
-    @property
+    @cached_constant
     def KW(self):
         return 10 ^ -14
 
     # K1 and K2 is assumed very similar in NaCl and KCl, only property of ionic strength
-    @property
+    @cached_constant
     def K1(self):
         # i is the ionic strength that is presumed to be a property of the solution using this version of K1
         # by necessity on H+(free)
@@ -119,13 +197,13 @@ class Solution:
         pK1 = (
             -402.56788
             + 11656.46 / self.T
-            + 72.173 * log(self.T)
+            + 72.173 * np.log(self.T)
             - 0.161325 * self.T
             + 7.5526e-5 * self.T**2
         )
-        return 10 ** -(A + B / self.T + C * log(self.T) + pK1)
+        return 10 ** -(A + B / self.T + C * np.log(self.T) + pK1)
 
-    @property
+    @cached_constant
     def K2(self):
         # i is the ionic strength that is presumed to be a property of the solution using this version of K1
         # by necessity on H+(free)
@@ -133,8 +211,10 @@ class Solution:
         A = 38.2746 * m**0.5 + 1.6057 * m - 0.647 * m**1.5 + 0.113 * m**2
         B = -1738.16 * m**0.5
         C = -6.0346 * m**0.5
-        pK2 = -122.4994 + 5811.18 / self.T + 20.5263 * log(self.T) - 0.0120897 * self.T
-        return 10 ** -(A + B / self.T + C * log(self.T) + pK2)
+        pK2 = (
+            -122.4994 + 5811.18 / self.T + 20.5263 * np.log(self.T) - 0.0120897 * self.T
+        )
+        return 10 ** -(A + B / self.T + C * np.log(self.T) + pK2)
 
     def nutrient(self):
         # TODO maybe a way to get nutrient concentration is if solution is identified
@@ -142,53 +222,56 @@ class Solution:
         # nutrients are 0 (i.e., "any")
         pass
 
-    @property
+    @cached_constant
     def KS(self):
         pass
 
-    @property
+    @cached_constant
     def KF(self):
         pass
 
-    @property
+    @cached_constant
     def KB(self):
         pass
 
-    @property
+    @cached_constant
     def KSi(self):
         pass
 
-    @property
+    @cached_constant
     def KP1(self):
         pass
 
-    @property
+    @cached_constant
     def KP2(self):
         pass
 
-    @property
+    @cached_constant
     def KP3(self):
         pass
 
-    @property
+    @cached_constant
     def KNH4(self):
         pass
 
-    @property
+    @cached_constant
     def KNO2(self):
         pass
 
     def _look_for_nutrients(self):
-        if not os.path.exists(nutrient_path):
+        try:
+            nutrients = registry.table("nutrients")
+        except FileMissing:
+            return
+        # the first row is the generic entry, which keeps the default values
+        if self.id == next(iter(nutrients), None):
             return
-        with open(nutrient_path, newline="") as csvfile:
-            reader = csv.DictReader(csvfile)
-            next(reader)
-            for row in reader:
-                if row and row[reader.fieldnames[0]] == self.id:
-                    self.SiT = float(row["silicate"]) * 1e-6
-                    self.PT = float(row["phosphate"]) * 1e-6
-                    break
+        # looked up even if missing, a later entry for this id changes results
+        row = registry.get("nutrients", self.id)
+        if row is not None:
+            for column, value in row.items():
+                if column in nutrient_attributes and value != "":
+                    setattr(self, nutrient_attributes[column], float(value) * 1e-6)
 
 
 class NaCl(Solution):
@@ -196,7 +279,10 @@ class NaCl(Solution):
     def __init__(self, concentration: float = None):
         super().__init__("NaCl")
         self.c = concentration
-        self.I = self.c  # calculate from concentration
+        # calculate from concentration, left unset without one (the calibration
+        # files only set salt_value and salt_type)
+        if self.c is not None:
+            self.I = self.c
 
         # assume these have not been added
         self.ST = 0
@@ -205,6 +291,15 @@ class NaCl(Solution):
         self.rho = 1
 
     @property
+    def c(self):
+        return self._c
+
+    @c.setter
+    def c(self, value):
+        self._c = value
+        self._invalidate()
+
+    @cached_constant
     def KW(self):
         p00 = 14.83
         p10 = -0.4914
@@ -235,7 +330,10 @@ class KCl(Solution):
     def __init__(self, concentration: float = None):
         super().__init__("KCl")
         self.c = concentration
-        self.I = self.c  # calculate from concentration
+        # calculate from concentration, left unset without one (the calibration
+        # files only set salt_value and salt_type)
+        if self.c is not None:
+            self.I = self.c
 
         # assume these have not been added
         self.ST = 0
@@ -244,6 +342,15 @@ class KCl(Solution):
         self.rho = 1
 
     @property
+    def c(self):
+        return self._c
+
+    @c.setter
+    def c(self, value):
+        self._c = value
+        self._invalidate()
+
+    @cached_constant
     def KW(self):
         p00 = 14.86
         p10 = -1.062
@@ -279,44 +386,44 @@ class SW(Solution):
         self.SiT = 5e-6
         self.PT = 0.5e-6
 
-    @property
+    @cached_constant
     def KW(self):
         # used with H+(tot) --> not the original equation
-        return exp(
+        return np.exp(
             -13847.26 / self.T
             + 148.9652
-            - 23.652 * log(self.T)
-            + (118.67 / self.T - 5.977 + 1.0495 * log(self.T)) * self.S**0.5
+            - 23.652 * np.log(self.T)
+            + (118.67 / self.T - 5.977 + 1.0495 * np.log(self.T)) * self.S**0.5
             - 0.01615 * self.S
         )
 
-    @property
+    @cached_constant
     def K1(self):
         # used with H+(tot)
         return 10 ** (
             -3633.86 / self.T
             + 61.2172
-            - 9.67770 * log(self.T)
+            - 9.67770 * np.log(self.T)
             + 0.011555 * self.S
             - 0.0001152 * self.S**2
         )
 
-    @property
+    @cached_constant
     def K2(self):
         # used with H+(tot)
         return 10 ** (
             -471.78 / self.T
             - 25.9290
-            + 3.16967 * log(self.T)
+            + 3.16967 * np.log(self.T)
             + 0.01781 * self.S
             - 0.0001122 * self.S**2
         )
 
-    @property
+    @cached_constant
     def ST(self):
         return 0.14 / 96.062 * self.S / 1.80655
 
-    @property
+    @cached_constant
     def FT(self):
         return 0.000067 / 18.998 * self.S / 1.80655
 
@@ -338,29 +445,29 @@ class SW(Solution):
     def _BT_lee(self):
         return 0.0002414 / 10.811 * self.S / 1.80655
 
-    @property
+    @cached_constant
     def KS(self):
         # used with H+(free)
-        return exp(
+        return np.exp(
             -4276.1 / self.T
             + 141.328
-            - 23.093 * log(self.T)
-            + (-13856 / self.T + 324.57 - 47.986 * log(self.T)) * self.I**0.5
-            + (35474 / self.T - 771.54 + 114.723 * log(self.T)) * self.I
+            - 23.093 * np.log(self.T)
+            + (-13856 / self.T + 324.57 - 47.986 * np.log(self.T)) * self.I**0.5
+            + (35474 / self.T - 771.54 + 114.723 * np.log(self.T)) * self.I
             - 2698.0 / self.T * self.I**1.5
             + 1776.0 / self.T * self.I**2
-            + log(1 - 0.001005 * self.S)
+            + np.log(1 - 0.001005 * self.S)
         )
 
-    @property
+    @cached_constant
     def KF(self):
         # used with H+(tot)
-        return exp(874.0 / self.T - 9.68 + 0.111 * self.S**0.5)
+        return np.exp(874.0 / self.T - 9.68 + 0.111 * self.S**0.5)
 
-    @property
+    @cached_constant
     def KB(self):
         # used with H+(tot)
-        return exp(
+        return np.exp(
             (
                 -8966.90
                 - 2890.53 * self.S**0.5
@@ -372,60 +479,69 @@ class SW(Solution):
             + 148.0248
             + 137.1942 * self.S**0.5
             + 1.62142 * self.S
-            + (-24.4344 - 25.085 * self.S**0.5 - 0.2474 * self.S) * log(self.T)
+            + (-24.4344 - 25.085 * self.S**0.5 - 0.2474 * self.S) * np.log(self.T)
             + 0.053105 * self.S**0.5 * self.T
         )
 
-    @property
+    @cached_constant
     def KSi(self):
         # from Dickson et al. 2007
-        return exp(
+        return np.exp(
             -8904.2 / self.T
             + 117.385
-            - 19.334 * log(self.T)
+            - 19.334 * np.log(self.T)
             + (-458.79 / self.T + 3.5913) * self.I**0.5
             + (188.74 / self.T - 1.5998) * self.I
             + (-12.1652 / self.T + 0.07871) * self.I**2
-            + log(1 - 0.001005 * self.S)
+            + np.log(1 - 0.001005 * self.S)
         )
 
-    @property
+    @cached_constant
     def KP1(self):
         # from Dickson et al. 2007
-        return exp(
+        return np.exp(
             -4576.752 / self.T
             + 115.525
-            - 18.453 * log(self.T)
+            - 18.453 * np.log(self.T)
             + (-106.736 / self.T + 0.69171) * self.S**0.5
             + (-0.65643 / self.T - 0.01844) * self.S
         )
 
-    @property
+    @cached_constant
     def KP2(self):
         # from Dickson et al. 2007
-        return exp(
+        return np.exp(
             -8814.715 / self.T
             + 172.0883
-            - 27.927 * log(self.T)
+            - 27.927 * np.log(self.T)
             + (-160.340 / self.T + 1.3566) * self.S**0.5
             + (0.37335 / self.T - 0.05778) * self.S
         )
 
-    @property
+    @cached_constant
     def KP3(self):
         # from Dickson et al. 2007
-        return exp(
+        return np.exp(
             -3070.75 / self.T
             - 18.141
             + (17.27039 / self.T + 2.81197) * self.S**0.5
             + (-44.99486 / self.T - 0.09984) * self.S
         )
 
-    @property
+    @cached_constant
     def rho(self):
         """In g/mL"""
+        # gsw is only needed here, importing it up front slows down every start
+        try:
+            import gsw
+        except ImportError:
+            warnings.warn(
+                "GSW is not installed, using a seawater density of 1.026 g/mL"
+            )
+            return 1.026
         absolute_S = self.S  # gsw.SA_from_SP(self.S, 10, 32, -117)
-        return gsw.density.rho(absolute_S, self.t, 0) / 1000
+        with profiling.stage("density"):
+            return gsw.density.rho(absolute_S, self.t, 0) / 1000
 
 
 class Titrant(Solution):
@@ -455,7 +571,22 @@ class Titrant(Solution):
         return lambda weight: weight * a**3 + weight * b**2 + weight * c + d
 
 
+# one row per titration point, Titration keeps all its data in one such buffer
+titration_fields = np.dtype(
+    [
+        ("weight", np.float64),
+        ("emf", np.float64),
+        ("t", np.float64),
+        ("T", np.float64),
+        ("pH_est", np.float64),
+    ]
+)
+
+
 class Titration:
+    # _view: the buffer belongs to another titration (select/window)
+    __slots__ = ("_data", "_pH_envelope", "_view", "titrant", "E0", "k")
+
     def __init__(
         self,
         weight: list[float],
@@ -463,18 +594,167 @@ class Titration:
         temp: Union[float, list[float]],
         titrant: Titrant = None,
     ):
-        self.weight = np.array(weight, dtype=np.float64)
+        weight = np.asarray(weight, dtype=np.float64)
+        self._data = np.empty(len(weight), dtype=titration_fields)
+        self._data["weight"] = weight
         # TODO option to give back mass/air buoyancy corrected, will depend on titrant characteristics
-        self.emf = np.array(emf, dtype=np.float64)
-        if mean(temp) < 100:
-            self.t = np.array(temp, dtype=np.float64)
-            self.T = self.t + 273.15
+        self._data["emf"] = emf
+        temp = np.asarray(temp, dtype=np.float64)
+        if temp.size not in (1, len(weight)):
+            # temperatures not logged per point, e.g., calibration files
+            temp = np.mean(temp)
+        if np.mean(temp) < 100:
+            self._data["t"] = temp
+            self._data["T"] = self._data["t"] + 273.15
+        else:
+            self._data["T"] = temp
+            self._data["t"] = self._data["T"] - 273.15
+        self._pH_envelope = None
+        self._view = False
         self.titrant = titrant
         # estimate pH from system constnats
         self.E0 = get_system_constant("E0")
         self.k = k_boltz(np.mean(self.T))
         self.pH_est = -np.log10(np.exp((self.emf - self.E0) / self.k))
 
+    @classmethod
+    def from_buffer(
+        cls,
+        data: np.ndarray,
+        titrant: Titrant = None,
+        E0: float = None,
+        k: float = None,
+    ) -> "Titration":
+        """
+        Method to make a titration around an existing buffer of
+        titration_fields without copying it, e.g., a slice or a memory map
+
+        Args:
+            data (np.ndarray): structured array of titration_fields
+            titrant (Titrant): titrant used
+            E0 (float): E0 that pH_est in data was calculated with
+            k (float): k that pH_est in data was calculated with
+
+        Returns:
+            Titration: titration viewing data
+        """
+        titration = cls.__new__(cls)
+        titration._data = data
+        titration._pH_envelope = None
+        titration._view = False
+        titration.titrant = titrant
+        titration.E0 = get_system_constant("E0") if E0 is None else E0
+        titration.k = k_boltz(np.mean(data["T"])) if k is None else k
+        return titration
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @property
+    def weight(self) -> np.ndarray:
+        return self._data["weight"]
+
+    @property
+    def emf(self) -> np.ndarray:
+        return self._data["emf"]
+
+    @property
+    def t(self) -> np.ndarray:
+        return self._data["t"]
+
+    @property
+    def T(self) -> np.ndarray:
+        return self._data["T"]
+
+    @property
+    def pH_est(self) -> np.ndarray:
+        return self._data["pH_est"]
+
+    @pH_est.setter
+    def pH_est(self, value):
+        if self._view:
+            # copy on write, the titration this views keeps its pH and E0
+            self._data = self._data.copy()
+            self._view = False
+        self._data["pH_est"] = value
+        self._pH_envelope = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def window_slice(self, pH_low: float, pH_high: float) -> slice:
+        """
+        Method to find the contiguous range of points with pH_low <= pH <=
+        pH_high. The pH of a titration is close to monotonic, so a running
+        min/max of pH_est is monotonic and can be binary searched; it is
+        calculated once per pH estimate, and each window after that costs
+        O(log n). The first and last point of the range are within the
+        bounds; on a noisy curve a point in between can be just outside
+        them, and a point after the range that falls back inside them is
+        left out, where a boolean mask would select it
+
+        Args:
+            pH_low (float): lower pH bound, inclusive
+            pH_high (float): upper pH bound, inclusive
+
+        Returns:
+            slice: range of points in the window
+        """
+        pH = self.pH_est
+        n = len(pH)
+        if n == 0:
+            return slice(0, 0)
+        decreasing = pH[-1] < pH[0]
+        if self._pH_envelope is None:
+            if decreasing:
+                # reversed so that the envelope is always increasing
+                self._pH_envelope = np.minimum.accumulate(pH)[::-1]
+            else:
+                self._pH_envelope = np.maximum.accumulate(pH)
+        start = np.searchsorted(self._pH_envelope, pH_low, side="left")
+        stop = np.searchsorted(self._pH_envelope, pH_high, side="right")
+        if decreasing:
+            start, stop = n - stop, n - start
+        # the envelope can reach the bounds before the pH itself does
+        while start < stop and not pH_low <= pH[start] <= pH_high:
+            start += 1
+        while stop > start and not pH_low <= pH[stop - 1] <= pH_high:
+            stop -= 1
+        return slice(int(start), int(stop))
+
+    def window(self, pH_low: float, pH_high: float) -> "Titration":
+        """
+        Method to get the points with pH_low <= pH <= pH_high as a titration
+        that views the same buffer, i.e., without copying any data
+
+        Args:
+            pH_low (float): lower pH bound, inclusive
+            pH_high (float): upper pH bound, inclusive
+
+        Returns:
+            Titration: view of the points in the window
+        """
+        return self.select(self.window_slice(pH_low, pH_high))
+
+    def select(self, points: slice) -> "Titration":
+        """
+        Method to get a range of points as a titration that views the same
+        buffer. Setting its pH (e.g., recalculate_pH) copies the points
+        first, so this titration is not changed
+
+        Args:
+            points (slice): points to keep
+
+        Returns:
+            Titration: view of the points
+        """
+        titration = Titration.from_buffer(
+            self._data[points], self.titrant, self.E0, self.k
+        )
+        titration._view = True
+        return titration
+
     def recalculate_pH(self, new_E0):
 
         new_pH = self.pH_est + (self.E0 - new_E0) / self.k * log(10)
@@ -0,0 +1,134 @@
+## Telemetry of the AT fits of a batch
+# Every fit in TitrateAX.process_titration records how hard the solver worked
+# (evaluations, final cost, termination) and where it started, as
+# TitrationResult.solver. report() turns the fits of a batch into a summary
+# with text histograms and the slowest samples, and optionally one csv row
+# per file, to find samples that converge badly and to compare solver changes.
+import csv
+import sys
+from collections import Counter, namedtuple
+import numpy as np
+
+SolverStats = namedtuple(
+    "SolverStats",
+    [
+        "solver",
+        "nfev",
+        "njev",
+        "cost",
+        "status",
+        "message",
+        "f0",
+        "AT0",
+        "seconds",
+    ],
+)
+
+stats_columns = ["file", "sample_id", *SolverStats._fields]
+
+
+def from_result(solver: str, result, x0: list, seconds: float) -> SolverStats:
+    """
+    Method to get the telemetry of one fit
+
+    Args:
+        solver (str): solver name, gn or lm
+        result: AT_solution or scipy OptimizeResult
+        x0 (list): starting point (f, AT)
+        seconds (float): wall time of the fit
+
+    Returns:
+        SolverStats: telemetry of the fit
+    """
+    return SolverStats(
+        solver,
+        int(result.nfev),
+        None if result.njev is None else int(result.njev),
+        float(result.cost),
+        int(result.status),
+        str(result.message),
+        float(x0[0]),
+        float(x0[1]),
+        seconds,
+    )
+
+
+def _histogram(values: np.ndarray, label: str, output, bins: int = 10, log=False):
+    # one line per bin, bar length relative to the fullest bin
+    print(f"{label}:", file=output)
+    if log:
+        values = values[values > 0]
+    if not len(values):
+        print("  no values", file=output)
+        return
+    low, high = values.min(), values.max()
+    if low == high:
+        edges = np.array([low, high])
+    elif log:
+        edges = np.geomspace(low, high, bins + 1)
+    else:
+        edges = np.linspace(low, high, bins + 1)
+    counts, edges = np.histogram(values, edges)
+    scale = 40 / counts.max()
+    for count, start, end in zip(counts, edges[:-1], edges[1:]):
+        print(
+            f"  {start:>10.4g} - {end:<10.4g} {count:>7} {'#' * int(np.ceil(count * scale))}",
+            file=output,
+        )
+
+
+def report(results: list, csv_path: str = None, slowest: int = 5, output=sys.stderr):
+    """
+    Method to print the solver telemetry of a batch and optionally write it
+    to a csv file, one row per fitted file
+
+    Args:
+        results (list): TitrationResult of the batch, files without a fit are skipped
+        csv_path (str): optional csv file for the telemetry of every fit
+        slowest (int): number of samples with the most evaluations to list
+        output: stream for the summary
+    """
+    fitted = [result for result in results if result.solver is not None]
+    if csv_path:
+        with open(csv_path, "w", newline="") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=stats_columns)
+            writer.writeheader()
+            for result in fitted:
+                writer.writerow(
+                    {
+                        "file": result.file,
+                        "sample_id": result.sample_id,
+                        **result.solver._asdict(),
+                    }
+                )
+    print(
+        f"Solver telemetry of {len(fitted)} fits ({len(results) - len(fitted)} files without a fit)",
+        file=output,
+    )
+    if not fitted:
+        return
+    stats = [result.solver for result in fitted]
+    nfev = np.array([stat.nfev for stat in stats])
+    seconds = np.array([stat.seconds for stat in stats])
+    cost = np.array([stat.cost for stat in stats])
+    print(
+        f"  nfev mean {nfev.mean():.1f}, median {np.median(nfev):.0f}, max {nfev.max()}; "
+        f"time mean {seconds.mean()*1e3:.3f} ms, total {seconds.sum():.3f} s",
+        file=output,
+    )
+    for (status, message), count in Counter(
+        (stat.status, stat.message) for stat in stats
+    ).most_common():
+        print(f"  status {status:>2} {count:>7}  {message}", file=output)
+    _histogram(nfev, "residual evaluations", output)
+    _histogram(seconds * 1e3, "wall time (ms)", output)
+    _histogram(cost, "final cost", output, log=True)
+    print("most evaluations:", file=output)
+    for index in np.argsort(-nfev, kind="stable")[:slowest]:
+        stat = stats[index]
+        print(
+            f"  {fitted[index].file}: nfev {stat.nfev}, {stat.seconds*1e3:.3f} ms, "
+            f"cost {stat.cost:.3g}, x0 = ({stat.f0:.4f}, {stat.AT0*1e6:.2f} umol/kg), "
+            f"{stat.message}",
+            file=output,
+        )
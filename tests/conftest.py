@@ -0,0 +1,13 @@
+# The modules live in the repository root and find auxiliary_data/ relative
+# to the working directory, so the tests import from and run in the root.
+import os
+import sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    monkeypatch.chdir(root)
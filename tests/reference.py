@@ -0,0 +1,70 @@
+## Reference implementations the tests compare against
+# The row-list parser read_titration_file replaced, and one least_squares
+# call per titration as TitrateAX(solver="lm") fits. The benchmarks time
+# the same references.
+import csv
+from functools import partial
+import numpy as np
+from scipy.optimize import least_squares
+from ax_maths import AT_jacobian, AT_residuals, estimate_AT_E0, find_data_in_range
+from extract_data import datatypes, titration_data
+
+
+def legacy_read_titration_file(filename: str) -> tuple[list, dict, dict]:
+    # the parser used before read_titration_file: list of rows, transposed
+    # with zip(*rows) and typecast cell by cell from datatypes
+    with open(filename, "r") as datafile:
+        csvreader = csv.reader(datafile)
+        sample_info = next(csvreader)
+        fwd_data = list()
+        bwd_data = list()
+        for row in csvreader:
+            if "BWD" in row:
+                break
+            fwd_data.append(row)
+        for row in csvreader:
+            bwd_data.append(row)
+    typecast = list()
+    for data in (fwd_data, bwd_data):
+        processed = dict(zip(datatypes.keys(), map(list, zip(*data))))
+        typecast.append(
+            {
+                key: [datatypes[key](value) for value in values]
+                for key, values in processed.items()
+            }
+        )
+    return sample_info, typecast[0], typecast[1]
+
+
+def prepare_problems(files: list) -> tuple[list, np.ndarray]:
+    # (sample, titration) pairs and starting points, as in TitrateAX
+    problems = list()
+    x0 = list()
+    for file in files:
+        sample, HCl_titration_data, _ = titration_data(file)
+        indices = find_data_in_range(3, 3.5, HCl_titration_data.pH_est)
+        AT_est, _ = estimate_AT_E0(
+            HCl_titration_data.weight[indices],
+            HCl_titration_data.emf[indices],
+            np.mean(HCl_titration_data.T[indices]),
+            sample.m0,
+            HCl_titration_data.titrant.concentration,
+        )
+        problems.append((sample, HCl_titration_data))
+        x0.append((1, AT_est))
+    return problems, np.array(x0)
+
+
+def fit_one_by_one(problems: list, x0: np.ndarray) -> np.ndarray:
+    x = np.empty_like(x0)
+    for i, (sample, titration) in enumerate(problems):
+        x[i] = least_squares(
+            fun=partial(AT_residuals, sample=sample, titration=titration),
+            x0=x0[i],
+            jac=partial(AT_jacobian, sample=sample, titration=titration),
+            method="lm",
+            xtol=1e-15,
+            ftol=1e-15,
+            gtol=1e-15,
+        ).x
+    return x
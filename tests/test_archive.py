@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import archive as archive_module
+from archive import TitrationArchive
+from benchmarks.fixtures import write_ax_files
+from extract_data import read_titration_file
+from solutions import titration_fields
+
+
+def test_archive_round_trip(tmp_path, monkeypatch):
+    files = write_ax_files(str(tmp_path / "ax"), 2)
+    archive = TitrationArchive(str(tmp_path / "archive"))
+    parsed = list()
+
+    def reader(filename):
+        parsed.append(filename)
+        return read_titration_file(filename)
+
+    monkeypatch.setattr(archive_module, "read_titration_file", reader)
+    assert archive.add(files) == 2
+    assert archive.add(files) == 0
+    # every file is parsed once
+    assert sorted(parsed) == sorted(os.path.abspath(file) for file in files)
+
+    entry = archive.find(sample_id="SW1", direction="bwd")[0]
+    _, _, bwd_data = read_titration_file(files[1])
+    raw = archive.raw(entry)
+    assert raw["time"].astype(str).tolist() == bwd_data["time"].tolist()
+    for column in bwd_data.dtype.names[1:]:
+        np.testing.assert_array_equal(raw[column], bwd_data[column])
+    assert len(archive.titration(entry)) == len(bwd_data)
+    # the time column does not dominate the raw records
+    assert os.path.getsize(archive.raw_path) < 2 * os.path.getsize(archive.curves_path)
+
+
+def test_archive_recovers_from_interrupted_add(tmp_path):
+    files = write_ax_files(str(tmp_path / "ax"), 3)
+    folder = str(tmp_path / "archive")
+    TitrationArchive(folder).add(files[:1])
+    # an add that stopped after part of the curves and half an index row
+    with open(os.path.join(folder, "curves.bin"), "ab") as curvesfile:
+        curvesfile.write(b"\0" * 100)
+    with open(os.path.join(folder, "index.csv"), "a") as indexfile:
+        indexfile.write(f"{os.path.abspath(files[1])},")
+
+    archive = TitrationArchive(folder)
+    assert len(archive.entries) == 2
+    assert archive.add(files) == 2
+
+    archive = TitrationArchive(folder)
+    assert len(archive.entries) == 6
+    records = os.path.getsize(archive.curves_path) // titration_fields.itemsize
+    assert records == sum(entry["length"] for entry in archive.entries)
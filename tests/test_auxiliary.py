@@ -0,0 +1,51 @@
+import glob
+import multiprocessing
+import os
+import shutil
+from auxiliary import AuxiliaryTables
+
+
+def copy_tables(tmp_path):
+    folder = str(tmp_path / "auxiliary_data")
+    shutil.copytree("auxiliary_data", folder)
+    return AuxiliaryTables(folder + os.sep), folder
+
+
+def test_update_keeps_the_layout(tmp_path):
+    tables, folder = copy_tables(tmp_path)
+    before = {path: open(path, "rb").read() for path in glob.glob(f"{folder}/*.csv")}
+    tables.update("HCl_summary", {"A20": {"c": "0.99883"}})
+    tables.update("system_constants", {"E0": {"value": "0.41"}})
+    tables.update("nutrients", {"any": {"oxygen": "0"}})
+    tables.update("burette_density", {"dosimat 12": {"x0": "0"}})
+
+    for path, content in before.items():
+        assert open(path, "rb").read() == content, path
+
+
+def test_update_escapes_values(tmp_path):
+    tables, _ = copy_tables(tmp_path)
+    tables.update("NaOH_summary", {"J": {"c": "0.0687,checked"}})
+
+    assert tables.row("NaOH_summary", "J")["c"] == "0.0687,checked"
+    assert tables.row("NaOH_summary", "J")["I"] == 0.7
+
+
+def update_column(folder, column):
+    AuxiliaryTables(folder + os.sep).update("NaOH_summary", {"K": {column: "1"}})
+
+
+def test_concurrent_updates_are_all_kept(tmp_path):
+    tables, folder = copy_tables(tmp_path)
+    columns = ["x1", "x2", "x3", "x4", "x5"]
+    processes = [
+        multiprocessing.Process(target=update_column, args=(folder, column))
+        for column in columns
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    row = tables.row("NaOH_summary", "K")
+    assert [row[column] for column in columns] == [1.0] * len(columns)
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+from functools import partial
+from ax_maths import (
+    AT_distribution,
+    AT_jacobian,
+    AT_monte_carlo,
+    AT_residuals,
+    ATSolver,
+    best_linear_window,
+    estimate_AT_E0,
+    fit_AT_batch,
+)
+from benchmarks.fixtures import write_ax_file, write_ax_files
+from extract_data import titration_data
+from tests.reference import fit_one_by_one, prepare_problems
+from titrate_ax import TitrateAX
+
+
+@pytest.fixture(scope="module")
+def problems(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp("ax"))
+    # one shorter titration, so the batch has to be padded
+    files = write_ax_files(folder, 5) + [write_ax_file(folder, 5, n_fwd=40)]
+    return prepare_problems(files)
+
+
+def test_fit_AT_batch_matches_least_squares(problems):
+    problems, x0 = problems
+    expected = fit_one_by_one(problems, x0)
+    fit = fit_AT_batch(problems, x0)
+
+    assert fit.converged.all()
+    # AT within 0.001 umol/kg
+    np.testing.assert_allclose(fit.AT, expected[:, 1], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(fit.f, expected[:, 0], rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("point_temperature", [True, False])
+def test_gauss_newton_matches_least_squares(tmp_path, point_temperature):
+    files = write_ax_files(str(tmp_path), 4)
+    gn = TitrateAX(solver="gn", point_temperature=point_temperature)
+    lm = TitrateAX(solver="lm", point_temperature=point_temperature)
+    for file in files:
+        expected = lm.process_titration(file)
+        result = gn.process_titration(file)
+        assert result.AT == pytest.approx(expected.AT, rel=0, abs=1e-9)
+        assert result.f == pytest.approx(expected.f, rel=0, abs=1e-6)
+        assert result.E0 == pytest.approx(expected.E0, rel=0, abs=1e-8)
+
+
+def test_best_linear_window_skips_points_before_the_kink():
+    x = np.linspace(0, 1, 41)
+    # falls until x = 0.25 (index 10), then rises on a straight line
+    y = np.where(x < 0.25, 0.3 - x, 2 * (x - 0.25))
+    noise = np.random.default_rng(0).normal(0, 2e-3, len(x))
+
+    assert best_linear_window(x, y) == (10, 41)
+    assert best_linear_window(x, y + noise) == (10, 41)
+    # the point where the line crosses zero is not above it
+    assert best_linear_window(x, y, above=0) == (11, 41)
+
+
+def test_best_linear_window_stops_at_a_plateau():
+    x = np.linspace(0, 1, 41)
+    # straight until x = 0.7 (index 28), flat after
+    start, stop = best_linear_window(x, np.minimum(3 * x, 2.1))
+
+    assert start == 0
+    assert stop in (29, 30)
+
+
+def test_best_linear_window_too_few_points():
+    assert best_linear_window([0, 1, 2], [0, 1, 4], min_points=5) == (0, 3)
+
+
+@pytest.fixture(scope="module")
+def titration(tmp_path_factory):
+    file = write_ax_file(str(tmp_path_factory.mktemp("mc")))
+    sample, fwd, _ = titration_data(file)
+    return sample.at(T=np.mean(fwd.T)), fwd
+
+
+@pytest.mark.parametrize("auto_window", [False, True])
+def test_AT_monte_carlo_is_reproducible(titration, auto_window):
+    sample, fwd = titration
+    window = fwd.window_slice(3, 3.5)
+    first = AT_monte_carlo(sample, fwd, window, 50, seed=1, auto_window=auto_window)
+    second = AT_monte_carlo(sample, fwd, window, 50, seed=1, auto_window=auto_window)
+    other = AT_monte_carlo(sample, fwd, window, 50, seed=2, auto_window=auto_window)
+
+    assert first.converged.all()
+    for field in AT_distribution._fields:
+        np.testing.assert_array_equal(getattr(first, field), getattr(second, field))
+    assert not np.array_equal(first.AT, other.AT)
+
+
+def test_AT_monte_carlo_spread_follows_the_noise(titration):
+    sample, fwd = titration
+    window = fwd.window_slice(3, 3.5)
+    # only the emf is perturbed
+    quiet = {"concentration": 0, "burette": 0, "emf": 1e-5, "constants": 0}
+    loud = dict(quiet, emf=1e-4)
+    std_quiet = np.std(AT_monte_carlo(sample, fwd, window, 200, 1, quiet).AT)
+    std_loud = np.std(AT_monte_carlo(sample, fwd, window, 200, 1, loud).AT)
+
+    assert std_quiet > 0
+    # the fit is linear at this scale, ten times the noise is ten times the spread
+    assert std_loud / std_quiet == pytest.approx(10, rel=0.1)
+
+
+def test_auto_window_estimate(tmp_path, monkeypatch):
+    import titrate_ax
+
+    calls = []
+
+    def spy(mass, emf, T, m0, titrant_conc, auto_window=False):
+        calls.append((len(mass), auto_window))
+        return estimate_AT_E0(mass, emf, T, m0, titrant_conc, auto_window)
+
+    monkeypatch.setattr(titrate_ax, "estimate_AT_E0", spy)
+    file = write_ax_file(str(tmp_path))
+    auto = TitrateAX(auto_window=True).process_titration(file)
+    fixed = TitrateAX().process_titration(file)
+
+    # the whole forward titration goes in, the estimate chooses the window
+    assert calls[0] == (60, True)
+    assert calls[1][1] is False and calls[1][0] < 60
+    # both estimates lead to the same least squares minimum
+    assert auto.AT == pytest.approx(fixed.AT, rel=0, abs=1e-9)
+
+
+def test_gauss_newton_needs_fewer_evaluations(tmp_path):
+    from scipy.optimize import least_squares
+
+    for file in write_ax_files(str(tmp_path), 4):
+        sample, fwd, _ = titration_data(file)
+        good = fwd.select(fwd.window_slice(3, 3.5))
+        AT_est, _ = estimate_AT_E0(
+            good.weight,
+            good.emf,
+            np.mean(good.T),
+            sample.m0,
+            fwd.titrant.concentration,
+        )
+        sample = sample.at(T=np.mean(fwd.T))
+        x0 = [1, AT_est]
+        gn = ATSolver(sample, fwd).solve(x0)
+        # the least squares of TitrateAX(solver="lm")
+        lm = least_squares(
+            fun=partial(AT_residuals, sample=sample, titration=fwd),
+            x0=x0,
+            jac=partial(AT_jacobian, sample=sample, titration=fwd),
+            method="lm",
+            xtol=1e-15,
+            ftol=1e-15,
+            gtol=1e-15,
+        )
+
+        assert gn.x[1] == pytest.approx(lm.x[1], rel=0, abs=1e-9)
+        assert gn.nfev < lm.nfev
+        assert gn.njev < lm.njev
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from benchmarks.fixtures import write_calibration_files
+from calibrate_NaOH import CalibrateNaOH
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def test_workers_match_one_process(tmp_path, workers):
+    files = write_calibration_files(str(tmp_path), n_files=6)
+    calibrate = CalibrateNaOH(str(tmp_path), "NaCl-0-", file_extension="csv")
+    expected = calibrate.calibrate()
+    parallel = CalibrateNaOH(
+        str(tmp_path), "NaCl-0-", file_extension="csv", workers=workers
+    )
+    result = parallel.calibrate()
+
+    assert expected.files == len(files)
+    assert np.isfinite(expected.concentration)
+    # the same file reads in another process, the reduction is unchanged
+    assert result == expected
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from benchmarks.fixtures import write_ax_file
+from tests.reference import legacy_read_titration_file
+from extract_data import (
+    correct_burette_volume,
+    datatypes,
+    read_titration_file,
+    v_to_w,
+    volumes_to_weights,
+)
+
+
+@pytest.mark.parametrize("n_bwd", [30, 0])
+def test_read_titration_file_matches_legacy_parser(tmp_path, n_bwd):
+    filename = write_ax_file(str(tmp_path), n_fwd=25, n_bwd=n_bwd, seed=1)
+    sample_info, fwd_data, bwd_data = read_titration_file(filename)
+    legacy_info, legacy_fwd, legacy_bwd = legacy_read_titration_file(filename)
+
+    assert sample_info == legacy_info
+    assert len(fwd_data) == 25
+    assert len(bwd_data) == n_bwd
+    for data, legacy in ((fwd_data, legacy_fwd), (bwd_data, legacy_bwd)):
+        for column, values in legacy.items():
+            if datatypes[column] is str:
+                assert data[column].tolist() == values
+            else:
+                np.testing.assert_array_equal(data[column], values)
+
+
+def test_volumes_to_weights_matches_one_by_one(tmp_path):
+    sections = list()
+    for index in range(3):
+        file = write_ax_file(str(tmp_path), index, n_fwd=20 + index, seed=index)
+        sample_info, fwd_data, bwd_data = read_titration_file(file)
+        sections.append((fwd_data["volume"], fwd_data["t_HCl"], "HCl", sample_info[7]))
+        sections.append(
+            (bwd_data["volume"], bwd_data["t_NaOH"], "NaOH", sample_info[6])
+        )
+    # an empty section and plain lists keep their place
+    sections.insert(1, ([], [], "HCl", sections[0][3]))
+    sections.append(([1.5, 0.25], [20.1, 24.9], "NaOH", sections[2][3]))
+
+    weights = volumes_to_weights("dosimat 12", sections)
+
+    assert len(weights) == len(sections)
+    for weight, (volume, temperature, titrant, id) in zip(weights, sections):
+        expected = v_to_w(
+            correct_burette_volume("dosimat 12", volume), temperature, titrant, id
+        )
+        np.testing.assert_array_equal(weight, expected)
+    assert volumes_to_weights("dosimat 12", []) == []
@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pytest
+import parse_cache
+from benchmarks.fixtures import write_ax_file
+from extract_data import read_titration_file
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(parse_cache, "folder", None)
+    parse_cache.enable(str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+class CountingReader:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, filename):
+        self.calls += 1
+        return read_titration_file(filename)
+
+
+def test_cache_hit(tmp_path, cache):
+    filename = write_ax_file(str(tmp_path))
+    reader = CountingReader()
+    parse_cache.load(filename, reader).save()
+    cached = parse_cache.load(filename, reader)
+
+    assert reader.calls == 1
+    assert len(os.listdir(cache)) == 1
+    sample_info, fwd_data, bwd_data = read_titration_file(filename)
+    assert cached.sample_info == sample_info
+    np.testing.assert_array_equal(cached.fwd_data, fwd_data)
+    np.testing.assert_array_equal(cached.bwd_data, bwd_data)
+
+
+def test_touched_file_keeps_entry(tmp_path, cache):
+    filename = write_ax_file(str(tmp_path))
+    reader = CountingReader()
+    parse_cache.load(filename, reader).save()
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    parse_cache.load(filename, reader).save()
+    parse_cache.load(filename, reader)
+
+    assert reader.calls == 1
+
+
+def test_changed_file_is_parsed_again(tmp_path, cache):
+    filename = write_ax_file(str(tmp_path), seed=1)
+    reader = CountingReader()
+    parse_cache.load(filename, reader).save()
+    # same name and length, other emf noise
+    write_ax_file(str(tmp_path), seed=2)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    cached = parse_cache.load(filename, reader)
+
+    assert reader.calls == 2
+    np.testing.assert_array_equal(cached.fwd_data, read_titration_file(filename)[1])
+
+
+def test_derived_array_follows_dependencies(tmp_path, cache):
+    filename = write_ax_file(str(tmp_path))
+    computed = list()
+
+    def weights(scale):
+        def compute():
+            computed.append(scale)
+            return np.arange(3) * scale
+
+        return compute
+
+    parsed = parse_cache.load(filename, read_titration_file)
+    parsed.get("weights", weights(1.0), 1.0)
+    parsed.save()
+    cached = parse_cache.load(filename, read_titration_file)
+    np.testing.assert_array_equal(cached.get("weights", weights(1.0), 1.0), [0, 1, 2])
+    assert computed == [1.0]
+
+    # e.g., new density coefficients
+    np.testing.assert_array_equal(cached.get("weights", weights(2.0), 2.0), [0, 2, 4])
+    assert computed == [1.0, 2.0]
+    assert cached.modified
@@ -0,0 +1,30 @@
+import tracemalloc
+from collections import defaultdict
+import pytest
+import profiling
+
+
+@pytest.fixture
+def profile(monkeypatch):
+    # profiling on for one test, with records of its own
+    monkeypatch.setattr(profiling, "enabled", False)
+    monkeypatch.setattr(profiling, "_records", defaultdict(lambda: [0.0, 0, 0]))
+    was_tracing = tracemalloc.is_tracing()
+    profiling.enable()
+    yield
+    if not was_tracing:
+        tracemalloc.stop()
+
+
+def test_nested_stage_keeps_outer_peak(profile):
+    with profiling.stage("outer", "file"):
+        data = bytearray(20 * 2**20)
+        del data
+        with profiling.stage("inner"):
+            small = bytearray(2**10)
+            del small
+    records = profiling.pop("file")
+
+    assert records["outer"][2] >= 20 * 2**20
+    assert records["inner"][2] < 2**20
+    assert records["outer"][1] == records["inner"][1] == 1
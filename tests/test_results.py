@@ -0,0 +1,49 @@
+import csv
+from benchmarks.fixtures import write_ax_files
+from results import results_columns
+from titrate_ax import TitrateAX
+
+# header of results files written before dependencies were recorded
+old_columns = [
+    "sample_id",
+    "file",
+    "file_hash",
+    "params_hash",
+    "f",
+    "AT",
+    "E0",
+    "fit_quality",
+    "flag",
+    "error",
+]
+
+
+def read_results(path):
+    with open(path, newline="") as csvfile:
+        reader = csv.DictReader(csvfile)
+        return reader.fieldnames, list(reader)
+
+
+def test_reprocess_changed_with_old_header(tmp_path):
+    folder = tmp_path / "ax"
+    files = write_ax_files(str(folder), 3)
+    results = str(tmp_path / "results.csv")
+    TitrateAX(str(folder), results=results).titrate()
+    # the same results as an older version would have written them
+    _, rows = read_results(results)
+    with open(results, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=old_columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+    # no record of the auxiliary rows used, so every file is done again
+    reprocessed = TitrateAX(str(folder), results=results).reprocess(changed=True)
+    assert sorted(result.file for result in reprocessed) == sorted(files)
+    columns, rows = read_results(results)
+    assert set(results_columns) <= set(columns)
+    assert len(rows) == 6
+    assert all(row["dependencies"] for row in rows[3:])
+
+    # now they are recorded and nothing has changed since
+    assert TitrateAX(str(folder), results=results).reprocess(changed=True) == []
+    assert len(read_results(results)[1]) == 6
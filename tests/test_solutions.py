@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from ax_maths import find_data_in_range
+from benchmarks.fixtures import write_ax_files
+from extract_data import titration_data
+from solutions import SW
+
+pH_ranges = [(3, 3.5), (9, 10.5), (2, 12), (5, 6)]
+
+
+def titrations(folder, noise):
+    for file in write_ax_files(str(folder), 5, noise=noise):
+        _, fwd, bwd = titration_data(file)
+        yield fwd
+        yield bwd
+
+
+def test_window_matches_mask_selection(tmp_path):
+    for titration in titrations(tmp_path, 5e-5):
+        for pH_low, pH_high in pH_ranges:
+            window = titration.window_slice(pH_low, pH_high)
+            mask = find_data_in_range(pH_low, pH_high, titration.pH_est)
+            np.testing.assert_array_equal(np.arange(window.start, window.stop), mask)
+
+
+def test_window_on_noisy_curves(tmp_path):
+    # 0.5 mV noise, the pH goes back and forth near the bounds
+    for titration in titrations(tmp_path, 5e-4):
+        pH = titration.pH_est
+        for pH_low, pH_high in pH_ranges:
+            window = titration.window_slice(pH_low, pH_high)
+            mask = find_data_in_range(pH_low, pH_high, pH)
+            if not len(mask):
+                assert window.start == window.stop
+                continue
+            assert window.start == mask[0]
+            assert pH_low <= pH[window.start] <= pH_high
+            assert pH_low <= pH[window.stop - 1] <= pH_high
+            # points in the window but outside the bounds are noise at a bound
+            outside = pH[window][(pH[window] < pH_low) | (pH[window] > pH_high)]
+            assert np.all(
+                np.minimum(abs(outside - pH_low), abs(outside - pH_high)) < 0.05
+            )
+
+
+def test_recalculate_pH_of_a_window_leaves_the_titration(tmp_path):
+    file = write_ax_files(str(tmp_path), 1)[0]
+    _, titration, _ = titration_data(file)
+    pH = titration.pH_est.copy()
+    E0 = titration.E0
+    window = titration.window(3, 3.5)
+    assert len(window)
+    window_pH = window.pH_est.copy()
+
+    window.recalculate_pH(E0 + 0.001)
+
+    np.testing.assert_array_equal(titration.pH_est, pH)
+    assert titration.E0 == E0
+    assert window.E0 == E0 + 0.001
+    assert np.all(window.pH_est < window_pH)
+    points = titration.window_slice(3, 3.5)
+    np.testing.assert_array_equal(window.weight, titration.weight[points])
+
+
+def seawater(S, t, w0):
+    sample = SW()
+    sample.S = S
+    sample.t = t
+    sample.w0 = w0
+    return sample
+
+
+constants = ["rho", "m0", "k", "KW", "KS", "KF", "K1", "K2", "KB"]
+
+
+@pytest.mark.parametrize(
+    "change", [{"S": 30}, {"t": 15}, {"w0": 90}, {"T": 300.15}, {"I": 0.6}]
+)
+def test_constants_follow_the_state(change):
+    sample = seawater(35, 25, 100)
+    before = {name: getattr(sample, name) for name in constants}
+    for name, value in change.items():
+        setattr(sample, name, value)
+    fresh = seawater(sample.S, sample.t, sample.w0)
+
+    # every cached value is the one of a solution made in the new state
+    for name in constants:
+        assert getattr(sample, name) == getattr(fresh, name), name
+    changed = {name for name in constants if getattr(sample, name) != before[name]}
+    if "w0" in change:
+        assert changed == {"m0"}
+    else:
+        assert {"rho", "m0", "KW"} <= changed
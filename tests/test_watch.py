@@ -0,0 +1,47 @@
+from collections import Counter
+from concurrent.futures import Future
+import titrate_ax
+from benchmarks.fixtures import write_ax_file
+from titrate_ax import TitrateAX
+
+
+class StopAfter:
+    # stands in for time.sleep, ends the watch after a number of polls
+    def __init__(self, polls):
+        self.polls = polls
+
+    def __call__(self, seconds):
+        self.polls -= 1
+        if not self.polls:
+            raise KeyboardInterrupt
+
+
+def test_watch_reads_each_file_state_once(tmp_path, monkeypatch):
+    folder = tmp_path / "ax"
+    folder.mkdir()
+    complete = write_ax_file(str(folder), 0)
+    # abandoned after the BWD marker
+    incomplete = write_ax_file(str(folder), 1, n_bwd=0)
+    reads = Counter()
+    is_complete = TitrateAX._is_complete
+
+    def counting(self, file):
+        reads[file] += 1
+        return is_complete(self, file)
+
+    monkeypatch.setattr(TitrateAX, "_is_complete", counting)
+    monkeypatch.setattr(titrate_ax.time, "sleep", StopAfter(10))
+    results = tmp_path / "results.csv"
+    TitrateAX(str(folder), results=str(results)).watch(settle_time=0)
+
+    assert reads == {complete: 1, incomplete: 1}
+    assert len(results.read_text().splitlines()) == 2
+
+
+def test_failed_worker_is_logged(caplog):
+    future = Future()
+    future.set_exception(RuntimeError("worker died"))
+
+    TitrateAX()._report_future(future, None, None, None)
+
+    assert "worker died" in caplog.text
@@ -1,53 +1,88 @@
-import argparse
 from exceptions import TitrationDataMissing
+import csv
 import os, sys
+import json
+import time
 from util import get_matching_files
-from extract_data import titration_data
+from extract_data import datatypes, titration_data
 import logging
 from solutions import *
-import math
 import numpy as np
-from scipy.stats import linregress
 from ax_maths import *
 from functools import partial
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from auxiliary import registry
+import profiling
+import solver_stats
+from results import ResultsSink, file_hash, latest_results, parameters_hash
 
-
-from scipy.optimize import least_squares, root
-
+# handlers are set up by the command line entry point (cli.py)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.DEBUG)
-
-# Create a formatter
-formatter = logging.Formatter("%(levelname)s - %(message)s")
 
-# Set the formatter for the stream handler
-stream_handler.setFormatter(formatter)
-
-# Add the stream handler to the logger
-logger.addHandler(stream_handler)
+TitrationResult = namedtuple(
+    "TitrationResult",
+    [
+        "file",
+        "sample_id",
+        "flag",
+        "f",
+        "AT",
+        "E0",
+        "fit_quality",
+        "error",
+        "uncertainty",
+        "profile",
+        "solver",
+        "dependencies",
+    ],
+    # AT_distribution of the Monte Carlo replicates, if requested, the
+    # profiling records of the file, if profiling is on, the
+    # solver_stats.SolverStats of the fit, and the auxiliary rows used as
+    # table name -> id -> fingerprint
+    defaults=[None, None, None, None],
+)
 
 
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-
-parser.add_argument(
-    "-p",
-    "--path",
-    help="path to one file or all files in a folder",
-    default=argparse.SUPPRESS,
-)
-args = parser.parse_args()
+def _init_worker():
+    # load the auxiliary tables once per worker instead of once per file
+    registry.warm()
 
 
 class TitrateAX:
     def __init__(
         self,
         path: str = None,
+        workers: int = 1,
+        results: str = None,
+        solver: str = "gn",
+        point_temperature: bool = True,
+        auto_window: bool = False,
+        replicates: int = 0,
+        seed: int = None,
+        solver_stats: bool = False,
+        solver_stats_csv: str = None,
     ):
         logger.info("Let's measure AX!!!\n")
+        self.workers = workers
+        self.results = results
+        self.burette_id = "dosimat 12"
+        self.pH_range = (3, 3.5)
+        self.solver = solver
+        self.point_temperature = point_temperature
+        self.auto_window = auto_window
+        self.replicates = replicates
+        self.seed = seed
+        self.solver_stats = solver_stats or bool(solver_stats_csv)
+        self.solver_stats_csv = solver_stats_csv
         # initialize
-        if os.path.isfile(path):
+        if path is None:
+            # no input of its own, files are passed to process_titration
+            # one at a time, e.g., by the server
+            self.file = None
+            self.path = None
+        elif os.path.isfile(path):
             logger.info(f"Processing single file {path}")
             self.file = path
             self.path = None
@@ -65,61 +100,423 @@ class TitrateAX:
             titration_files = self._process_inputs()
         logger.info(f"Number of files slated for processing: {len(titration_files)}")
 
-        for file in titration_files:
-            self.process_titration(file)
+        sink = None
+        params_hash = None
+        hashes = None
+        if self.results:
+            sink = ResultsSink(self.results)
+            params_hash = parameters_hash(self.parameters)
+            hashes = {file: file_hash(file) for file in titration_files}
+            remaining = [
+                file
+                for file in titration_files
+                if not sink.is_done(hashes[file], params_hash)
+            ]
+            if len(remaining) < len(titration_files):
+                logger.info(
+                    f"Skipping {len(titration_files) - len(remaining)} files that already have results in {self.results}"
+                )
+            titration_files = remaining
+        return self._process_and_report(titration_files, sink, params_hash, hashes)
+
+    def reprocess(self, changed: bool = True):
+        """
+        Processes the files of the results file again and appends the new
+        results, which replace the old ones. With changed, only files whose
+        last result used auxiliary rows (titrants, burette, nutrients, system
+        constants) that have changed since, that have no record of them, or
+        that failed
+
+        Args:
+            changed (bool): only files affected by changes of the auxiliary tables
+
+        Returns:
+            list: TitrationResult of the processed files
+        """
+        if not self.results:
+            raise FileNotFoundError("Reprocessing needs the results file (-o)")
+        params_hash = parameters_hash(self.parameters)
+        latest = latest_results(self.results, params_hash)
+        titration_files = list()
+        # reason -> number of files
+        reasons = Counter()
+        # table name -> id -> current fingerprint, shared by all files
+        fingerprints = dict()
+        for file, row in latest.items():
+            if not os.path.isfile(file):
+                logger.warning(f"{file} is no longer there, not reprocessed")
+                continue
+            if not changed:
+                titration_files.append(file)
+            elif row.get("error"):
+                # may have failed on the auxiliary data, e.g., a missing entry
+                reasons["failed last time"] += 1
+                titration_files.append(file)
+            elif not row.get("dependencies"):
+                reasons["no record of the auxiliary data used"] += 1
+                titration_files.append(file)
+            else:
+                changes = registry.changed(
+                    json.loads(row["dependencies"]), fingerprints
+                )
+                if changes:
+                    titration_files.append(file)
+                for name, id in changes:
+                    reasons[f"{name} {id}"] += 1
+        for reason, count in reasons.most_common():
+            logger.info(f"{count} files affected by {reason}")
+        logger.info(
+            f"Reprocessing {len(titration_files)} of {len(latest)} files in {self.results}"
+        )
+        sink = ResultsSink(self.results)
+        hashes = {file: file_hash(file) for file in titration_files}
+        return self._process_and_report(titration_files, sink, params_hash, hashes)
+
+    def _process_and_report(
+        self,
+        titration_files: list,
+        sink: ResultsSink = None,
+        params_hash: str = None,
+        hashes: dict = None,
+    ) -> list:
+        results = list()
+        try:
+            for result in self._process_all(titration_files):
+                results.append(result)
+                self._report(
+                    result, sink, hashes[result.file] if sink else None, params_hash
+                )
+        finally:
+            if sink:
+                sink.close()
+        failed = sum(1 for result in results if result.error)
+        if failed:
+            logger.warning(f"{failed} of {len(results)} files could not be processed")
+        if self.solver_stats:
+            solver_stats.report(results, self.solver_stats_csv)
+        return results
+
+    def watch(self, settle_time: float = 60.0, poll_interval: float = 1.0):
+        """
+        Keeps watching the folder and processes every titration file as soon
+        as it is complete, i.e., its size and modification time have not
+        changed for settle_time seconds, it has a BWD section, and it ends on
+        a full row. A file that changes after it was processed is processed
+        again. Runs until interrupted (Ctrl+C)
+
+        Args:
+            settle_time (float): seconds a file has to stay unchanged, well
+                above the ~15 s LabVIEW waits between points
+            poll_interval (float): seconds between scans of the folder
+        """
+        if not self.path:
+            raise NotADirectoryError("Watch mode needs a folder, not a single file")
+        sink = ResultsSink(self.results) if self.results else None
+        params_hash = parameters_hash(self.parameters)
+        # file -> ((size, mtime), time that state was first seen)
+        seen = dict()
+        # file -> (size, mtime) it was processed at
+        processed = dict()
+        # file -> (size, mtime) it was found incomplete at, read again once
+        # it changes
+        incomplete = dict()
+        executor = None
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker
+            )
+        # future -> file hash
+        pending = dict()
+        logger.info(f"Watching {self.path} for titration files, Ctrl+C to stop")
+        try:
+            while True:
+                now = time.monotonic()
+                for file in get_matching_files(self.path, "", "csv"):
+                    # only stat calls for files that have not changed
+                    state = self._settled(file, seen, now, settle_time)
+                    if state is None or state in (
+                        processed.get(file),
+                        incomplete.get(file),
+                    ):
+                        continue
+                    if not self._is_complete(file):
+                        incomplete[file] = state
+                        continue
+                    incomplete.pop(file, None)
+                    if file in processed:
+                        logger.info(f"{file} changed after it was processed")
+                    processed[file] = state
+                    digest = file_hash(file)
+                    if sink and sink.is_done(digest, params_hash):
+                        logger.debug(f"{file} already has a result, skipping")
+                        continue
+                    if executor:
+                        future = executor.submit(self._try_process_titration, file)
+                        pending[future] = digest
+                    else:
+                        result = self._try_process_titration(file)
+                        self._report(result, sink, digest, params_hash)
+                for future in [future for future in pending if future.done()]:
+                    self._report_future(future, sink, pending.pop(future), params_hash)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finally:
+            try:
+                # finish what was already started
+                for future, digest in pending.items():
+                    self._report_future(future, sink, digest, params_hash)
+            finally:
+                # also after a second Ctrl+C, so the results file is closed
+                if executor:
+                    executor.shutdown(cancel_futures=True)
+                if sink:
+                    sink.close()
+
+    def _report_future(
+        self, future, sink: ResultsSink, file_hash: str, params_hash: str
+    ):
+        # a broken worker fails this one file, not the whole watch
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Worker failed: {e!r}")
+            return
+        self._report(result, sink, file_hash, params_hash)
 
-    def process_titration(self, file: str):
+    def _settled(self, file: str, seen: dict, now: float, settle_time: float) -> tuple:
+        # LabVIEW keeps appending rows, so wait until the file stops changing;
+        # the (size, mtime) of a file unchanged for settle_time, else None
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            seen.pop(file, None)
+            return None
+        state = (stat.st_size, stat.st_mtime_ns)
+        if file not in seen or seen[file][0] != state:
+            seen[file] = (state, now)
+            return None
+        if now - seen[file][1] < settle_time or not stat.st_size:
+            return None
+        return state
+
+    def _is_complete(self, file: str) -> bool:
+        with open(file, "r") as datafile:
+            text = datafile.read()
+        if not text.endswith("\n"):
+            return False
+        # the back titration is written last, a file without a BWD section or
+        # with a partial last row is still being written (or was abandoned,
+        # and is then picked up once it changes again)
+        lines = text.splitlines()
+        for i, line in enumerate(lines):
+            if "BWD" in next(csv.reader([line]), []):
+                bwd_rows = [row for row in lines[i + 1 :] if row.strip()]
+                return bool(bwd_rows) and (
+                    len(next(csv.reader(bwd_rows[-1:]))) >= len(datatypes)
+                )
+        return False
+
+    def _report(
+        self,
+        result: TitrationResult,
+        sink: ResultsSink = None,
+        file_hash: str = None,
+        params_hash: str = None,
+    ):
+        profiling.merge(result.file, result.profile)
+        if result.error:
+            logger.error(f"Failed to process {result.file}: {result.error}")
+        elif result.AT is not None:
+            if result.uncertainty is not None:
+                print(
+                    f"{result.file}: f = {result.f:.6f} ± {np.std(result.uncertainty.f):.6f}, "
+                    f"AT = {result.AT*1e6:.6f} ± {np.std(result.uncertainty.AT)*1e6:.6f}"
+                )
+            else:
+                print(f"{result.file}: f = {result.f:.6f}, AT = {result.AT*1e6:.6f}")
+        if sink:
+            row = {
+                **result._asdict(),
+                "file_hash": file_hash,
+                "params_hash": params_hash,
+                "dependencies": (
+                    None
+                    if result.dependencies is None
+                    else json.dumps(result.dependencies, sort_keys=True)
+                ),
+                "solver": (
+                    None
+                    if result.solver is None
+                    else json.dumps(result.solver._asdict())
+                ),
+            }
+            if result.uncertainty is not None:
+                row.update(
+                    f_sd=np.std(result.uncertainty.f),
+                    AT_sd=np.std(result.uncertainty.AT),
+                    E0_sd=np.std(result.uncertainty.E0),
+                    replicates=len(result.uncertainty.AT),
+                    replicates_converged=int(np.sum(result.uncertainty.converged)),
+                )
+            sink.append(row)
+
+    @property
+    def parameters(self) -> dict:
+        # everything besides the file content that changes a result
+        return {
+            "burette_id": self.burette_id,
+            "pH_range": self.pH_range,
+            "solver": self.solver,
+            "point_temperature": self.point_temperature,
+            "auto_window": self.auto_window,
+            # the stored spread of the replicates depends on these
+            "replicates": self.replicates,
+            "seed": self.seed,
+        }
+
+    def _process_all(self, titration_files: list):
+        # yields results in the same order as the files, as they finish
+        if self.workers > 1 and len(titration_files) > 1:
+            with ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker
+            ) as executor:
+                yield from executor.map(
+                    self._try_process_titration,
+                    titration_files,
+                    chunksize=max(1, len(titration_files) // (self.workers * 4)),
+                )
+        else:
+            for file in titration_files:
+                yield self._try_process_titration(file)
+
+    def _try_process_titration(self, file: str) -> TitrationResult:
+        # keep one bad file from stopping the rest of the batch
+        with registry.track() as dependencies:
+            try:
+                with profiling.stage("process_titration", file):
+                    result = self.process_titration(file)
+            except Exception as e:
+                result = TitrationResult(
+                    file, None, None, None, None, None, None, repr(e)
+                )
+        # records of a worker process go back to the main one with the result;
+        # failed files keep their lookups too, e.g., a missing titrant id
+        return result._replace(profile=profiling.pop(file), dependencies=dependencies)
+
+    def process_titration(self, file: str) -> TitrationResult:
         logger.debug(f"Processing this file now: {file}.")
-        sample, HCl_titration_data, NaOH_titration_data = titration_data(file)
+        with profiling.stage("titration_data"):
+            sample, HCl_titration_data, NaOH_titration_data = titration_data(
+                file, self.burette_id
+            )
         logger.debug(f"{file} successfully parsed.")
 
         # nutrients and constants already in Sample()
         # CT after degas also in sample
         # find index for good fwd titration data
-        HCl_titr_good_indices = find_data_in_range(3, 3.5, HCl_titration_data.pH_est)
-        # estimate E0 and AT from fwd
-        HCl_mass = HCl_titration_data.weight[HCl_titr_good_indices]
-        emf = HCl_titration_data.emf[HCl_titr_good_indices]
-        T = np.mean(HCl_titration_data.T[HCl_titr_good_indices])
+        good_points = HCl_titration_data.window_slice(*self.pH_range)
         try:
-            AT_est_fwd, E0_est_fwd = estimate_AT_E0(
-                HCl_mass, emf, T, sample.m0, HCl_titration_data.titrant.concentration
-            )
-            logger.info(
-                f"Estimated total alkalinity: {AT_est_fwd*1e6:.2f} umol/kg and E0: {E0_est_fwd:.4f} V"
-            )
+            with profiling.stage("gran"):
+                if self.auto_window:
+                    # where the Gran function of the whole titration is
+                    # linear instead of the pH range
+                    HCl_good_data = HCl_titration_data
+                else:
+                    HCl_good_data = HCl_titration_data.select(good_points)
+                # estimate E0 and AT from fwd
+                HCl_mass = HCl_good_data.weight
+                emf = HCl_good_data.emf
+                T = np.mean(HCl_good_data.T)
+                AT_est_fwd, E0_est_fwd = estimate_AT_E0(
+                    HCl_mass,
+                    emf,
+                    T,
+                    sample.m0,
+                    HCl_titration_data.titrant.concentration,
+                    self.auto_window,
+                )
+                logger.info(
+                    f"Estimated total alkalinity: {AT_est_fwd*1e6:.2f} umol/kg and E0: {E0_est_fwd:.4f} V"
+                )
         except:
             logger.warning("Not enough data in the forward titration")
             AT_est_fwd = None
             E0_est_fwd = None
 
+        f_fwd = AT_fwd = E0_fwd = fit_quality = uncertainty = stats = None
         if AT_est_fwd:
-            result = least_squares(
-                fun=partial(AT_residuals, sample=sample, titration=HCl_titration_data),
-                x0=[1, AT_est_fwd],
-                jac=partial(AT_jacobian, sample=sample, titration=HCl_titration_data),
-                method="lm",
-                xtol=1e-15,
-                ftol=1e-15,
-                gtol=1e-15,
+            if self.point_temperature:
+                # constants at the temperature of every titration point
+                fit_sample = sample.at(T=HCl_titration_data.T)
+            else:
+                # constants at the mean temperature of the titration
+                fit_sample = sample.at(T=np.mean(HCl_titration_data.T))
+            if self.solver == "lm":
+                # imported before the clock starts, it is not part of the fit
+                from scipy.optimize import least_squares
+            x0 = [1, AT_est_fwd]
+            start = time.perf_counter()
+            with profiling.stage("fit"):
+                if self.solver == "gn":
+                    result = ATSolver(fit_sample, HCl_titration_data).solve(x0)
+                else:
+                    result = least_squares(
+                        fun=partial(
+                            AT_residuals,
+                            sample=fit_sample,
+                            titration=HCl_titration_data,
+                        ),
+                        x0=x0,
+                        jac=partial(
+                            AT_jacobian, sample=fit_sample, titration=HCl_titration_data
+                        ),
+                        method="lm",
+                        xtol=1e-15,
+                        ftol=1e-15,
+                        gtol=1e-15,
+                    )
+            stats = solver_stats.from_result(
+                self.solver, result, x0, time.perf_counter() - start
             )
             # The result is a bit higher than the matlab function, needs more optimization
             # TODO might be issue with my constants, check solution classes
             f_fwd, AT_fwd = result.x
             E0_fwd = E0_est_fwd - k_boltz(T) * log(f_fwd)
-            print(f"f = {f_fwd:.6f}, AT = {AT_fwd*1e6:.6f}")
+            # root mean square of the mass balance residuals, in mol
+            fit_quality = float(np.sqrt(np.mean(result.fun**2)))
+            logger.debug(
+                f"f = {f_fwd:.6f}, AT = {AT_fwd*1e6:.6f} after {result.nfev} evaluations"
+            )
+            if self.replicates:
+                with profiling.stage("uncertainty"):
+                    uncertainty = AT_monte_carlo(
+                        fit_sample,
+                        HCl_titration_data,
+                        good_points,
+                        self.replicates,
+                        self.seed,
+                        auto_window=self.auto_window,
+                    )
 
         ## Back titration
-        if E0_fwd:
+        # not evaluated yet: AT from the pH 3-3.5 range and KW from the
+        # pH 9-10.5 range of the bwd titration, with the pH from E0_fwd
+        if NaOH_titration_data is not None and E0_fwd:
             NaOH_titration_data.recalculate_pH(E0_fwd)
-        # re-estimate NaOH pH data from fwd titration
-        NaOH_titr_good_indices = find_data_in_range(3, 3.5, NaOH_titration_data.pH_est)
-
-        # re-estimate the NaOH data with E0 from bwd low pH titr
-        NaOH_high_pH_data = find_data_in_range(9, 10.5, NaOH_titration_data.pH_est)
 
-        idx2 = "AT titration range for bwd 3-3.5"
-        idx3 = "KW titration range during bwd, 9-10.5"
+        return TitrationResult(
+            file,
+            sample.id,
+            sample.flag,
+            f_fwd,
+            AT_fwd,
+            E0_fwd,
+            fit_quality,
+            None,
+            uncertainty,
+            solver=stats,
+        )
 
     def fwd_titration(self, titration_data: Titration, sample):
         # This method should essentially give you the AT from data processing
@@ -137,6 +534,8 @@ class TitrateAX:
         Returns:
             list: valid files
         """
+        if self.path is None:
+            raise TitrationDataMissing("No titration file or folder was provided.")
         titration_files = get_matching_files(self.path, "", "csv")
         # catch if only one calibration file
         if not titration_files:
@@ -145,10 +544,7 @@ class TitrateAX:
             return titration_files
 
 
-try:
-    titration = TitrateAX(**vars(args))
-except TypeError as e:
-    logger.critical(f"Error in command line inputs: {e}")
-    sys.exit(1)
+if __name__ == "__main__":
+    from cli import main
 
-titration.titrate()
+    sys.exit(main(["titrate", *sys.argv[1:]]))
@@ -1,5 +1,5 @@
 from pathlib import Path
-import pandas as pd
+from auxiliary import registry
 
 
 def get_matching_files(folder: str, pattern: str, extension: str) -> list[str]:
@@ -16,12 +16,10 @@ def get_matching_files(folder: str, pattern: str, extension: str) -> list[str]:
         list: ordered by filename
     """
     folder_path = Path(folder)
+    # "**" is not a valid glob, so an empty pattern only matches the extension
+    glob_pattern = f"*{pattern}*{extension}" if pattern else f"*{extension}"
     return sorted(
-        [
-            str(file)
-            for file in folder_path.glob(f"*{pattern}*{extension}")
-            if file.is_file()
-        ]
+        [str(file) for file in folder_path.glob(glob_pattern) if file.is_file()]
     )
 
 
@@ -36,9 +34,8 @@ def get_system_constant(constant: str) -> float:
         float: value of constant
 
     """
-    df = pd.read_csv("auxiliary_data/system_constants.csv")
-    row = df[df["constant"] == constant]
+    row = registry.row("system_constants", constant)
 
-    value = float(row["value"].values[0])
+    value = float(row["value"])
 
     return value